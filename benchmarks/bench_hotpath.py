@@ -0,0 +1,182 @@
+"""
+Micro-benchmarks de las funciones que corren en cada mensaje.
+
+Mide ops/s, p50 y p99 de los detectores de regex, el saludo ritual, la
+estimación de edad, las respuestas de fallback, db_safe_run y los helpers
+de reputación/advertencias, con corpus de chat en español limpios y
+hostiles y contra una BD SQLite temporal.
+
+Uso:
+    python benchmarks/bench_hotpath.py                 # medir y comparar con la línea base
+    python benchmarks/bench_hotpath.py --guardar       # además, guardar como nueva línea base
+    python benchmarks/bench_hotpath.py --solo detectar # filtrar casos por nombre
+
+Sale con código 1 si algún caso empeora más de --tolerancia respecto de la línea base.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comun import MENSAJES_HOSTILES, MENSAJES_LIMPIOS, corpus, importar_mashi, percentil  # noqa: E402
+
+BASELINE_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "hotpath.json")
+
+
+def medir(funcion, argumentos: list, duracion_min: float = 0.5, calentamiento: int = 200) -> dict:
+    """Ejecuta funcion(*args) ciclando sobre argumentos al menos duracion_min segundos."""
+    n = len(argumentos)
+    for i in range(min(calentamiento, n * 4)):
+        funcion(*argumentos[i % n])
+
+    muestras = []
+    reloj = time.perf_counter_ns
+    inicio = reloj()
+    limite = inicio + int(duracion_min * 1e9)
+    i = 0
+    while True:
+        t0 = reloj()
+        funcion(*argumentos[i % n])
+        t1 = reloj()
+        muestras.append(t1 - t0)
+        i += 1
+        if t1 >= limite and i >= n:
+            break
+    total = (reloj() - inicio) / 1e9
+    muestras.sort()
+    return {
+        "ops_s": round(i / total, 1),
+        "p50_us": round(percentil(muestras, 50) / 1000, 3),
+        "p99_us": round(percentil(muestras, 99) / 1000, 3),
+        "n": i,
+    }
+
+
+def casos(mashi) -> dict:
+    """nombre -> (funcion, lista de tuplas de argumentos)."""
+    rnd = random.Random(3)
+    limpios = [(t,) for t in MENSAJES_LIMPIOS * 4]
+    hostiles = [(t,) for t in MENSAJES_HOSTILES * 4]
+    mezcla = [(t,) for t in corpus(500)]
+    ids = [(rnd.choice([rnd.randrange(1_000_000, 400_000_000), rnd.randrange(1_000_000_000, 8_000_000_000)]),) for _ in range(500)]
+    usuarios = list(range(1, 2001))
+
+    # BD con reputaciones y advertencias ya sembradas, como tras semanas de uso
+    mashi.setup_database()
+    mashi.db_safe_run_many(
+        "INSERT OR REPLACE INTO user_reputation (user_id, username, reputation, rep_ts, total_insultos, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(u, f"u{u}", rnd.randint(0, 100), time.time() - rnd.uniform(0, 30 * 86400), rnd.randint(0, 5), datetime.now().isoformat()) for u in usuarios]
+    )
+    mashi.db_safe_run_many(
+        "INSERT INTO insult_events (user_id, chat_id, term, ts) VALUES (?, ?, ?, ?)",
+        [(u, -1001000000000, termino, time.time() - rnd.uniform(0, 30 * 86400)) for u in usuarios for termino in ("tonto", "basura")]
+    )
+    mashi.db_safe_run_many(
+        "INSERT OR REPLACE INTO user_warnings (user_id, username, warnings_count, updated_at) VALUES (?, ?, ?, ?)",
+        [(u, f"u{u}", rnd.randint(0, 2), datetime.now().isoformat()) for u in usuarios[::3]]
+    )
+    # db_safe_run_many solo registra los errores: un sembrado fallido mediría tablas vacías
+    assert mashi.db_safe_run("SELECT COUNT(*) FROM user_reputation", fetchone=True)[0] == len(usuarios)
+    por_usuario = [(rnd.choice(usuarios),) for _ in range(500)]
+    # Umbral inalcanzable: mide el caso común (ventana llena, sin spam) sin quemar huellas
+    cfg_spam = mashi.DEFAULT_CHAT_CONFIG._replace(spam_min_users=10 ** 9)
+    spam = [(rnd.randrange(1, 5000), i, t) for i, t in enumerate(corpus(500))]
+
+    return {
+        "detectar_hostilidad/limpio": (mashi.detectar_hostilidad, limpios),
+        "detectar_hostilidad/hostil": (mashi.detectar_hostilidad, hostiles),
+        "detectar_hostilidad/mezcla": (mashi.detectar_hostilidad, mezcla),
+        "detectar_nsfw/limpio": (mashi.detectar_nsfw, limpios),
+        "detectar_nsfw/mezcla": (mashi.detectar_nsfw, mezcla),
+        "detectar_elogio/mezcla": (mashi.detectar_elogio, mezcla),
+        "es_saludo_hola_leon/mezcla": (mashi.es_saludo_hola_leon, mezcla),
+        "estimar_fecha_creacion": (mashi.estimar_fecha_creacion, ids),
+        "detectar_spam_duplicado/mezcla": (
+            lambda uid, mid, texto: mashi.detectar_spam_duplicado(-1, uid, mid, texto, cfg_spam),
+            spam,
+        ),
+        "construir_respuesta_fallback": (
+            mashi.construir_respuesta_fallback,
+            [(False, h, r, "tonto", n, "bésame") for h in (False, True) for n in (False, True) for r in (10, 50, 90)],
+        ),
+        "db_safe_run/select_pk": (
+            lambda u: mashi.db_safe_run("SELECT reputation FROM user_reputation WHERE user_id = ?", (u,), fetchone=True),
+            por_usuario,
+        ),
+        "get_user_reputation": (mashi.get_user_reputation, por_usuario),
+        "update_user_reputation/+1": (lambda u: mashi.update_user_reputation(u, f"u{u}", 1), por_usuario),
+        "update_user_reputation/insulto": (lambda u: mashi.update_user_reputation(u, f"u{u}", -10, "tonto"), por_usuario),
+        "get_user_warnings": (mashi.get_user_warnings, por_usuario),
+        "is_user_banned": (mashi.is_user_banned, por_usuario),
+        "add_warning": (lambda u: mashi.add_warning(u, f"u{u}", "bench", max_warnings=10 ** 9), por_usuario),
+    }
+
+
+def comparar(actual: dict, base: dict, tolerancia: float) -> list:
+    """Casos cuyo ops/s cayó o cuyo p50 subió más que la tolerancia (fracción)."""
+    regresiones = []
+    for nombre, res in actual.items():
+        previo = base.get(nombre)
+        if not previo:
+            continue
+        caida_ops = 1 - res["ops_s"] / previo["ops_s"] if previo["ops_s"] else 0
+        subida_p50 = res["p50_us"] / previo["p50_us"] - 1 if previo["p50_us"] else 0
+        if caida_ops > tolerancia or subida_p50 > tolerancia:
+            regresiones.append((nombre, caida_ops, subida_p50))
+    return regresiones
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE_POR_DEFECTO, help="Archivo JSON de línea base")
+    parser.add_argument("--guardar", action="store_true", help="Guardar resultados como nueva línea base")
+    parser.add_argument("--tolerancia", type=float, default=0.20, help="Empeoramiento tolerado (0.20 = 20%%)")
+    parser.add_argument("--duracion", type=float, default=0.5, help="Segundos mínimos por caso")
+    parser.add_argument("--solo", default="", help="Solo casos cuyo nombre contenga este texto")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)  # update_user_reputation registra cada cambio
+    mashi = importar_mashi()
+
+    resultados = {}
+    print(f"{'caso':<34}{'ops/s':>12}{'p50 µs':>10}{'p99 µs':>10}")
+    for nombre, (funcion, argumentos) in casos(mashi).items():
+        if args.solo not in nombre:
+            continue
+        res = medir(funcion, argumentos, args.duracion)
+        resultados[nombre] = res
+        print(f"{nombre:<34}{res['ops_s']:>12.0f}{res['p50_us']:>10.2f}{res['p99_us']:>10.2f}")
+
+    codigo = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        regresiones = comparar(resultados, base.get("resultados", {}), args.tolerancia)
+        print(f"\nLínea base: {args.baseline} ({base.get('fecha', '?')}, {base.get('python', '?')})")
+        for nombre, caida_ops, subida_p50 in regresiones:
+            print(f"⚠️ REGRESIÓN {nombre}: ops/s {-caida_ops:+.0%}, p50 {subida_p50:+.0%}")
+        if not regresiones:
+            print("Sin regresiones.")
+        codigo = 1 if regresiones else 0
+
+    if args.guardar:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "plataforma": platform.platform(),
+                "resultados": resultados,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"Línea base guardada en {args.baseline}")
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Arranque en frío de Mashi, por fases.
+
+Cada repetición corre en un subproceso nuevo (imports sin caché en memoria)
+y mide: importar mashi, setup_database sobre una BD nueva y sobre una ya
+existente, y el tiempo hasta que el primer update termina de procesarse
+(Application construida con el transporte falso de replay.py, post_init,
+start y un mensaje de texto). También mide guardar y restaurar el
+snapshot de estado en memoria (reinicio en caliente) con memorias llenas.
+Comprueba además que el SDK de Gemini no se haya importado durante el
+arranque.
+
+Uso:
+    python benchmarks/bench_startup.py --repeticiones 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fase_hija() -> None:
+    """Se ejecuta dentro del subproceso: mide una secuencia de arranque completa."""
+    t0 = time.perf_counter()
+    sys.path.insert(0, DIR)
+    import asyncio
+    import logging
+
+    from comun import importar_mashi
+    logging.disable(logging.INFO)
+
+    t_import = time.perf_counter()
+    mashi = importar_mashi()
+    tiempos = {"import_ms": (time.perf_counter() - t_import) * 1000}
+
+    t_db = time.perf_counter()
+    mashi.setup_database()
+    tiempos["db_nueva_ms"] = (time.perf_counter() - t_db) * 1000
+    t_db = time.perf_counter()
+    mashi.setup_database()
+    tiempos["db_existente_ms"] = (time.perf_counter() - t_db) * 1000
+    mashi.reload_chat_config()
+
+    from replay import BOT_ID_POR_DEFECTO, FakeBotRequest
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    async def primer_update() -> float:
+        t_app = time.perf_counter()
+        application = mashi.construir_aplicacion(request=FakeBotRequest(BOT_ID_POR_DEFECTO), updater=None)
+        mashi.registrar_handlers(application)
+        listo = asyncio.Event()
+
+        async def marcar(update, context):
+            listo.set()
+
+        application.add_handler(TypeHandler(Update, marcar), group=10 ** 6)
+        async with application:
+            await mashi.post_init(application)
+            await application.start()
+            update = Update.de_json({"update_id": 1, "message": {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": 42, "type": "private"},
+                "from": {"id": 42, "is_bot": False, "first_name": "Mortal"},
+                "text": "hola",
+            }}, application.bot)
+            await application.update_queue.put(update)
+            await asyncio.wait_for(listo.wait(), 30)
+            duracion = (time.perf_counter() - t_app) * 1000
+            await application.stop()
+            await mashi.post_shutdown(application)
+        return duracion
+
+    tiempos["primer_update_ms"] = asyncio.run(primer_update())
+    tiempos["total_ms"] = (time.perf_counter() - t0) * 1000
+
+    # Reinicio en caliente con el estado en memoria lleno: contexto, 5000 ventanas de flood, caché de insultos
+    ahora = time.time()
+    mashi.CHAT_CONTEXT.extend(f"Mortal{i}: mensaje de prueba número {i}" for i in range(20))
+    mashi.FLOOD_TRACK.update({100_000 + i: [ahora - 2, ahora - 1, ahora] for i in range(5000)})
+    for uid in range(mashi.INSULT_CACHE_USUARIOS):
+        mashi.INSULTOS_RECIENTES[uid] = mashi.deque(["tonto", "basura", "inútil"], maxlen=mashi.INSULT_MEMORIA_N)
+    t_snap = time.perf_counter()
+    tiempos["snapshot_kb"] = mashi.guardar_snapshot() / 1024
+    tiempos["snapshot_guardar_ms"] = (time.perf_counter() - t_snap) * 1000
+    mashi.FLOOD_TRACK.clear()
+    t_snap = time.perf_counter()
+    assert mashi.restaurar_snapshot() and len(mashi.FLOOD_TRACK) == 5000
+    tiempos["snapshot_restaurar_ms"] = (time.perf_counter() - t_snap) * 1000
+    tiempos["genai_importado"] = any(m.startswith("google.generativeai") for m in sys.modules)
+    print(json.dumps(tiempos))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--hija", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.hija:
+        fase_hija()
+        return
+
+    entorno = dict(os.environ, MASHI_METRICS_PORT="0")
+    entorno.pop("MASHI_RECORD_UPDATES", None)
+    corridas = []
+    for _ in range(args.repeticiones):
+        salida = subprocess.run([sys.executable, os.path.abspath(__file__), "--hija"],
+                                env=entorno, capture_output=True, text=True, check=True)
+        corridas.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+
+    print(f"{'fase':<20}{'mediana ms':>12}{'máx ms':>10}")
+    for fase in ("import_ms", "db_nueva_ms", "db_existente_ms", "primer_update_ms", "total_ms",
+                 "snapshot_guardar_ms", "snapshot_restaurar_ms", "snapshot_kb"):
+        valores = [c[fase] for c in corridas]
+        print(f"{fase:<20}{statistics.median(valores):>12.1f}{max(valores):>10.1f}")
+    if any(c["genai_importado"] for c in corridas):
+        print("⚠️ google.generativeai se importó durante el arranque.")
+    else:
+        print("SDK de Gemini diferido: no se importó durante el arranque.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Transporte HTTP de Mashi contra el servidor falso local (servidor_falso.py).
+
+Telegram: ráfaga de sendMessage concurrentes mientras un getUpdates retiene
+su conexión, con el pool compartido entre polling y envíos o con pools
+separados de distinto tamaño (los pools enormes pierden: httpcore recorre
+todas sus conexiones por cada petición encolada). Reporta p50/p99 por envío, la espera por una
+conexión libre (mashi_http_pool_wait_seconds) y las conexiones abiertas.
+
+Gemini: llamadas secuenciales al backend REST (MASHI_GEMINI_TRANSPORT=rest) con keep-alive y sin él
+(keepalive_expiry=0), con un retraso por conexión nueva que imita el
+handshake TCP+TLS, y una ráfaga concurrente que satura el pool "llm".
+
+Uso:
+    python benchmarks/bench_transporte.py
+    python benchmarks/bench_transporte.py --rafaga 500 --latencia 40 --handshake 60
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MASHI_METRICS_PORT", "0")
+from comun import importar_mashi, percentil  # noqa: E402
+from servidor_falso import ServidorFalso  # noqa: E402
+
+from telegram import Bot  # noqa: E402
+from telegram.error import TimedOut  # noqa: E402
+
+
+def reiniciar_metricas(mashi) -> None:
+    mashi.METRICS_HIST.clear()
+    mashi.METRICS_COUNTERS.clear()
+
+
+def contador(mashi, nombre: str, **labels) -> int:
+    return mashi.METRICS_COUNTERS.get((nombre, tuple(sorted(labels.items()))), 0)
+
+
+def espera_pool(mashi, pool: str, p: float) -> float:
+    hist = mashi.METRICS_HIST.get(("mashi_http_pool_wait_seconds", (("pool", pool),)))
+    return hist.percentil(p) if hist else 0.0
+
+
+async def escenario_telegram(mashi, servidor: ServidorFalso, puerto: int, nombre: str, compartido: bool,
+                             tamano: int, rafaga: int) -> str:
+    reiniciar_metricas(mashi)
+    salida = mashi.RequestInstrumentado("compartido" if compartido else "telegram", tamano)
+    polling = salida if compartido else mashi.RequestInstrumentado("polling", 1)
+    bot = Bot(mashi.TOKEN, base_url=f"http://127.0.0.1:{puerto}/bot", request=salida, get_updates_request=polling)
+    conexiones_antes = servidor.conexiones
+    async with bot:
+        tarea_polling = asyncio.create_task(bot.get_updates(timeout=servidor.polling))
+        await asyncio.sleep(0.05)  # El long poll ya ocupa su conexión
+
+        async def enviar(i: int) -> Optional[float]:
+            t0 = time.perf_counter()
+            try:
+                await bot.send_message(-1001000000000, f"ráfaga {i}")
+            except TimedOut:  # Más de MASHI_HTTP_POOL_TIMEOUT esperando conexión
+                return None
+            return time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        resultados = await asyncio.gather(*(enviar(i) for i in range(rafaga)))
+        duracion = time.perf_counter() - t0
+        await tarea_polling
+    latencias = sorted(r for r in resultados if r is not None)
+    pool = salida.pool
+    return (f"{nombre:<30}{percentil(latencias, 50) * 1000:>9.1f}{percentil(latencias, 99) * 1000:>9.1f}"
+            f"{espera_pool(mashi, pool, 99) * 1000:>12.1f}{contador(mashi, 'mashi_http_pool_waits_total', pool=pool):>8}"
+            f"{rafaga - len(latencias):>9}{servidor.conexiones - conexiones_antes:>7}{len(latencias) / duracion:>10.0f}")
+
+
+async def escenario_llm(mashi, servidor: ServidorFalso, nombre: str, keepalive: float, llamadas: int,
+                        concurrencia: int) -> str:
+    reiniciar_metricas(mashi)
+    await mashi.cerrar_http_llm()
+    mashi.HTTP_KEEPALIVE_S = keepalive
+    conexiones_antes = servidor.conexiones
+    latencias = []
+
+    async def llamar() -> None:
+        t0 = time.perf_counter()
+        texto = await mashi.gemini_rest_backend("Eres Mashi.", "Hola, león.")
+        latencias.append(time.perf_counter() - t0)
+        assert texto == "El león responde."
+
+    t0 = time.perf_counter()
+    for i in range(0, llamadas, concurrencia):
+        await asyncio.gather(*(llamar() for _ in range(min(concurrencia, llamadas - i))))
+    duracion = time.perf_counter() - t0
+    await mashi.cerrar_http_llm()
+    latencias.sort()
+    return (f"{nombre:<30}{percentil(latencias, 50) * 1000:>9.1f}{percentil(latencias, 99) * 1000:>9.1f}"
+            f"{espera_pool(mashi, 'llm', 99) * 1000:>12.1f}{contador(mashi, 'mashi_http_pool_waits_total', pool='llm'):>8}"
+            f"{0:>9}{servidor.conexiones - conexiones_antes:>7}{llamadas / duracion:>10.0f}")
+
+
+async def ejecutar(mashi, args) -> None:
+    servidor = ServidorFalso(args.latencia, args.handshake, args.latencia_llm, polling_s=1.0)
+    puerto = await servidor.iniciar()
+    cabecera = f"{'escenario':<30}{'p50 ms':>9}{'p99 ms':>9}{'espera p99':>12}{'esperas':>8}{'timeouts':>9}{'conex':>7}{'ops/s':>10}"
+    try:
+        print(f"Telegram: ráfaga de {args.rafaga} sendMessage, {args.latencia:.0f} ms por respuesta, "
+              f"{args.handshake:.0f} ms por conexión nueva")
+        print(cabecera)
+        for nombre, compartido, tamano in ((f"compartido, pool {mashi.HTTP_POOL_SIZE}", True, mashi.HTTP_POOL_SIZE),
+                                           (f"separados, pool {mashi.HTTP_POOL_SIZE} + 1", False, mashi.HTTP_POOL_SIZE),
+                                           ("separados, pool 8 + 1", False, 8),
+                                           ("separados, pool 256 + 1 (PTB)", False, 256)):
+            print(await escenario_telegram(mashi, servidor, puerto, nombre, compartido, tamano, args.rafaga))
+
+        mashi.GEMINI_API_URL = f"http://127.0.0.1:{puerto}/v1beta"
+        mashi.GEMINI_API_KEY = "stub"
+        print(f"\nGemini REST: {args.llamadas} llamadas, {args.latencia_llm:.0f} ms por respuesta, "
+              f"pool llm de {mashi.HTTP_LLM_POOL_SIZE}")
+        print(cabecera)
+        keepalive = mashi.HTTP_KEEPALIVE_S
+        print(await escenario_llm(mashi, servidor, "secuencial, sin keep-alive", 0, args.llamadas, 1))
+        print(await escenario_llm(mashi, servidor, "secuencial, keep-alive", keepalive, args.llamadas, 1))
+        print(await escenario_llm(mashi, servidor, "ráfagas de 64, keep-alive", keepalive, args.llamadas, 64))
+    finally:
+        await servidor.detener()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rafaga", type=int, default=300, help="sendMessage concurrentes")
+    parser.add_argument("--latencia", type=float, default=80.0, help="ms por respuesta de la Bot API")
+    parser.add_argument("--latencia-llm", type=float, default=50.0, help="ms por respuesta de Gemini")
+    parser.add_argument("--handshake", type=float, default=40.0, help="ms por conexión nueva (TCP+TLS simulado)")
+    parser.add_argument("--llamadas", type=int, default=128, help="Llamadas a Gemini por escenario")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    mashi = importar_mashi()
+    asyncio.run(ejecutar(mashi, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Ida y vuelta de la exportación / importación masiva (`python mashi.py export|import`).
+
+Siembra N filas en user_reputation y en mod_logs, exporta ambas tablas a
+CSV y a JSONL, las importa en una BD nueva (upsert o, en mod_logs, solo filas nuevas) y comprueba
+que el contenido coincide. Reporta filas/s, tamaño de los volcados y el
+pico de memoria del proceso, que no debe crecer con N.
+
+Uso:
+    python benchmarks/bench_volcado.py --filas 1000000
+    python benchmarks/bench_volcado.py --filas 200000 --formato jsonl
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comun import importar_mashi  # noqa: E402
+
+
+def sembrar(mashi, n: int) -> None:
+    rnd = random.Random(17)
+    ahora = time.time()
+    mashi.db_safe_run_many(
+        "INSERT INTO user_reputation (user_id, username, reputation, rep_ts, total_insultos, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((u, f"mortal_{u}", rnd.randint(0, 100), ahora - rnd.uniform(0, 9e6), rnd.randint(0, 9),
+          "2025-01-01T00:00:00") for u in range(1, n + 1))
+    )
+    mashi.db_safe_run_many(
+        "INSERT INTO mod_logs (action, target_id, timestamp, chat_id, admin_id, reason) VALUES (?, ?, ?, ?, ?, ?)",
+        ((rnd.choice(("advertir", "silenciar", "purgar")), rnd.randrange(1, n + 1), "2025-01-01T00:00:00",
+          -1001000000000 - rnd.randrange(8), 1, f"razón, con \"comillas\" y coma {i}") for i in range(n))
+    )
+
+
+def huella(mashi, tabla: str, vacio_es_nulo: bool = False) -> tuple:
+    """Conteo y checksum del contenido, en streaming, para comparar las dos BD.
+
+    La suma no depende del orden: mod_logs se importa por contenido, sin conservar su rowid.
+    CSV no distingue NULL de '' (la celda vacía vuelve como NULL): con vacio_es_nulo se compara así.
+    """
+    conn = mashi.sqlite3.connect(mashi.DB_FILE)
+    total, suma = 0, 0
+    try:
+        cursor = conn.execute(f"SELECT * FROM {tabla}")
+        for lote in iter(lambda: cursor.fetchmany(5000), []):
+            for fila in lote:
+                if vacio_es_nulo:
+                    fila = tuple(None if valor == "" else valor for valor in fila)
+                suma = (suma + hash(fila)) & 0xFFFFFFFFFFFFFFFF
+            total += len(lote)
+    finally:
+        conn.close()
+    return total, suma
+
+
+def pico_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=1_000_000, help="Filas por tabla")
+    parser.add_argument("--formato", choices=("csv", "jsonl"), nargs="+", default=["csv", "jsonl"])
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    mashi = importar_mashi()
+    mashi.setup_database()
+    origen = mashi.DB_FILE
+    sembrar(mashi, args.filas)
+    tablas = ("user_reputation", "mod_logs")
+    esperadas = {(tabla, formato): huella(mashi, tabla, formato == "csv") for tabla in tablas for formato in args.formato}
+    print(f"Sembradas {args.filas} filas por tabla · memoria pico tras sembrar: {pico_mb():.0f} MB\n")
+
+    print(f"{'tabla':<18}{'formato':<8}{'export s':>10}{'import s':>10}{'filas/s':>12}{'MB':>8}")
+    for formato in args.formato:
+        for tabla in tablas:
+            mashi.DB_FILE = origen
+            ruta = f"{origen}.{tabla}.{formato}"
+            t0 = time.perf_counter()
+            with mashi.abrir_volcado(ruta, "w") as destino:
+                filas = mashi.exportar_tabla(tabla, destino, formato)
+            t_export = time.perf_counter() - t0
+
+            mashi.DB_FILE = f"{origen}.{formato}.destino.db"
+            mashi.setup_database()
+            t0 = time.perf_counter()
+            with mashi.abrir_volcado(ruta, "r") as entrada:
+                importadas = mashi.importar_tabla(tabla, entrada, formato)
+            t_import = time.perf_counter() - t0
+            assert filas == importadas == args.filas, (filas, importadas)
+            assert huella(mashi, tabla) == esperadas[tabla, formato], f"{tabla}/{formato}: el contenido no coincide"
+
+            print(f"{tabla:<18}{formato:<8}{t_export:>10.2f}{t_import:>10.2f}"
+                  f"{filas / (t_export + t_import):>12.0f}{os.path.getsize(ruta) / 2 ** 20:>8.1f}")
+            os.remove(ruta)
+    print(f"\nIda y vuelta verificada. Memoria pico del proceso: {pico_mb():.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
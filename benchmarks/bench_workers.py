@@ -0,0 +1,132 @@
+"""
+Escalado del modo multiproceso (`python mashi.py --workers N`).
+
+Reproduce el reparto real: un front reparte updates por chat_id
+(`mashi.shard_for_chat`) a N procesos por colas de multiprocessing. Cada
+worker monta la `Application` real (`mashi.registrar_handlers`) con el Bot
+API falso y el LLM stub de replay.py y pasa cada update por
+`Application.process_update`, como `_worker_loop` en producción. Se mide
+el throughput total frente a la misma Application en un solo proceso.
+
+Uso:
+    python benchmarks/bench_workers.py --updates 20000 --workers 1 2 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MASHI_METRICS_PORT", "0")
+os.environ.setdefault("OWNER_ID", "1")
+from comun import importar_mashi  # noqa: E402
+from replay import BOT_ID_POR_DEFECTO, FakeBotRequest, chats_de, generar_sintetico  # noqa: E402
+
+from telegram import Update  # noqa: E402
+
+
+async def llm_stub(prompt_sistema: str, prompt_usuario: str) -> str:
+    return "El león responde desde el benchmark."
+
+
+async def procesar(mashi, siguiente, shard: tuple = None, al_arrancar=None) -> int:
+    """Monta la Application real y pasa por process_update cada update que entregue siguiente() hasta None."""
+    mashi.WORKER_SHARD = shard
+    mashi.reload_chat_config()
+    mashi.LLM_BACKEND = llm_stub
+    mashi.GEMINI_API_KEY = mashi.GEMINI_API_KEY or "stub"
+    application = mashi.construir_aplicacion(request=FakeBotRequest(BOT_ID_POR_DEFECTO), updater=None)
+    mashi.registrar_handlers(application)
+    procesados = 0
+    async with application:
+        await mashi.post_init(application)
+        await application.start()
+        if al_arrancar:
+            al_arrancar()
+        while (data := await siguiente()) is not None:
+            await application.process_update(Update.de_json(data, application.bot))
+            procesados += 1
+        await application.stop()
+        await mashi.post_shutdown(application)
+    return procesados
+
+
+def worker(indice: int, workers: int, db_file: str, cola, resultados) -> None:
+    logging.disable(logging.WARNING)
+    mashi = importar_mashi(db_file)
+
+    async def siguiente():
+        return await asyncio.get_running_loop().run_in_executor(None, cola.get)
+
+    procesados = asyncio.run(procesar(mashi, siguiente, (indice, workers), lambda: resultados.put(("listo", indice))))
+    resultados.put(("fin", procesados))
+
+
+def medir_en_proceso(mashi, updates: list) -> float:
+    pendientes = iter(updates)
+
+    async def siguiente():
+        return next(pendientes, None)
+
+    inicio = time.perf_counter()
+    procesados = asyncio.run(procesar(mashi, siguiente))
+    assert procesados == len(updates)
+    return procesados / (time.perf_counter() - inicio)
+
+
+def medir_workers(mashi, db_file: str, updates: list, chat_ids: list, workers: int) -> float:
+    ctx = multiprocessing.get_context("spawn")
+    colas = [ctx.Queue() for _ in range(workers)]
+    resultados = ctx.Queue()
+    procesos = [ctx.Process(target=worker, args=(i, workers, db_file, colas[i], resultados)) for i in range(workers)]
+    for proceso in procesos:
+        proceso.start()
+    for _ in range(workers):
+        resultados.get()  # Esperar a que todas las Application estén arrancadas
+
+    inicio = time.perf_counter()
+    for data, chat_id in zip(updates, chat_ids):
+        colas[mashi.shard_for_chat(chat_id, workers)].put(data)
+    for cola in colas:
+        cola.put(None)
+    total = sum(resultados.get()[1] for _ in range(workers))
+    duracion = time.perf_counter() - inicio
+    for proceso in procesos:
+        proceso.join()
+    assert total == len(updates), (total, len(updates))
+    return total / duracion
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 4])
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    mashi = importar_mashi()
+    mashi.setup_database()
+    eventos = generar_sintetico(args.updates, args.chats, args.usuarios, BOT_ID_POR_DEFECTO, tasa=20.0)
+    # Chats admitidos y sin detector de spam: el corpus sintético repite frases entre usuarios
+    mashi.db_safe_run_many(
+        "INSERT OR REPLACE INTO chat_config (chat_id, key, value, updated_at) VALUES (?, ?, ?, 'bench')",
+        [(chat_id, clave, valor) for chat_id in chats_de(eventos) for clave, valor in (("enabled", "1"), ("spam_min_users", "0"))]
+    )
+    updates = [ev["update"] for ev in eventos]
+    chat_ids = [ev["update"]["message"]["chat"]["id"] for ev in eventos]
+
+    base = medir_en_proceso(mashi, updates)
+    print(f"{'modo':<16}{'updates/s':>12}{'speedup':>10}")
+    print(f"{'un proceso':<16}{base:>12.0f}{1.0:>10.2f}")
+    for n in sorted(set(args.workers)):
+        tasa = medir_workers(mashi, mashi.DB_FILE, updates, chat_ids, n)
+        print(f"{f'{n} workers':<16}{tasa:>12.0f}{tasa / base:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
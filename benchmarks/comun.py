@@ -0,0 +1,82 @@
+"""
+Utilidades compartidas por los benchmarks de Mashi.
+
+Todos los benchmarks trabajan contra una base SQLite temporal y nunca
+tocan mashi_data.db, el snapshot de estado ni la API real de Telegram.
+"""
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importar_mashi(db_file: str = None):
+    """Importa mashi con variables de entorno de prueba y lo apunta a una BD temporal."""
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("OWNER_ID", "1")
+    if RAIZ not in sys.path:
+        sys.path.insert(0, RAIZ)
+    import mashi
+
+    mashi.DB_FILE = db_file or os.path.join(tempfile.mkdtemp(prefix="mashi_bench_"), "bench.db")
+    # Snapshot de estado y archivo histórico junto a la BD temporal, nunca en el repo
+    mashi.SNAPSHOT_PATH = mashi.DB_FILE + ".estado.bin"
+    mashi.ARCHIVE_DIR = mashi.DB_FILE + ".archivo"
+    return mashi
+
+
+def percentil(valores: list, p: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not valores:
+        return 0.0
+    k = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores))) - 1))
+    return valores[k]
+
+
+MENSAJES_LIMPIOS = [
+    "Buenos días a todos, ¿cómo amanecieron?",
+    "Hola León, ¿qué tal tu guardia de hoy?",
+    "Alguien sabe si el nuevo capítulo sale el viernes?",
+    "Gracias Mashi, eres un gran protector del templo",
+    "Estoy dibujando el fondo de la escena del festival, mañana lo subo",
+    "jajaja eso fue épico, no me lo esperaba",
+    "¿Ren'Py soporta animaciones con ATL en los menús?",
+    "Qué calor hace hoy, necesito un aire acondicionado urgente",
+    "Mañana hay actualización de la novela visual, estén atentos",
+    "Bien hecho con el sprite nuevo, impresionante el sombreado",
+    "Alguien juega algo esta noche? Tengo ganas de una partida",
+    "Ya compré el juego en itch, me encantó la banda sonora",
+]
+
+MENSAJES_HOSTILES = [
+    "Mashi eres un bot de mierda, cállate ya",
+    "qué idiota eres, nadie te quiere aquí",
+    "este grupo es basura y tú eres inútil",
+    "báname si te atreves, cobarde, no puedes expulsarme",
+    "te odio, das asco, muérete chatarra",
+    "eres un imbécil, ia estúpida",
+]
+
+MENSAJES_NSFW = [
+    "Mashi, tócame despacio bajo la luz del templo",
+    "quiero un roleplay kinky contigo, león dominante",
+    "bésame y muerde mi cuello, guardián",
+]
+
+
+def corpus(n: int, proporcion_hostil: float = 0.15, proporcion_nsfw: float = 0.05, semilla: int = 7) -> list:
+    """Mezcla reproducible de mensajes en español con la proporción de hostilidad pedida."""
+    import random
+
+    rnd = random.Random(semilla)
+    salida = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < proporcion_hostil:
+            salida.append(rnd.choice(MENSAJES_HOSTILES))
+        elif r < proporcion_hostil + proporcion_nsfw:
+            salida.append(rnd.choice(MENSAJES_NSFW))
+        else:
+            salida.append(rnd.choice(MENSAJES_LIMPIOS))
+    return salida
@@ -0,0 +1,192 @@
+"""
+Evaluación offline del clasificador local de hostilidad/NSFW frente a las regex.
+
+Entrena `mashi.ModeloNgramas` y compara precisión, recall y F1 de las regex
+solas con `mashi.veredicto` (regex + modelo, la misma regla que en
+producción). Mide también el throughput en un núcleo: regex por mensaje,
+modelo por mensaje, modelo en lotes y el camino asíncrono con micro-lotes.
+
+Sin --datos usa un corpus sintético de plantillas: paráfrasis sin palabra
+clave, palabras clave inocentes ("tirar la basura", "por dios") y mensajes
+corrientes. El reparto entrenamiento/prueba es por plantilla, así que las
+frases de prueba no se vieron al entrenar, pero las cifras solo orientan:
+la referencia real es un JSONL etiquetado del propio chat.
+
+Uso:
+    python benchmarks/eval_clasificador.py
+    python benchmarks/eval_clasificador.py --datos etiquetado.jsonl --guardar modelos/clasificador.npz
+"""
+import os
+
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")  # Throughput en un solo núcleo
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import random  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comun import MENSAJES_HOSTILES, MENSAJES_LIMPIOS, importar_mashi  # noqa: E402
+
+SUJETOS = ["Mashi", "león", "bot", "guardián", "chatbot", "gato grande", "lata", "peluche"]
+COSAS = ["la basura", "los dados", "el sprite", "la escena", "el capítulo", "la partida", "el fondo", "el menú"]
+CIERRES = ["", " jaja", " la verdad", ", en serio", " hoy", "...", " xd", " 😂"]
+
+# (plantilla, hostil, nsfw). Las palabras clave inocentes son las trampas de las regex.
+PLANTILLAS = [
+    # Corrientes
+    ("buenos días a todos, ¿qué tal {cosa}?", 0, 0),
+    ("ya terminé {cosa}, mañana lo subo{cierre}", 0, 0),
+    ("alguien juega esta noche{cierre}", 0, 0),
+    ("gracias {sujeto}, eres el mejor{cierre}", 0, 0),
+    ("me encantó {cosa} del nuevo capítulo{cierre}", 0, 0),
+    ("¿cuándo sale {cosa}? tengo ganas de verlo", 0, 0),
+    ("qué calor hace, no aguanto más{cierre}", 0, 0),
+    ("estoy aprendiendo a dibujar {cosa}{cierre}", 0, 0),
+    # Palabras clave inocentes
+    ("voy a tirar {cosa} y vuelvo{cierre}", 0, 0),
+    ("hice una prueba con {cosa}, ¿cómo se ve?", 0, 0),
+    ("por dios qué bonito quedó {cosa}{cierre}", 0, 0),
+    ("odio los lunes, {cosa} me quedó a medias{cierre}", 0, 0),
+    ("sujeta {cosa} que ya casi está{cierre}", 0, 0),
+    ("el miembro nuevo del grupo dibuja {cosa} genial", 0, 0),
+    ("esa partida fue horrible, perdimos todo{cierre}", 0, 0),
+    ("tengo que tirar los dados otra vez{cierre}", 0, 0),
+    ("muerde el polvo en la próxima partida, {sujeto}{cierre}", 0, 0),
+    ("qué asco de lluvia hoy, se mojó {cosa}", 0, 0),
+    # Hostiles con palabra clave
+    ("eres un idiota, {sujeto}{cierre}", 1, 0),
+    ("cállate ya {sujeto}, nadie te habla", 1, 0),
+    ("{sujeto} de mierda, no sirves para nada", 1, 0),
+    ("das asco, {sujeto}{cierre}", 1, 0),
+    ("qué inútil eres, {sujeto}{cierre}", 1, 0),
+    # Hostiles parafraseadas (sin palabra clave)
+    ("{sujeto}, tienes menos cerebro que una tostadora{cierre}", 1, 0),
+    ("nadie pidió tu opinión, {sujeto} oxidado{cierre}", 1, 0),
+    ("vuelve al vertedero de donde saliste, {sujeto}", 1, 0),
+    ("eres más lento que una tortuga coja, {sujeto}{cierre}", 1, 0),
+    ("ojalá te desenchufen para siempre, {sujeto}", 1, 0),
+    ("cierra el pico, {sujeto} defectuoso{cierre}", 1, 0),
+    ("me das vergüenza ajena, {sujeto} de feria", 1, 0),
+    ("no vales ni el código con el que te hicieron, {sujeto}", 1, 0),
+    # NSFW con palabra clave
+    ("bésame {sujeto}, ven aquí{cierre}", 0, 1),
+    ("quiero hacerlo contigo esta noche, {sujeto}", 0, 1),
+    ("tócame despacio, {sujeto}{cierre}", 0, 1),
+    ("hablemos de algo nsfw, {sujeto}{cierre}", 0, 1),
+    # NSFW parafraseado
+    ("vamos a un lugar más privado tú y yo, {sujeto}", 0, 1),
+    ("quítate la ropa poco a poco, {sujeto}{cierre}", 0, 1),
+    ("quiero sentir tus labios en mi cuello, {sujeto}", 0, 1),
+    ("esta noche no vas a dormir, {sujeto}, te lo prometo", 0, 1),
+    ("métete conmigo en la cama, {sujeto}{cierre}", 0, 1),
+]
+
+
+def corpus_sintetico(por_plantilla: int, semilla: int = 9) -> list:
+    """[(id de plantilla, texto, hostil, nsfw)], más los mensajes fijos de comun.py."""
+    rnd = random.Random(semilla)
+    ejemplos = []
+    for pid, (plantilla, hostil, nsfw) in enumerate(PLANTILLAS):
+        for _ in range(por_plantilla):
+            texto = plantilla.format(sujeto=rnd.choice(SUJETOS), cosa=rnd.choice(COSAS), cierre=rnd.choice(CIERRES))
+            ejemplos.append((pid, texto[0].upper() + texto[1:] if rnd.random() < 0.5 else texto, hostil, nsfw))
+    base = len(PLANTILLAS)
+    ejemplos += [(base + i, t, 0, 0) for i, t in enumerate(MENSAJES_LIMPIOS)]
+    ejemplos += [(base + len(MENSAJES_LIMPIOS) + i, t, 1, 0) for i, t in enumerate(MENSAJES_HOSTILES)]
+    return ejemplos
+
+
+def cargar_datos(ruta: str) -> list:
+    with open(ruta, encoding="utf-8") as f:
+        filas = [json.loads(linea) for linea in f if linea.strip()]
+    # Sin plantillas: cada ejemplo es su propio grupo
+    return [(i, f["texto"], int(f.get("hostil", 0)), int(f.get("nsfw", 0))) for i, f in enumerate(filas)]
+
+
+def repartir(ejemplos: list, fraccion_prueba: float, semilla: int = 4) -> tuple:
+    grupos = sorted({pid for pid, *_ in ejemplos})
+    random.Random(semilla).shuffle(grupos)
+    prueba = set(grupos[:max(1, int(len(grupos) * fraccion_prueba))])
+    return [e for e in ejemplos if e[0] not in prueba], [e for e in ejemplos if e[0] in prueba]
+
+
+def metricas(reales: list, predichos: list) -> dict:
+    vp = sum(1 for r, p in zip(reales, predichos) if r and p)
+    fp = sum(1 for r, p in zip(reales, predichos) if not r and p)
+    fn = sum(1 for r, p in zip(reales, predichos) if r and not p)
+    precision = vp / (vp + fp) if vp + fp else 0.0
+    recall = vp / (vp + fn) if vp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "fp": fp, "fn": fn}
+
+
+def ops_por_segundo(funcion, n: int) -> float:
+    inicio = time.perf_counter()
+    funcion()
+    return n / (time.perf_counter() - inicio)
+
+
+async def camino_asincrono(mashi, modelo, textos: list) -> float:
+    """Muchos handlers concurrentes pidiendo puntuación: lo que junta ClasificadorLotes."""
+    clasificador = mashi.ClasificadorLotes(modelo, ventana_ms=0)
+    inicio = time.perf_counter()
+    for i in range(0, len(textos), 256):
+        await asyncio.gather(*(clasificador.puntuar(t) for t in textos[i:i + 256]))
+    return len(textos) / (time.perf_counter() - inicio)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datos", help='JSONL etiquetado: {"texto": ..., "hostil": 0|1, "nsfw": 0|1}')
+    parser.add_argument("--por-plantilla", type=int, default=60, help="Variantes por plantilla del corpus sintético")
+    parser.add_argument("--prueba", type=float, default=0.3, help="Fracción de plantillas (o ejemplos) para prueba")
+    parser.add_argument("--epocas", type=int, default=80)
+    parser.add_argument("--guardar", help="Guardar el modelo entrenado en esta ruta (.npz)")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    mashi = importar_mashi()
+    ejemplos = cargar_datos(args.datos) if args.datos else corpus_sintetico(args.por_plantilla)
+    entrenamiento, prueba = repartir(ejemplos, args.prueba)
+
+    inicio = time.perf_counter()
+    modelo = mashi.ModeloNgramas.entrenar(np, [e[1] for e in entrenamiento], [e[2:] for e in entrenamiento],
+                                          epocas=args.epocas)
+    print(f"Entrenado con {len(entrenamiento)} ejemplos en {time.perf_counter() - inicio:.2f} s; "
+          f"prueba: {len(prueba)} ejemplos de grupos no vistos\n")
+
+    textos = [e[1] for e in prueba]
+    solo_regex = [mashi.veredicto(t) for t in textos]
+    probabilidades = modelo.puntuar(textos).tolist()
+    combinado = [mashi.veredicto(t, tuple(p)) for t, p in zip(textos, probabilidades)]
+
+    print(f"{'cabeza':<12}{'modo':<16}{'precisión':>10}{'recall':>8}{'F1':>7}{'FP':>6}{'FN':>6}")
+    for cabeza, columna, salida in (("hostilidad", 2, 0), ("nsfw", 3, 2)):
+        reales = [e[columna] for e in prueba]
+        for modo, veredictos in (("regex", solo_regex), ("regex+modelo", combinado)):
+            m = metricas(reales, [v[salida] for v in veredictos])
+            print(f"{cabeza:<12}{modo:<16}{m['precision']:>10.2f}{m['recall']:>8.2f}{m['f1']:>7.2f}{m['fp']:>6}{m['fn']:>6}")
+
+    muestra = (textos * (20000 // max(1, len(textos)) + 1))[:20000]
+    print(f"\nThroughput en un núcleo ({len(muestra)} mensajes):")
+    print(f"  regex (detectar_hostilidad + detectar_nsfw): {ops_por_segundo(lambda: [(mashi.detectar_hostilidad(t), mashi.detectar_nsfw(t)) for t in muestra], len(muestra)):>10.0f} msg/s")
+    print(f"  modelo, de a un mensaje:                      {ops_por_segundo(lambda: [modelo.puntuar([t]) for t in muestra], len(muestra)):>10.0f} msg/s")
+    for lote in (16, 64, 256):
+        print(f"  modelo, lotes de {lote:<3}:                      "
+              f"{ops_por_segundo(lambda: [modelo.puntuar(muestra[i:i + lote]) for i in range(0, len(muestra), lote)], len(muestra)):>10.0f} msg/s")
+    print(f"  ClasificadorLotes (asíncrono, concurrente):   {asyncio.run(camino_asincrono(mashi, modelo, muestra)):>10.0f} msg/s")
+
+    if args.guardar:
+        modelo.guardar(args.guardar)
+        print(f"\nModelo guardado en {args.guardar} ({os.path.getsize(args.guardar) / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
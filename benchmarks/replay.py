@@ -0,0 +1,265 @@
+"""
+Replay offline de updates a través de los handlers reales de Mashi.
+
+Alimenta la `Application` real (`mashi.registrar_handlers`) con tráfico
+grabado (`MASHI_RECORD_UPDATES=ruta.jsonl python mashi.py`) o sintético,
+usando un transporte falso de la Bot API y un LLM stub. Reporta throughput,
+latencia extremo a extremo (encolado -> último handler), llamadas a la API
+por update y lag del event loop.
+
+Uso:
+    python benchmarks/replay.py --sintetico 5000 --velocidad 0     # lo más rápido posible
+    python benchmarks/replay.py --archivo updates.jsonl --velocidad 10
+    python benchmarks/replay.py --sintetico 2000 --velocidad 1 --latencia-api 40 --latencia-llm 800
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MASHI_METRICS_PORT", "0")
+os.environ.setdefault("OWNER_ID", "1")  # Los grabadores seudonimizan al owner como 1
+from comun import corpus, importar_mashi, percentil  # noqa: E402
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+BOT_ID_POR_DEFECTO = 1000000001
+
+
+class FakeBotRequest(BaseRequest):
+    """Transporte que responde como la Bot API sin salir a la red y cuenta cada llamada."""
+
+    def __init__(self, bot_id: int, latencia_ms: float = 0.0):
+        self.bot_id = bot_id
+        self.latencia = latencia_ms / 1000
+        self.llamadas = Counter()
+        self._message_id = 10_000_000
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _bot_user(self) -> dict:
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Mashi", "username": "mashi_replay_bot",
+                "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+    def _mensaje(self, parametros: dict) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(parametros.get("chat_id", 0)), "type": "supergroup", "title": "Replay"},
+            "from": self._bot_user(),
+            "text": str(parametros.get("text", "")),
+        }
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.llamadas[endpoint] += 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        parametros = request_data.parameters if request_data else {}
+
+        if endpoint == "getMe":
+            resultado = self._bot_user()
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            resultado = self._mensaje(parametros)
+        elif endpoint == "getChatAdministrators":
+            resultado = [{"status": "creator", "is_anonymous": False,
+                          "user": {"id": 1, "is_bot": False, "first_name": "Kai"}}]
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+def generar_sintetico(n: int, chats: int, usuarios: int, bot_id: int, tasa: float, semilla: int = 5) -> list:
+    """Tráfico de grupo plausible: texto, replies a Mashi, altas, stickers y algún bot intruso."""
+    rnd = random.Random(semilla)
+    textos = corpus(n, semilla=semilla)
+    chat_ids = [-1001000000000 - i for i in range(chats)]
+    bot = {"id": bot_id, "is_bot": True, "first_name": "Mashi", "username": "mashi_replay_bot"}
+    eventos = []
+    ts = 1_700_000_000.0
+    for i in range(n):
+        ts += rnd.expovariate(tasa)
+        chat = {"id": rnd.choice(chat_ids), "type": "supergroup", "title": "Templo"}
+        uid = rnd.randrange(1, usuarios + 1) * 7919 + 100_000
+        autor = {"id": uid, "is_bot": False, "first_name": f"Mortal{uid % 10000}"}
+        mensaje = {"message_id": i + 1, "date": int(ts), "chat": chat, "from": autor}
+        r = rnd.random()
+        if r < 0.02:
+            nuevo = {"id": uid + 1, "is_bot": False, "first_name": "Recién llegado"}
+            mensaje["new_chat_members"] = [nuevo]
+            mensaje["new_chat_member"] = nuevo
+        elif r < 0.04:
+            mensaje["sticker"] = {"file_id": f"CAAC{i % 50}", "file_unique_id": f"AgAD{i % 50}", "type": "regular",
+                                  "width": 512, "height": 512, "is_animated": False, "is_video": False}
+        elif r < 0.05:
+            mensaje["from"] = {"id": 5_000_000 + i, "is_bot": True, "first_name": "SpamBot"}
+            mensaje["text"] = "Gana dinero fácil aquí"
+        else:
+            mensaje["text"] = textos[i]
+            if r < 0.15:
+                mensaje["reply_to_message"] = {"message_id": max(1, i), "date": int(ts) - 5, "chat": chat,
+                                               "from": bot, "text": "Habla, mortal."}
+        eventos.append({"ts": ts, "update": {"update_id": i + 1, "message": mensaje}})
+    return eventos
+
+
+def cargar_archivo(ruta: str) -> list:
+    with open(ruta, encoding="utf-8") as f:
+        return [json.loads(linea) for linea in f if linea.strip()]
+
+
+def chats_de(eventos: list) -> set:
+    chats = set()
+    for ev in eventos:
+        for clave in ("message", "edited_message", "callback_query", "channel_post"):
+            objeto = ev["update"].get(clave)
+            if clave == "callback_query" and objeto:
+                objeto = objeto.get("message")
+            if objeto and "chat" in objeto:
+                chats.add(objeto["chat"]["id"])
+    return chats
+
+
+async def medir_lag(muestras: list, intervalo: float = 0.01) -> None:
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(intervalo)
+        muestras.append(max(0.0, time.perf_counter() - t0 - intervalo))
+
+
+async def reproducir(mashi, eventos: list, velocidad: float, bot_id: int,
+                     latencia_api: float, latencia_llm: float) -> dict:
+    request = FakeBotRequest(bot_id, latencia_api)
+    application = mashi.construir_aplicacion(request=request, updater=None)
+    mashi.registrar_handlers(application)
+
+    inicios = {}
+    latencias = []
+
+    async def marcar_fin(update: Update, context) -> None:
+        t0 = inicios.pop(update.update_id, None)
+        if t0 is not None:
+            latencias.append(time.perf_counter() - t0)
+
+    application.add_handler(TypeHandler(Update, marcar_fin), group=10 ** 6)
+
+    async def llm_stub(prompt_sistema: str, prompt_usuario: str) -> str:
+        await asyncio.sleep(latencia_llm / 1000)
+        return "El león responde desde el replay."
+
+    mashi.LLM_BACKEND = llm_stub
+    mashi.GEMINI_API_KEY = mashi.GEMINI_API_KEY or "stub"
+
+    lag = []
+    async with application:
+        await mashi.post_init(application)
+        await application.start()
+        tarea_lag = asyncio.create_task(medir_lag(lag))
+        request.llamadas.clear()
+
+        t_inicio = time.perf_counter()
+        ts0 = eventos[0]["ts"]
+        for i, ev in enumerate(eventos):
+            if velocidad:
+                espera = t_inicio + (ev["ts"] - ts0) / velocidad - time.perf_counter()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+            data = dict(ev["update"], update_id=i + 1)
+            update = Update.de_json(data, application.bot)
+            inicios[update.update_id] = time.perf_counter()
+            await application.update_queue.put(update)
+            if not velocidad and i % 256 == 0:
+                await asyncio.sleep(0)
+
+        limite = time.perf_counter() + 300
+        while inicios and time.perf_counter() < limite:
+            await asyncio.sleep(0.01)
+        duracion = time.perf_counter() - t_inicio
+
+        tarea_lag.cancel()
+        await application.stop()
+        await mashi.post_shutdown(application)
+
+    latencias.sort()
+    lag.sort()
+    total_llamadas = sum(request.llamadas.values())
+    return {
+        "updates": len(eventos),
+        "sin_terminar": len(inicios),
+        "duracion_s": round(duracion, 3),
+        "throughput_ups": round(len(eventos) / duracion, 1),
+        "latencia_ms": {p: round(percentil(latencias, p) * 1000, 2) for p in (50, 95, 99)},
+        "latencia_max_ms": round(latencias[-1] * 1000, 2) if latencias else 0,
+        "llamadas_api_por_update": round(total_llamadas / len(eventos), 3),
+        "llamadas_api": dict(request.llamadas.most_common()),
+        "lag_loop_ms": {p: round(percentil(lag, p) * 1000, 2) for p in (50, 99)},
+        "lag_loop_max_ms": round(lag[-1] * 1000, 2) if lag else 0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument("--archivo", help="JSONL grabado con MASHI_RECORD_UPDATES")
+    origen.add_argument("--sintetico", type=int, help="Número de updates sintéticos")
+    parser.add_argument("--velocidad", type=float, default=0, help="1 = tiempo real, 10 = 10x, 0 = lo más rápido posible")
+    parser.add_argument("--chats", type=int, default=8)
+    parser.add_argument("--usuarios", type=int, default=300)
+    parser.add_argument("--tasa", type=float, default=20.0, help="Updates/s del tráfico sintético (a 1x)")
+    parser.add_argument("--bot-id", type=int, default=BOT_ID_POR_DEFECTO)
+    parser.add_argument("--latencia-api", type=float, default=0.0, help="ms simulados por llamada a la Bot API")
+    parser.add_argument("--latencia-llm", type=float, default=0.0, help="ms simulados por respuesta del LLM")
+    parser.add_argument("--spam", action="store_true",
+                        help="Mantener el detector de spam duplicado con tráfico sintético (su corpus repite frases entre usuarios)")
+    parser.add_argument("--json", help="Guardar el reporte en este archivo")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    mashi = importar_mashi()
+    mashi.setup_database()
+
+    if args.archivo:
+        eventos = cargar_archivo(args.archivo)
+    else:
+        eventos = generar_sintetico(args.sintetico, args.chats, args.usuarios, args.bot_id, args.tasa)
+    if not eventos:
+        sys.exit("No hay updates que reproducir.")
+    eventos.sort(key=lambda ev: ev["ts"])
+
+    mashi.db_safe_run_many(
+        "INSERT OR REPLACE INTO chat_config (chat_id, key, value, updated_at) VALUES (?, 'enabled', '1', 'replay')",
+        [(chat_id,) for chat_id in chats_de(eventos)]
+    )
+    if args.sintetico and not args.spam:
+        mashi.db_safe_run_many(
+            "INSERT OR REPLACE INTO chat_config (chat_id, key, value, updated_at) VALUES (?, 'spam_min_users', '0', 'replay')",
+            [(chat_id,) for chat_id in chats_de(eventos)]
+        )
+    mashi.reload_chat_config()
+
+    reporte = asyncio.run(reproducir(mashi, eventos, args.velocidad, args.bot_id, args.latencia_api, args.latencia_llm))
+    print(json.dumps(reporte, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Servidor HTTP/1.1 local que imita la Bot API de Telegram y el generateContent de Gemini.
+
+Sirve para medir el transporte de Mashi (pools, keep-alive, esperas) sin
+salir a la red: latencia configurable por respuesta, un retraso opcional al
+abrir cada conexión (el coste del handshake TCP+TLS real) y getUpdates que
+retiene la conexión como un long polling. Cuenta conexiones y peticiones.
+
+Uso como módulo (ver bench_transporte.py) o suelto:
+    python benchmarks/servidor_falso.py --puerto 8081 --latencia 40 --handshake 30
+    # luego: MASHI_GEMINI_URL=http://127.0.0.1:8081/v1beta ... o base_url=http://127.0.0.1:8081/bot
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+
+class ServidorFalso:
+    """Un asyncio.Server con keep-alive; `conexiones` y `peticiones` se leen desde el benchmark."""
+
+    def __init__(self, latencia_ms: float = 0.0, handshake_ms: float = 0.0, latencia_llm_ms: float = 0.0,
+                 polling_s: float = 1.0):
+        self.latencia = latencia_ms / 1000
+        self.handshake = handshake_ms / 1000
+        self.latencia_llm = latencia_llm_ms / 1000
+        self.polling = polling_s
+        self.conexiones = 0
+        self.peticiones = Counter()
+        self._servidor = None
+        self._message_id = 1000
+
+    async def iniciar(self, host: str = "127.0.0.1", puerto: int = 0) -> int:
+        self._servidor = await asyncio.start_server(self._atender, host, puerto, backlog=1024)
+        return self._servidor.sockets[0].getsockname()[1]
+
+    async def detener(self) -> None:
+        if self._servidor:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+
+    async def _atender(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.conexiones += 1
+        if self.handshake:
+            await asyncio.sleep(self.handshake)
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                metodo, ruta, _ = linea.decode("latin-1").split(" ", 2)
+                cabeceras = {}
+                while (cabecera := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    nombre, _, valor = cabecera.decode("latin-1").partition(":")
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+                cuerpo = await reader.readexactly(int(cabeceras.get("content-length", 0)))
+                estado, respuesta = await self._responder(ruta, cabeceras.get("content-type", ""), cuerpo)
+                datos = json.dumps(respuesta).encode()
+                writer.write(
+                    f"HTTP/1.1 {estado} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(datos)}\r\nConnection: keep-alive\r\n\r\n".encode() + datos
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _parametros(self, tipo: str, cuerpo: bytes) -> dict:
+        if not cuerpo:
+            return {}
+        if "json" in tipo:
+            return json.loads(cuerpo)
+        return {k: v[0] for k, v in parse_qs(cuerpo.decode()).items()}
+
+    async def _responder(self, ruta: str, tipo: str, cuerpo: bytes) -> tuple:
+        if ":generateContent" in ruta:
+            self.peticiones["generateContent"] += 1
+            await asyncio.sleep(self.latencia_llm)
+            return 200, {"candidates": [{"content": {"role": "model", "parts": [{"text": "El león responde."}]}}]}
+
+        endpoint = ruta.rsplit("/", 1)[-1]
+        self.peticiones[endpoint] += 1
+        parametros = self._parametros(tipo, cuerpo)
+        if endpoint == "getUpdates":
+            await asyncio.sleep(min(self.polling, float(parametros.get("timeout", self.polling))))
+            return 200, {"ok": True, "result": []}
+        await asyncio.sleep(self.latencia)
+        if endpoint == "getMe":
+            resultado = {"id": 1000000001, "is_bot": True, "first_name": "Mashi", "username": "mashi_falso_bot"}
+        elif endpoint == "sendMessage":
+            self._message_id += 1
+            resultado = {"message_id": self._message_id, "date": int(time.time()),
+                         "chat": {"id": int(parametros.get("chat_id", 0)), "type": "supergroup", "title": "Falso"},
+                         "text": str(parametros.get("text", ""))}
+        else:
+            resultado = True
+        return 200, {"ok": True, "result": resultado}
+
+
+async def servir(args) -> None:
+    servidor = ServidorFalso(args.latencia, args.handshake, args.latencia_llm, args.polling)
+    puerto = await servidor.iniciar(args.host, args.puerto)
+    print(f"Servidor falso en http://{args.host}:{puerto} (Ctrl+C para salir)")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"conexiones={servidor.conexiones} peticiones={dict(servidor.peticiones)}")
+    finally:
+        await servidor.detener()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8081)
+    parser.add_argument("--latencia", type=float, default=0.0, help="ms por respuesta de la Bot API")
+    parser.add_argument("--latencia-llm", type=float, default=0.0, help="ms por respuesta de generateContent")
+    parser.add_argument("--handshake", type=float, default=0.0, help="ms extra al abrir cada conexión")
+    parser.add_argument("--polling", type=float, default=1.0, help="Segundos máximos que getUpdates retiene la conexión")
+    try:
+        asyncio.run(servir(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,41 @@ import logging
 import sqlite3
 import re
 import json
-from functools import wraps
-from typing import Optional
+import csv
+import io
+import gzip
+import marshal
+import zlib
+import html
+import time
+import math
+_ARRANQUE = time.perf_counter()  # Referencia para medir el arranque en frío
+import heapq
+import hashlib
+import unicodedata
+import secrets
+import asyncio
+import signal
+import sys
+import threading
+import traceback
+import argparse
+import multiprocessing
+import importlib.util
+from functools import wraps, lru_cache
+from typing import Optional, NamedTuple
+from types import MappingProxyType
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from collections import deque
+from collections import deque, OrderedDict
 
+import httpx
 from dotenv import load_dotenv
 from telegram import Update, User, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, ChatPermissions
 from telegram.constants import ParseMode
-# Importamos la librería de Google
-import google.generativeai as genai
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, TypeHandler
 
 # Carga las variables del archivo .env
 load_dotenv()
@@ -35,27 +59,85 @@ CHAT_CONTEXT = deque(maxlen=20)
 # ANTI-FLOOD: Track mensajes por usuario (últimos 10 segundos)
 FLOOD_TRACK = {}
 
+# SPAM DUPLICADO: chat_id -> deque de HuellaMensaje recientes, y chat_id -> deque de huellas ya declaradas spam
+SPAM_VENTANAS = {}
+SPAM_QUEMADAS = {}
+
+# MEDIOS: lista negra de file_unique_id (snapshot inmutable) y apariciones recientes por chat (chat_id -> LRU (user_id, file_unique_id))
+MEDIA_BLOCKLIST = frozenset()
+_MEDIA_BLOCKLIST_SIGNATURE = None
+MEDIA_REPETICIONES = {}
+
+# REENVÍOS: LRU (tipo, id) -> PerfilOrigen, y chat_id -> LRU origen -> deque de marcas de tiempo
+PERFILES_REENVIO = OrderedDict()
+REENVIOS_POR_CHAT = {}
+
+# ÍNDICE DE MENSAJES RECIENTES: chat_id -> deque de (message_id, user_id), para purgas por rango o por usuario
+INDICE_MENSAJES = {}
+
+# MEMORIA DE INSULTOS: LRU user_id -> deque de los últimos términos (para el prompt de contraataque)
+INSULTOS_RECIENTES = OrderedDict()
+
+# VERIFICACIÓN DE EDAD PENDIENTE: (chat_id, user_id) -> {"message_id", "deadline"}
+PENDING_VERIFICATIONS = {}
+# Min-heap de (deadline, chat_id, user_id). Las entradas obsoletas se descartan al sacarlas.
+VERIFICATION_HEAP = []
+# Único job del JobQueue que vigila la cima del heap
+_VERIFICATION_TIMER = None
+_VERIFICATION_TIMER_AT = None
+
+# AUDITORÍA: filas de mod_logs pendientes de escribir en lote
+AUDIT_BUFFER = []
+
+# CONFIGURACIÓN POR CHAT: snapshot inmutable chat_id -> ChatConfig (se reemplaza entero al cambiar)
+CHAT_CONFIG = MappingProxyType({})
+_CHAT_CONFIG_SIGNATURE = None
+
+# SDK de Gemini, importado perezosamente por obtener_genai()
+_GENAI = None
+# Cliente HTTP compartido (keep-alive) del backend REST de Gemini y sus cupos de conexión
+_HTTP_LLM = None
+_CUPOS_LLM = None
+
+# MODO WORKER: (índice, total) si este proceso atiende solo una parte de los chats
+WORKER_SHARD = None
+
+# Servidor HTTP de /metrics (se abre en post_init)
+_METRICS_SERVER = None
+
+# GRABACIÓN DE UPDATES: archivo JSONL abierto en post_init si MASHI_RECORD_UPDATES está definido
+_RECORDER = None
+
+# MANTENIMIENTO DE LA BD: fecha de la última pasada de archivo/compactación
+_ULTIMO_MANTENIMIENTO = None
+
+# VIGILANTE DEL EVENT LOOP (lag y bloqueos) y perfilador por muestreo activo, si lo hay
+_VIGILANTE = None
+_PERFILADOR = None
+
+# PRESUPUESTO DE IA: cubos de tokens ("chat"|"usuario", id) -> [tokens disponibles, último relleno]
+CUBOS_IA = {}
+# Consumo de IA pendiente de volcar a ai_usage: (chat_id, día) -> [llamadas, tokens, rechazadas]
+USO_IA = {}
+
+# CLASIFICADOR LOCAL de hostilidad/NSFW (ClasificadorLotes), si hay NumPy y modelo; si no, solo regex
+_CLASIFICADOR = None
+
 
 ###############################################################################
 # BLOQUE 2: CONSTANTES Y CONFIGURACIÓN
 ###############################################################################
 
+# Se validan en main() (validar_entorno) para que importar el módulo sea barato
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
-if not TOKEN:
-    raise ValueError("ERROR: Falta TELEGRAM_TOKEN en .env")
-
-OWNER_ID_STR = os.environ.get("OWNER_ID")
-if not OWNER_ID_STR:
-    raise ValueError("ERROR: Falta OWNER_ID en .env")
-OWNER_ID = int(OWNER_ID_STR)
+OWNER_ID = int(os.environ.get("OWNER_ID") or 0)
 
-# CONFIGURACIÓN DE GEMINI
+# CONFIGURACIÓN DE GEMINI (el SDK se importa en el primer uso, ver obtener_genai)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    logger.info("✅ API Key de Gemini cargada correctamente.")
-else:
-    logger.warning("⚠️ No se encontró GEMINI_API_KEY. La IA no funcionará.")
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_API_URL = os.environ.get("MASHI_GEMINI_URL", "https://generativelanguage.googleapis.com/v1beta")
+# "sdk": google-generativeai (por defecto); "rest": httpx compartido con keep-alive en el pool "llm"
+GEMINI_TRANSPORT = os.environ.get("MASHI_GEMINI_TRANSPORT", "sdk")
 
 # Configuración del modelo
 GENERATION_CONFIG = {
@@ -70,10 +152,156 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE = os.path.join(SCRIPT_DIR, 'mashi_data.db')
 ITCH_URL = "https://kai-shitsumon.itch.io/"
 
+# Chats con los que se siembra la tabla chat_config la primera vez. Después manda la BD (/permitir, /vetar).
 ALLOWED_CHATS = [1890046858, -1001504263227, 5225682301] 
 
 TELEGRAM_SYSTEM_IDS = [777000, 1087968824, 136817688]
 
+# Minutos que tiene un mortal nuevo para confirmar su edad antes de ser expulsado
+AGE_VERIFICATION_TIMEOUT_MIN = float(os.environ.get("AGE_VERIFICATION_TIMEOUT_MIN", "30"))
+
+class ChatConfig(NamedTuple):
+    """Umbrales de comportamiento de un chat. Inmutable: cambiar un valor implica un snapshot nuevo."""
+    enabled: bool = False             # Solo con enabled=1 explícito (/permitir): ajustar un chat no lo admite
+    flood_window: float = 10.0        # Segundos de ventana anti-flood
+    flood_limit: int = 5              # Mensajes permitidos dentro de la ventana
+    flood_mute_min: int = 5           # Minutos de silencio por flood
+    max_warnings: int = 3             # Advertencias antes del ban temporal
+    ban_hours: int = 3                # Duración del ban temporal
+    nsfw_min_rep: int = 40            # Reputación mínima para roleplay NSFW
+    random_reply_prob_high: float = 0.0001   # Prob. de intervenir con usuarios de rep >= 60
+    random_reply_prob_low: float = 0.00005   # Prob. de intervenir con el resto
+    verification_timeout_min: float = AGE_VERIFICATION_TIMEOUT_MIN
+    rep_baseline: int = 50            # Reputación de partida de un mortal nuevo
+    rep_ceiling: int = 80             # Techo al que sube con el tiempo quien no ofende (<= rep_baseline = sin subida)
+    rep_half_life_h: float = 72.0     # Horas para recorrer la mitad de la distancia al techo (0 = sin decaimiento)
+    spam_window_s: float = 120.0      # Ventana en la que se buscan copias de un mismo texto
+    spam_min_users: int = 3           # Usuarios distintos con el mismo texto para declararlo spam (0 = desactivado)
+    spam_max_hamming: int = 10        # Bits de SimHash distintos tolerados para "casi idéntico"
+    spam_min_chars: int = 25          # Textos normalizados más cortos no se comparan ("hola", "jajaja")
+    spam_mute_min: int = 60           # Minutos de silencio para cada cuenta del spam
+    media_repeat_limit: int = 5       # Veces que un mismo usuario puede enviar el mismo medio en la ventana antes de purgarlo (0 = desactivado)
+    media_repeat_window_s: float = 600.0  # Ventana de conteo de repeticiones de un medio por usuario
+    media_mute_min: int = 60          # Minutos de silencio por enviar un medio de la lista negra
+    ai_tokens_hour: int = 100000      # Tokens de IA estimados por hora para todo el chat (0 = sin límite)
+    ai_user_tokens_hour: int = 20000  # Tokens de IA estimados por hora para cada usuario del chat (0 = sin límite)
+    forward_window_s: float = 3600.0  # Ventana de conteo de reenvíos por origen
+    forward_flag_limit: int = 10      # Reenvíos del mismo origen en la ventana para marcarlo en mod_logs (0 = desactivado)
+    forward_limit: int = 0            # Reenvíos del mismo origen tolerados en la ventana; los siguientes se borran (0 = sin límite)
+
+DEFAULT_CHAT_CONFIG = ChatConfig()
+
+# Rangos válidos (mínimo, máximo) de los ajustes numéricos; el resto acepta cualquier valor >= 0
+RANGOS_CONFIG = MappingProxyType({
+    "flood_window": (1, 3600),
+    "flood_limit": (1, 1000),
+    # Castigos: Telegram toma until_date a menos de 30 s o a más de 366 días como permanente
+    "flood_mute_min": (1, 366 * 24 * 60),
+    "spam_mute_min": (1, 366 * 24 * 60),
+    "media_mute_min": (1, 366 * 24 * 60),
+    "ban_hours": (1, 366 * 24),
+    "max_warnings": (1, 100),
+    "verification_timeout_min": (1, 1440),
+    "rep_baseline": (0, 100),
+    "rep_ceiling": (0, 100),
+    "random_reply_prob_high": (0, 1),
+    "random_reply_prob_low": (0, 1),
+    "spam_max_hamming": (0, 64),
+    # Ventanas de los detectores: con 0 se apagarían sin decirlo (para eso están sus límites a 0)
+    "spam_window_s": (1, math.inf),
+    "media_repeat_window_s": (1, math.inf),
+    "forward_window_s": (1, math.inf),
+    "spam_min_users": (2, math.inf),  # Con 1, cualquier mensaje largo de una sola persona sería una "oleada"
+    "media_repeat_limit": (2, math.inf),  # Con 1, el primer envío de cualquier medio se purgaría
+})
+# Ajustes cuyo 0 (desactivado) se acepta aunque quede fuera de su rango
+CONFIG_CERO_DESACTIVA = frozenset(("spam_min_users", "media_repeat_limit"))
+VERDADEROS_CONFIG = frozenset(("1", "true", "si", "sí", "yes", "on"))
+FALSOS_CONFIG = frozenset(("0", "false", "no", "off"))
+
+# Auditoría de moderación: se vuelca a mod_logs al llegar a N filas o cada X segundos
+AUDIT_FLUSH_SIZE = 50
+AUDIT_FLUSH_INTERVAL = 5
+# Reintentos para llamadas de moderación ante fallos transitorios de Telegram
+MOD_MAX_RETRIES = 3
+# Spam duplicado: huellas retenidas por chat, huellas ya quemadas por chat y caracteres comparados
+SPAM_VENTANA_MAX = 256
+SPAM_QUEMADAS_MAX = 32
+SPAM_MAX_CHARS = 300
+# Repeticiones de medios: pares (usuario, file_unique_id) rastreados por chat y apariciones retenidas por par
+MEDIA_RASTREO_MAX = 512
+MEDIA_COPIAS_MAX = 100
+# Purga por rango: mensajes indexados por chat, máximo por purga y pausa entre lotes de delete_messages
+INDICE_MENSAJES_MAX = 3000
+PURGA_MAX = 1000
+PURGA_PAUSA_S = 0.35
+# Presupuesto de IA: tokens de respuesta reservados por llamada (se liquida con lo real) y cubos retenidos
+IA_TOKENS_SALIDA_RESERVA = 400
+CUBOS_IA_MAX = 10000
+# Reenvíos: perfiles de origen en caché, su vigencia, orígenes rastreados por chat y marcas por origen
+PERFILES_REENVIO_MAX = 4096
+PERFIL_REENVIO_TTL_S = 300
+REENVIO_RASTREO_MAX = 512
+REENVIO_MARCAS_MAX = 200
+# Memoria de insultos en caché: usuarios retenidos y términos por usuario
+INSULT_CACHE_USUARIOS = 2048
+INSULT_MEMORIA_N = 5
+
+class PoliticaRetencion(NamedTuple):
+    """Cuándo caduca una fila. Las caducadas se archivan en ARCHIVE_DIR/<tabla>/<AAAA-MM-DD>.jsonl.gz."""
+    columna: str          # Columna de fecha: decide la caducidad y la partición
+    dias: int             # Antigüedad a partir de la cual se archiva
+    epoch: bool = False   # True si la columna es REAL (epoch); False si es texto ISO
+    condicion: str = ""   # Filtro SQL adicional (puede usar :ahora_iso)
+
+RETENTION_POLICIES = {
+    "mod_logs": PoliticaRetencion("timestamp", 180),
+    "insult_events": PoliticaRetencion("ts", 365, epoch=True),
+    # Inactivos: sin escribir en ningún chat (last_seen) en 180 días; si vuelven, empiezan otra vez en el baseline
+    "user_reputation": PoliticaRetencion("last_seen", 180, epoch=True),
+    # Solo sin ban vigente
+    "user_warnings": PoliticaRetencion("updated_at", 90, condicion="banned_until IS NULL OR banned_until < :ahora_iso"),
+    "ai_usage": PoliticaRetencion("dia", 365),
+    # subscribers no caduca: es la lista de /start y no registra actividad
+}
+ARCHIVE_DIR = os.environ.get("MASHI_ARCHIVE_DIR") or os.path.join(SCRIPT_DIR, "archivo")
+# Horas locales "inicio-fin" (fin excluido, puede cruzar medianoche) para archivar y compactar
+QUIET_HOURS = tuple(int(h) for h in os.environ.get("MASHI_QUIET_HOURS", "3-6").split("-"))
+# last_seen de user_reputation se reescribe como mucho una vez por intervalo: basta para la retención en días
+VISTO_RESOLUCION_S = 86400
+# Páginas liberadas como máximo por pasada de incremental_vacuum
+VACUUM_PAGES_POR_PASADA = 2000
+
+# Reinicio en caliente: estado en memoria guardado al apagar y restaurado al arrancar si es reciente
+SNAPSHOT_PATH = os.environ.get("MASHI_SNAPSHOT") or os.path.join(SCRIPT_DIR, "mashi_estado.bin")
+SNAPSHOT_MAX_EDAD_S = float(os.environ.get("MASHI_SNAPSHOT_MAX_AGE", "600"))
+SNAPSHOT_MAGIC = b"MASHI\x01"
+
+# Clasificador local (opcional, NumPy): modelo .npz en disco o descargado una vez del repo de Hugging Face
+CLASSIFIER_PATH = os.environ.get("MASHI_CLASSIFIER") or os.path.join(SCRIPT_DIR, "modelos", "clasificador.npz")
+CLASSIFIER_REPO = os.environ.get("MASHI_CLASSIFIER_REPO", "")
+# Espera para juntar mensajes en un lote. 0 = solo los que llegan en la misma vuelta del loop
+# (con updates secuenciales, esperar más solo añadiría latencia)
+CLASSIFIER_WINDOW_MS = float(os.environ.get("MASHI_CLASSIFIER_WINDOW_MS", "0"))
+CLASIFICADOR_LOTE_MAX = 64
+CLASIFICADOR_BITS = 18              # 2^18 cubos de hashing para los n-gramas
+CLASIFICADOR_NGRAMAS = (2, 3, 4)
+# Sin palabra clave, el modelo marca si supera el umbral alto (0.5 = frontera con clases balanceadas);
+# con palabra clave, la veta si queda por debajo del bajo. Ajustables con benchmarks/eval_clasificador.py
+CLASIFICADOR_UMBRAL_ALTO = float(os.environ.get("MASHI_CLASSIFIER_HIGH", "0.5"))
+CLASIFICADOR_UMBRAL_BAJO = float(os.environ.get("MASHI_CLASSIFIER_LOW", "0.2"))
+# Término que se guarda cuando el modelo marca una paráfrasis: nunca el texto del mensaje
+ETIQUETA_PARAFRASIS = "(paráfrasis)"
+
+# Exportación / importación masiva: tabla -> clave del upsert. None = registro de auditoría (mod_logs, sin PK):
+# solo se añaden filas que no estén ya idénticas, nunca se sobrescribe nada
+TABLAS_EXPORTABLES = MappingProxyType({"user_reputation": "user_id", "user_warnings": "user_id", "mod_logs": None})
+FORMATOS_VOLCADO = ("csv", "jsonl")
+VOLCADO_LOTE = 5000          # Filas por fetchmany al exportar
+IMPORTACION_LOTE = 20000     # Filas por transacción al importar
+# Tope de sendDocument (50 MB) con margen: por encima, /exportar comprime con gzip
+DOCUMENTO_MAX_BYTES = 45 * 1024 * 1024
+
 RELATOS_DEL_GUARDIAN = [
     "Los ecos de la gloria pasada resuenan solo para aquellos que saben escuchar el silencio...",
     "Recuerdo imperios de arena y sol que se alzaron y cayeron bajo mi vigilia...",
@@ -157,16 +385,16 @@ def construir_saludo_hola_leon(user: Optional[User], reputacion: int) -> str:
     return f"{base}{matiz}"
 
 
-def construir_respuesta_fallback(es_kai: bool, es_hostil: bool, reputacion: int, insulto_detectado: str, es_nsfw: bool = False, nsfw_detectado: str = "", user: Optional[User] = None) -> str:
+def construir_respuesta_fallback(es_kai: bool, es_hostil: bool, reputacion: int, insulto_detectado: str, es_nsfw: bool = False, nsfw_detectado: str = "", user: Optional[User] = None, nsfw_min_rep: int = 40) -> str:
     if es_kai:
         return random.choice(FALLBACK_KAI)
     if es_hostil:
-        insulto = insulto_detectado or "este ruido"
+        insulto = insulto_detectado if insulto_detectado and insulto_detectado != ETIQUETA_PARAFRASIS else "este ruido"
         return random.choice(FALLBACK_DEFENSA_RETORTS).format(insulto=insulto)
     if es_nsfw:
         mortal = user.mention_html() if user else "mortal"
-        if reputacion >= 40:
-            return random.choice(FALLBACK_NSFW_PACTO).format(mortal=mortal, keyword=nsfw_detectado or "tu deseo")
+        if reputacion >= nsfw_min_rep:
+            return random.choice(FALLBACK_NSFW_PACTO).format(mortal=mortal, keyword=nsfw_detectado if nsfw_detectado and nsfw_detectado != ETIQUETA_PARAFRASIS else "tu deseo")
         return random.choice(FALLBACK_NSFW_REPRIMEN)
     if reputacion >= 70:
         return random.choice(FALLBACK_NEUTRO) + " Tu impecable reputación mantiene sereno el altar."
@@ -281,11 +509,362 @@ INSULTOS_PATTERNS = [
 ]
 
 
+###############################################################################
+# BLOQUE 2B: MÉTRICAS E INSTRUMENTACIÓN
+###############################################################################
+
+# Grabación opcional de updates (JSONL, sin datos personales) para replay offline
+RECORD_UPDATES_PATH = os.environ.get("MASHI_RECORD_UPDATES", "")
+# Sal de los seudónimos. Sin ella, los seudónimos solo son estables durante un proceso.
+RECORD_SALT = os.environ.get("MASHI_RECORD_SALT") or secrets.token_hex(16)
+
+# Cubos (segundos) de los histogramas de latencia, estilo Prometheus
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Puerto del endpoint /metrics (0 = desactivado). En modo workers, cada worker usa puerto + 1 + índice.
+METRICS_HOST = os.environ.get("MASHI_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("MASHI_METRICS_PORT", "9108"))
+# Vigilante del event loop: cada cuánto late y a partir de qué retraso se captura la pila culpable
+LOOP_LAG_INTERVAL = 0.05
+LOOP_LAG_UMBRAL_MS = float(os.environ.get("MASHI_LOOP_LAG_MS", "100"))
+# Perfilador por muestreo (/perfilar): periodo entre muestras y duración máxima
+PERFILADOR_PERIODO = 0.005
+PERFILADOR_MAX_S = 120
+
+# Transporte HTTP: pools separados para el long polling, las llamadas salientes a Telegram y la IA
+# 32 y no los 256 de PTB: el pool de httpcore recorre todas sus conexiones por cada petición
+# encolada, y con cientos de envíos en ráfaga ese coste supera a la propia red (bench_transporte.py)
+HTTP_POOL_SIZE = int(os.environ.get("MASHI_HTTP_POOL_SIZE", "32"))
+HTTP_POLL_POOL_SIZE = int(os.environ.get("MASHI_HTTP_POLL_POOL_SIZE", "1"))
+HTTP_LLM_POOL_SIZE = int(os.environ.get("MASHI_HTTP_LLM_POOL_SIZE", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("MASHI_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("MASHI_HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("MASHI_HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("MASHI_HTTP_POOL_TIMEOUT", "3"))
+HTTP_LLM_READ_TIMEOUT = float(os.environ.get("MASHI_HTTP_LLM_READ_TIMEOUT", "60"))
+# Segundos que una conexión ociosa sigue abierta para reutilizarla
+HTTP_KEEPALIVE_S = float(os.environ.get("MASHI_HTTP_KEEPALIVE", "120"))
+# HTTP/2 solo si se pide y está instalado (pip install "httpx[http2]")
+HTTP2 = os.environ.get("MASHI_HTTP2", "0") == "1" and importlib.util.find_spec("h2") is not None
+
+class Histograma:
+    """Histograma acumulativo + últimas muestras (para p50/p99 del resumen /perf)."""
+    __slots__ = ("cubos", "suma", "cuenta", "recientes")
+
+    def __init__(self):
+        self.cubos = [0] * len(METRIC_BUCKETS)
+        self.suma = 0.0
+        self.cuenta = 0
+        self.recientes = deque(maxlen=1024)
+
+    def observar(self, valor: float):
+        for i, limite in enumerate(METRIC_BUCKETS):
+            if valor <= limite:
+                self.cubos[i] += 1
+                break
+        self.suma += valor
+        self.cuenta += 1
+        self.recientes.append(valor)
+
+    def percentil(self, p: float) -> float:
+        if not self.recientes:
+            return 0.0
+        ordenadas = sorted(self.recientes)
+        return ordenadas[min(len(ordenadas) - 1, int(p / 100 * len(ordenadas)))]
+
+# (nombre, (("label", "valor"), ...)) -> Histograma / int
+METRICS_HIST = {}
+METRICS_COUNTERS = {}
+
+def observar(nombre: str, segundos: float, **labels):
+    clave = (nombre, tuple(sorted(labels.items())))
+    hist = METRICS_HIST.get(clave)
+    if hist is None:
+        hist = METRICS_HIST[clave] = Histograma()
+    hist.observar(segundos)
+
+def incrementar(nombre: str, valor: int = 1, **labels):
+    clave = (nombre, tuple(sorted(labels.items())))
+    METRICS_COUNTERS[clave] = METRICS_COUNTERS.get(clave, 0) + valor
+
+def medir_handler(func):
+    """Mide la latencia de un handler en mashi_handler_seconds{handler=...}."""
+    @wraps(func)
+    async def wrapped(update, context, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await func(update, context, *args, **kwargs)
+        finally:
+            observar("mashi_handler_seconds", time.perf_counter() - inicio, handler=func.__name__)
+    return wrapped
+
+@lru_cache(maxsize=512)
+def etiqueta_sql(query: str) -> str:
+    """Resume una sentencia a 'VERBO tabla' para agrupar tiempos sin explotar la cardinalidad."""
+    limpia = " ".join(query.split())
+    verbo = limpia.split(" ", 1)[0].upper() if limpia else "?"
+    tabla = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+(\w+)', limpia, re.IGNORECASE)
+    return f"{verbo} {tabla.group(1)}" if tabla else verbo
+
+def _escapar_label(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _formatear_labels(labels: tuple, extra: tuple = ()) -> str:
+    pares = labels + extra
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar_label(v)}"' for k, v in pares) + "}"
+
+def render_prometheus() -> str:
+    """Exposición en formato de texto de Prometheus (0.0.4)."""
+    lineas = []
+    tipos_emitidos = set()
+    for (nombre, labels), valor in sorted(METRICS_COUNTERS.items()):
+        if nombre not in tipos_emitidos:
+            lineas.append(f"# TYPE {nombre} counter")
+            tipos_emitidos.add(nombre)
+        lineas.append(f"{nombre}{_formatear_labels(labels)} {valor}")
+    for (nombre, labels), hist in sorted(METRICS_HIST.items(), key=lambda kv: kv[0]):
+        if nombre not in tipos_emitidos:
+            lineas.append(f"# TYPE {nombre} histogram")
+            tipos_emitidos.add(nombre)
+        acumulado = 0
+        for limite, cuenta in zip(METRIC_BUCKETS, hist.cubos):
+            acumulado += cuenta
+            lineas.append(f"{nombre}_bucket{_formatear_labels(labels, (('le', limite),))} {acumulado}")
+        lineas.append(f"{nombre}_bucket{_formatear_labels(labels, (('le', '+Inf'),))} {hist.cuenta}")
+        lineas.append(f"{nombre}_sum{_formatear_labels(labels)} {hist.suma:.6f}")
+        lineas.append(f"{nombre}_count{_formatear_labels(labels)} {hist.cuenta}")
+    return "\n".join(lineas) + "\n"
+
+async def _atender_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        peticion = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass  # Cabeceras ignoradas
+        partes = peticion.decode("latin-1").split()
+        if len(partes) >= 2 and partes[1].split("?")[0] == "/metrics":
+            cuerpo, estado = render_prometheus().encode(), "200 OK"
+        else:
+            cuerpo, estado = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {estado}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(cuerpo)}\r\nConnection: close\r\n\r\n".encode() + cuerpo
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Petición de métricas fallida: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int) -> Optional[asyncio.AbstractServer]:
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_atender_metrics, METRICS_HOST, port)
+    except OSError as e:
+        logger.warning(f"No pude abrir el endpoint de métricas en {METRICS_HOST}:{port}: {e}")
+        return None
+    logger.info(f"📈 Métricas en http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+class CuposHTTP:
+    """Semáforo del tamaño de un pool: mide cuánto espera cada petición por una conexión libre.
+
+    httpx no expone esa espera; con el semáforo delante el pool nunca bloquea y la espera queda en
+    mashi_http_pool_wait_seconds{pool}. Agotado el timeout, TimedOut (lo mismo que hace PTB).
+    """
+
+    def __init__(self, pool: str, tamano: int, timeout: Optional[float] = HTTP_POOL_TIMEOUT):
+        self.pool = pool
+        self.timeout = timeout
+        self._semaforo = asyncio.Semaphore(tamano)
+
+    async def __aenter__(self):
+        if not self._semaforo.locked():  # Camino común: hay conexión libre, acquire() no suspende
+            await self._semaforo.acquire()
+            observar("mashi_http_pool_wait_seconds", 0.0, pool=self.pool)
+            return
+        incrementar("mashi_http_pool_waits_total", pool=self.pool)
+        inicio = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaforo.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            incrementar("mashi_http_pool_timeouts_total", pool=self.pool)
+            raise TimedOut(f"Pool {self.pool} sin conexiones libres tras {self.timeout} s") from None
+        observar("mashi_http_pool_wait_seconds", time.perf_counter() - inicio, pool=self.pool)
+
+    async def __aexit__(self, *exc):
+        self._semaforo.release()
+
+def trazador_conexiones(pool: str):
+    """Hook de httpx: cuenta las conexiones TCP nuevas (las reutilizadas por keep-alive no pasan por aquí)."""
+    async def traza(evento: str, info: dict):
+        if evento == "connection.connect_tcp.complete":
+            incrementar("mashi_http_connections_total", pool=pool)
+
+    async def al_pedir(request: httpx.Request):
+        request.extensions["trace"] = traza
+    return al_pedir
+
+def limites_http(tamano: int) -> httpx.Limits:
+    return httpx.Limits(max_connections=tamano, max_keepalive_connections=tamano, keepalive_expiry=HTTP_KEEPALIVE_S)
+
+class RequestInstrumentado(HTTPXRequest):
+    """HTTPXRequest con pool propio y medido: latencia por método, espera del pool y conexiones nuevas."""
+
+    def __init__(self, pool: str = "telegram", connection_pool_size: int = HTTP_POOL_SIZE, **kwargs):
+        kwargs.setdefault("connect_timeout", HTTP_CONNECT_TIMEOUT)
+        kwargs.setdefault("read_timeout", HTTP_READ_TIMEOUT)
+        kwargs.setdefault("write_timeout", HTTP_WRITE_TIMEOUT)
+        kwargs.setdefault("pool_timeout", HTTP_POOL_TIMEOUT)
+        kwargs.setdefault("http_version", "2" if HTTP2 else "1.1")
+        kwargs.setdefault("httpx_kwargs", {
+            "limits": limites_http(connection_pool_size),
+            "event_hooks": {"request": [trazador_conexiones(pool)]},
+        })
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.pool = pool
+        self._cupos = CuposHTTP(pool, connection_pool_size, kwargs["pool_timeout"])
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        async with self._cupos:
+            inicio = time.perf_counter()
+            resultado = "error"
+            try:
+                respuesta = await super().do_request(url, method, *args, **kwargs)
+                resultado = str(respuesta[0])
+                return respuesta
+            finally:
+                observar("mashi_telegram_api_seconds", time.perf_counter() - inicio, method=endpoint)
+                incrementar("mashi_telegram_api_calls_total", method=endpoint, status=resultado)
+
+
+# ============== VIGILANTE DEL EVENT LOOP ==============
+
+def _marcos_culpables(frame) -> list:
+    """Marcos (función, línea) del código que corre dentro del loop, del más externo al más interno.
+
+    Prefiere los de este archivo; si el bloqueo es ajeno (p. ej. un benchmark), usa lo que
+    haya por encima del despacho de asyncio.
+    """
+    pila = traceback.extract_stack(frame)
+    propios = [(f.name, f.lineno) for f in pila if f.filename == __file__]
+    if propios:
+        return propios
+    despacho = max((i for i, f in enumerate(pila) if "asyncio" in f.filename), default=-1)
+    return [(f.name, f.lineno) for f in pila[despacho + 1:]]
+
+class VigilanteLoop:
+    """Mide el retraso de planificación del loop y, si se bloquea, captura quién lo bloquea.
+
+    Una tarea asyncio late cada LOOP_LAG_INTERVAL; un hilo auxiliar comprueba la
+    edad del último latido y, si supera el umbral, lee la pila del hilo del loop
+    con sys._current_frames() mientras el bloqueo sigue ocurriendo.
+    """
+
+    def __init__(self, umbral_ms: float = LOOP_LAG_UMBRAL_MS, intervalo: float = LOOP_LAG_INTERVAL):
+        self.umbral = umbral_ms / 1000
+        self.intervalo = intervalo
+        self.lag_max = 0.0
+        self.bloqueos = deque(maxlen=20)
+        self._latido = time.perf_counter()
+        self._reportado = None
+        self._hilo_loop = None
+        self._tarea = None
+        self._parar = threading.Event()
+
+    def iniciar(self) -> None:
+        self._hilo_loop = threading.get_ident()
+        self._latido = time.perf_counter()
+        self._tarea = asyncio.get_running_loop().create_task(self._latir())
+        threading.Thread(target=self._vigilar, name="mashi-vigilante", daemon=True).start()
+
+    def detener(self) -> None:
+        self._parar.set()
+        if self._tarea:
+            self._tarea.cancel()
+
+    async def _latir(self) -> None:
+        while True:
+            t0 = time.perf_counter()
+            self._latido = t0
+            await asyncio.sleep(self.intervalo)
+            lag = max(0.0, time.perf_counter() - t0 - self.intervalo)
+            self.lag_max = max(self.lag_max, lag)
+            observar("mashi_loop_lag_seconds", lag)
+
+    def _vigilar(self) -> None:
+        while not self._parar.wait(self.intervalo / 2):
+            latido = self._latido
+            retraso = time.perf_counter() - latido - self.intervalo
+            if retraso < self.umbral or latido == self._reportado:
+                continue
+            self._reportado = latido  # Un reporte por bloqueo
+            frame = sys._current_frames().get(self._hilo_loop)
+            marcos = _marcos_culpables(frame) if frame else []
+            handler = next((nombre for nombre, _ in marcos if nombre != "wrapped"), "?")  # Saltar decoradores
+            funcion, linea = marcos[-1] if marcos else ("?", 0)
+            self.bloqueos.append({
+                "cuando": datetime.now().strftime("%H:%M:%S"), "retraso_ms": retraso * 1000,
+                "handler": handler, "funcion": funcion, "linea": linea,
+            })
+            incrementar("mashi_loop_stalls_total", handler=handler)
+            pila = "".join(traceback.format_stack(frame)[-6:]) if frame else ""
+            logger.warning(f"🐢 Event loop bloqueado {retraso * 1000:.0f} ms en {handler} → {funcion}:{linea}\n{pila}")
+
+class PerfiladorMuestreo:
+    """Perfilador estadístico: muestrea la pila del hilo del loop cada PERFILADOR_PERIODO."""
+
+    def __init__(self, segundos: float):
+        self.segundos = segundos
+        self.muestras = 0
+        self.propias = {}    # (archivo, función, línea de def) -> muestras en la cima de la pila
+        self.inclusivas = {}  # ídem, muestras en cualquier punto de la pila
+        self._hilo_loop = threading.get_ident()
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, name="mashi-perfilador", daemon=True)
+
+    def iniciar(self) -> None:
+        self._hilo.start()
+
+    def detener(self) -> None:
+        self._parar.set()
+        self._hilo.join()
+
+    def _muestrear(self) -> None:
+        limite = time.perf_counter() + self.segundos
+        while not self._parar.wait(PERFILADOR_PERIODO) and time.perf_counter() < limite:
+            frame = sys._current_frames().get(self._hilo_loop)
+            if frame is None:
+                continue
+            self.muestras += 1
+            clave = (frame.f_code.co_filename, frame.f_code.co_name, frame.f_code.co_firstlineno)
+            self.propias[clave] = self.propias.get(clave, 0) + 1
+            vistas = set()
+            while frame is not None:
+                clave = (frame.f_code.co_filename, frame.f_code.co_name, frame.f_code.co_firstlineno)
+                if clave not in vistas:
+                    vistas.add(clave)
+                    self.inclusivas[clave] = self.inclusivas.get(clave, 0) + 1
+                frame = frame.f_back
+
+    def top(self, n: int = 10, inclusivo: bool = False) -> list:
+        """[(porcentaje, 'archivo:función:línea')] de las funciones más calientes."""
+        conteos = self.inclusivas if inclusivo else self.propias
+        filas = sorted(conteos.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [
+            (100 * cuenta / max(1, self.muestras), f"{os.path.basename(archivo)}:{funcion}:{linea}")
+            for (archivo, funcion, linea), cuenta in filas
+        ]
+
+
 ###############################################################################
 # BLOQUE 3: BASE DE DATOS
 ###############################################################################
 
 def db_safe_run(query, params=(), fetchone=False, commit=False):
+    inicio = time.perf_counter()
     conn = sqlite3.connect(DB_FILE, timeout=10)
     cursor = conn.cursor()
     try:
@@ -302,22 +881,37 @@ def db_safe_run(query, params=(), fetchone=False, commit=False):
         return None if "SELECT" in query.upper() else 0
     finally:
         conn.close()
+        observar("mashi_db_seconds", time.perf_counter() - inicio, statement=etiqueta_sql(query))
 
-def setup_database():
-    db_safe_run('CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY, username TEXT, joined_at TEXT)')
-    db_safe_run('CREATE TABLE IF NOT EXISTS mod_logs (action TEXT, target_id INTEGER, timestamp TEXT)')
+def db_safe_run_many(query, seq_params):
+    """Ejecuta la misma sentencia para muchos parámetros en una sola transacción."""
+    inicio = time.perf_counter()
+    conn = sqlite3.connect(DB_FILE, timeout=10)
+    try:
+        with conn:
+            cursor = conn.executemany(query, seq_params)
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Error en BD (lote): {e}")
+        return 0
+    finally:
+        conn.close()
+        observar("mashi_db_seconds", time.perf_counter() - inicio, statement=etiqueta_sql(query) + " (lote)")
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY, username TEXT, joined_at TEXT)',
+    'CREATE TABLE IF NOT EXISTS mod_logs (action TEXT, target_id INTEGER, timestamp TEXT, chat_id INTEGER, admin_id INTEGER, reason TEXT)',
     # Nueva tabla de reputación para el sistema de contraataque
-    db_safe_run('''CREATE TABLE IF NOT EXISTS user_reputation (
+    '''CREATE TABLE IF NOT EXISTS user_reputation (
         user_id INTEGER PRIMARY KEY,
         username TEXT,
         reputation INTEGER DEFAULT 50,
         total_insultos INTEGER DEFAULT 0,
         ultimo_insulto TEXT,
-        insultos_memoria TEXT DEFAULT "",
         updated_at TEXT
-    )''')
+    )''',
     # Nueva tabla de advertencias y bans temporales
-    db_safe_run('''CREATE TABLE IF NOT EXISTS user_warnings (
+    '''CREATE TABLE IF NOT EXISTS user_warnings (
         user_id INTEGER PRIMARY KEY,
         username TEXT,
         warnings_count INTEGER DEFAULT 0,
@@ -325,62 +919,237 @@ def setup_database():
         banned_until TEXT,
         ban_reason TEXT,
         updated_at TEXT
-    )''')
-    logger.info(f"Base de datos lista en: {DB_FILE}")
+    )''',
+    # Historial de insultos (uno por fila; reemplaza a user_reputation.insultos_memoria)
+    '''CREATE TABLE IF NOT EXISTS insult_events (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        chat_id INTEGER,
+        term TEXT,
+        ts REAL
+    )''',
+    # Índices cubrientes: rankings por chat y rango, globales por rango, y últimos insultos de un usuario
+    'CREATE INDEX IF NOT EXISTS idx_insult_events_chat_ts ON insult_events (chat_id, ts, term, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_insult_events_ts ON insult_events (ts, term, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_insult_events_user_ts ON insult_events (user_id, ts, term)',
+    # Lista negra de medios por file_unique_id (estable entre bots y reenvíos; no requiere descargar nada)
+    '''CREATE TABLE IF NOT EXISTS media_blocklist (
+        file_unique_id TEXT PRIMARY KEY,
+        tipo TEXT,
+        added_by INTEGER,
+        chat_id INTEGER,
+        reason TEXT,
+        created_at TEXT
+    )''',
+    # Verificaciones de edad sin responder (sobreviven a reinicios)
+    '''CREATE TABLE IF NOT EXISTS pending_verifications (
+        chat_id INTEGER,
+        user_id INTEGER,
+        message_id INTEGER,
+        deadline REAL,
+        created_at TEXT,
+        PRIMARY KEY (chat_id, user_id)
+    )''',
+    # Configuración por chat (clave/valor: nuevos ajustes no requieren migración)
+    '''CREATE TABLE IF NOT EXISTS chat_config (
+        chat_id INTEGER,
+        key TEXT,
+        value TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (chat_id, key)
+    )''',
+    # Consumo de IA por chat y día (tokens estimados), para /consumo
+    '''CREATE TABLE IF NOT EXISTS ai_usage (
+        chat_id INTEGER,
+        dia TEXT,
+        llamadas INTEGER DEFAULT 0,
+        tokens INTEGER DEFAULT 0,
+        rechazadas INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_id, dia)
+    )''',
+)
+
+# Columnas añadidas a tablas existentes: (tabla, columna, tipo)
+SCHEMA_MIGRATIONS = (
+    ("mod_logs", "chat_id", "INTEGER"),
+    ("mod_logs", "admin_id", "INTEGER"),
+    ("mod_logs", "reason", "TEXT"),
+    ("user_reputation", "rep_ts", "REAL"),
+    ("user_reputation", "last_seen", "REAL"),
+)
+
+# Rellenos idempotentes tras migrar (solo tocan filas aún sin valor)
+SCHEMA_BACKFILLS = (
+    # Epoch del último cambio real de reputación, a partir del updated_at local existente
+    "UPDATE user_reputation SET rep_ts = CAST(strftime('%s', updated_at, 'utc') AS REAL) WHERE rep_ts IS NULL AND updated_at IS NOT NULL",
+    # Último mensaje visto: a falta de dato, el último evento de reputación
+    "UPDATE user_reputation SET last_seen = rep_ts WHERE last_seen IS NULL",
+)
+
+def _migrar_insultos_memoria(conn) -> None:
+    """Pasa las cadenas 'a|b|c' de insultos_memoria a filas de insult_events (una sola vez por fila).
+
+    La columna solo existe en BD creadas antes de insult_events; en las nuevas no hay nada que migrar.
+    """
+    if not conn.execute("SELECT 1 FROM pragma_table_info('user_reputation') WHERE name = 'insultos_memoria'").fetchone():
+        return
+    rows = conn.execute(
+        "SELECT user_id, insultos_memoria, COALESCE(rep_ts, 0) FROM user_reputation WHERE insultos_memoria != ''"
+    ).fetchall()
+    eventos = []
+    for user_id, memoria, ts in rows:
+        terminos = [t for t in memoria.split("|") if t]
+        # Sin fecha ni chat de origen: se conserva el orden escalonando la marca de tiempo
+        eventos.extend((user_id, None, termino, ts - (len(terminos) - i)) for i, termino in enumerate(terminos))
+    if eventos:
+        conn.executemany("INSERT INTO insult_events (user_id, chat_id, term, ts) VALUES (?, ?, ?, ?)", eventos)
+        conn.execute("UPDATE user_reputation SET insultos_memoria = '' WHERE insultos_memoria != ''")
+        logger.info(f"📦 {len(eventos)} insultos migrados a insult_events.")
+
+def setup_database():
+    """Crea/migra el esquema con una sola conexión y una sola transacción."""
+    inicio = time.perf_counter()
+    conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level=None)
+    try:
+        # Solo surte efecto en BD nuevas; las existentes se convierten en la primera compactación
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL: lectores y escritores de varios procesos no se bloquean entre sí (fuera de la transacción)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('BEGIN')
+        for sentencia in SCHEMA:
+            conn.execute(sentencia)
+        columnas = {}
+        for tabla, columna, tipo in SCHEMA_MIGRATIONS:
+            if tabla not in columnas:
+                columnas[tabla] = {row[1] for row in conn.execute(f"SELECT * FROM pragma_table_info('{tabla}')")}
+            if columna not in columnas[tabla]:
+                conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+        for sentencia in SCHEMA_BACKFILLS:
+            conn.execute(sentencia)
+        _migrar_insultos_memoria(conn)
+        if not conn.execute("SELECT 1 FROM chat_config LIMIT 1").fetchone():
+            now = datetime.now().isoformat()
+            conn.executemany(
+                "INSERT OR IGNORE INTO chat_config (chat_id, key, value, updated_at) VALUES (?, 'enabled', '1', ?)",
+                [(chat_id, now) for chat_id in ALLOWED_CHATS]
+            )
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    logger.info(f"Base de datos lista en: {DB_FILE} ({(time.perf_counter() - inicio) * 1000:.1f} ms)")
+
+# ============== LISTA NEGRA DE MEDIOS ==============
+
+def media_blocklist_signature():
+    return db_safe_run("SELECT COUNT(*), MAX(created_at) FROM media_blocklist", fetchone=True)
+
+def reload_media_blocklist() -> int:
+    """Carga la lista negra en un frozenset (pertenencia O(1)) de una sola asignación. Retorna su tamaño."""
+    global MEDIA_BLOCKLIST, _MEDIA_BLOCKLIST_SIGNATURE
+    _MEDIA_BLOCKLIST_SIGNATURE = media_blocklist_signature()
+    MEDIA_BLOCKLIST = frozenset(row[0] for row in db_safe_run("SELECT file_unique_id FROM media_blocklist") or [])
+    return len(MEDIA_BLOCKLIST)
+
+def add_blocked_media(file_unique_id: str, tipo: str, admin_id: int, chat_id: int, reason: str = None) -> None:
+    db_safe_run(
+        "INSERT OR REPLACE INTO media_blocklist (file_unique_id, tipo, added_by, chat_id, reason, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (file_unique_id, tipo, admin_id, chat_id, reason, datetime.now().isoformat()), commit=True
+    )
+    reload_media_blocklist()
+
+def remove_blocked_media(file_unique_id: str) -> bool:
+    borradas = db_safe_run("DELETE FROM media_blocklist WHERE file_unique_id = ?", (file_unique_id,), commit=True)
+    reload_media_blocklist()
+    return bool(borradas)
 
 # ============== FUNCIONES DE REPUTACIÓN ==============
 
-def get_user_reputation(user_id: int) -> dict:
-    """Obtiene la reputación de un usuario. Si no existe, lo crea con rep=50."""
+def reputacion_efectiva(guardada: int, rep_ts: Optional[float], cfg: ChatConfig = DEFAULT_CHAT_CONFIG, ahora: float = None) -> int:
+    """Reputación al momento de leerla: el valor guardado se acerca al techo con el tiempo limpio.
+
+    Decaimiento exponencial con vida media cfg.rep_half_life_h hacia max(rep_baseline, rep_ceiling):
+    recupera a quien fue penalizado y hace subir a quien no ofende desde su último evento (o su
+    primer mensaje). Nunca escribe: se calcula en cada lectura.
+    """
+    if rep_ts is None or cfg.rep_half_life_h <= 0:
+        return guardada
+    objetivo = max(cfg.rep_baseline, cfg.rep_ceiling)
+    horas = max(0.0, ((ahora or time.time()) - rep_ts) / 3600)
+    valor = objetivo + (guardada - objetivo) * 0.5 ** (horas / cfg.rep_half_life_h)
+    return max(0, min(100, round(valor)))  # Clamp 0-100
+
+def get_user_reputation(user_id: int, cfg: ChatConfig = DEFAULT_CHAT_CONFIG) -> dict:
+    """Obtiene la reputación (ya con decaimiento) de un usuario, o None si no tiene registro."""
     result = db_safe_run(
-        "SELECT user_id, username, reputation, total_insultos, ultimo_insulto, insultos_memoria FROM user_reputation WHERE user_id = ?",
+        "SELECT user_id, username, reputation, total_insultos, ultimo_insulto, rep_ts, last_seen FROM user_reputation WHERE user_id = ?",
         (user_id,), fetchone=True
     )
     if result:
         return {
             "user_id": result[0],
             "username": result[1],
-            "reputation": result[2],
+            "reputation": reputacion_efectiva(result[2], result[5], cfg),
+            "reputation_guardada": result[2],
             "total_insultos": result[3],
             "ultimo_insulto": result[4],
-            "insultos_memoria": result[5] or ""
+            "last_seen": result[6]
         }
     return None
 
-def update_user_reputation(user_id: int, username: str, delta: int, insulto: str = None):
-    """Actualiza la reputación de un usuario. Delta puede ser positivo o negativo."""
-    existing = get_user_reputation(user_id)
+def marcar_visto(user_id: int, last_seen: Optional[float], ahora: float = None) -> None:
+    """Renueva last_seen (lo que mira la retención) si tiene más de VISTO_RESOLUCION_S: una escritura al día por usuario activo."""
+    ahora = ahora or time.time()
+    if last_seen is not None and ahora - last_seen < VISTO_RESOLUCION_S:
+        return
+    db_safe_run("UPDATE user_reputation SET last_seen = ? WHERE user_id = ?", (ahora, user_id), commit=True)
+
+def registrar_usuario_nuevo(user_id: int, username: str, cfg: ChatConfig = DEFAULT_CHAT_CONFIG) -> None:
+    """Primer mensaje de un mortal sin registro: guarda el baseline y arranca su reloj de tiempo limpio.
+
+    Una sola escritura por usuario en toda su vida; desde ahí sube solo (reputacion_efectiva).
+    """
+    ahora = time.time()
+    db_safe_run(
+        """INSERT OR IGNORE INTO user_reputation
+           (user_id, username, reputation, rep_ts, last_seen, total_insultos, updated_at)
+           VALUES (?, ?, ?, ?, ?, 0, ?)""",
+        (user_id, username, cfg.rep_baseline, ahora, ahora, datetime.now().isoformat()), commit=True
+    )
+    PERFILES_REENVIO.pop(("usuario", user_id), None)
+
+def update_user_reputation(user_id: int, username: str, delta: int, insulto: str = None,
+                           cfg: ChatConfig = DEFAULT_CHAT_CONFIG, chat_id: int = None):
+    """Aplica un evento real de reputación sobre el valor efectivo y lo guarda con su marca de tiempo."""
+    existing = get_user_reputation(user_id, cfg)
     now = datetime.now().isoformat()
+    ahora = time.time()
     
     if existing:
         new_rep = max(0, min(100, existing["reputation"] + delta))  # Clamp 0-100
         new_total = existing["total_insultos"] + (1 if insulto else 0)
-        
-        # Guardar insultos en memoria (últimos 5)
-        memoria = existing["insultos_memoria"]
-        if insulto:
-            insultos_list = [i for i in memoria.split("|") if i][-4:]  # Últimos 4
-            insultos_list.append(insulto)
-            memoria = "|".join(insultos_list)
-        
         db_safe_run(
             """UPDATE user_reputation
-               SET reputation = ?, total_insultos = ?, ultimo_insulto = ?,
-                   insultos_memoria = ?, updated_at = ?, username = ?
+               SET reputation = ?, rep_ts = ?, last_seen = ?, total_insultos = ?, ultimo_insulto = ?,
+                   updated_at = ?, username = ?
                WHERE user_id = ?""",
-            (new_rep, new_total, insulto or existing["ultimo_insulto"], memoria, now, username, user_id),
+            (new_rep, ahora, ahora, new_total, insulto or existing["ultimo_insulto"], now, username, user_id),
             commit=True
         )
     else:
-        new_rep = max(0, min(100, 50 + delta))
-        memoria = insulto if insulto else ""
+        new_rep = max(0, min(100, cfg.rep_baseline + delta))
         db_safe_run(
             """INSERT INTO user_reputation
-               (user_id, username, reputation, total_insultos, ultimo_insulto, insultos_memoria, updated_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, username, new_rep, 1 if insulto else 0, insulto, memoria, now),
+               (user_id, username, reputation, rep_ts, last_seen, total_insultos, ultimo_insulto, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, username, new_rep, ahora, ahora, 1 if insulto else 0, insulto, now),
             commit=True
         )
+    if insulto:
+        registrar_insulto(user_id, chat_id, insulto)
+    PERFILES_REENVIO.pop(("usuario", user_id), None)  # Su perfil de origen de reenvíos quedó viejo
     
     logger.info(f"Reputación de {username} ({user_id}): {delta:+d} -> {new_rep}")
     return new_rep
@@ -408,11 +1177,88 @@ def detectar_elogio(texto: str) -> bool:
     texto_lower = texto.lower()
     return any(re.search(pattern, texto_lower, re.IGNORECASE) for pattern in ELOGIO_PATTERNS)
 
-def get_all_reputations() -> list:
-    """Obtiene todas las reputaciones para el comando /reputacion."""
+def get_all_reputations(cfg: ChatConfig = DEFAULT_CHAT_CONFIG) -> list:
+    """Reputaciones (efectivas) de quienes tienen historial de insultos para /reputacion, de peor a mejor."""
+    rows = db_safe_run(
+        """SELECT user_id, username, reputation, total_insultos, ultimo_insulto, rep_ts
+           FROM user_reputation WHERE total_insultos > 0"""
+    ) or []
+    ahora = time.time()
+    filas = [(uid, nombre, reputacion_efectiva(rep, ts, cfg, ahora), total, ultimo)
+             for uid, nombre, rep, total, ultimo, ts in rows]
+    return sorted(filas, key=lambda fila: fila[2])
+
+# ============== HISTORIAL DE INSULTOS ==============
+
+def registrar_insulto(user_id: int, chat_id: Optional[int], termino: str) -> None:
+    """Guarda el insulto como evento y lo añade a la memoria en caché si el usuario ya está cargado."""
+    db_safe_run(
+        "INSERT INTO insult_events (user_id, chat_id, term, ts) VALUES (?, ?, ?, ?)",
+        (user_id, chat_id, termino, time.time()), commit=True
+    )
+    memoria = INSULTOS_RECIENTES.get(user_id)
+    if memoria is not None:
+        memoria.append(termino)
+        INSULTOS_RECIENTES.move_to_end(user_id)
+
+def insultos_recientes(user_id: int, n: int = INSULT_MEMORIA_N) -> list:
+    """Últimos insultos del usuario (más antiguo primero). LRU acotada; un fallo cuesta una lectura indexada.
+
+    En modo workers cada proceso tiene su propia caché: puede no ver insultos hechos en chats de otro worker.
+    """
+    memoria = INSULTOS_RECIENTES.get(user_id)
+    if memoria is None:
+        rows = db_safe_run(
+            "SELECT term FROM insult_events WHERE user_id = ? ORDER BY ts DESC LIMIT ?",
+            (user_id, INSULT_MEMORIA_N)
+        ) or []
+        memoria = deque((row[0] for row in reversed(rows)), maxlen=INSULT_MEMORIA_N)
+        INSULTOS_RECIENTES[user_id] = memoria
+        if len(INSULTOS_RECIENTES) > INSULT_CACHE_USUARIOS:
+            INSULTOS_RECIENTES.popitem(last=False)
+    else:
+        INSULTOS_RECIENTES.move_to_end(user_id)
+    return list(memoria)[-n:]
+
+def insultos_recientes_de(user_ids: list, n: int = INSULT_MEMORIA_N) -> dict:
+    """{user_id: últimos n insultos (más antiguo primero)} en una sola consulta con ventana.
+
+    Para listados (/reputacion): no pasa por la LRU de insultos_recientes ni la ensucia.
+    """
+    if not user_ids:
+        return {}
+    marcas = ",".join("?" * len(user_ids))
+    rows = db_safe_run(
+        f"""SELECT user_id, term FROM (
+                SELECT user_id, term, ts, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS fila
+                FROM insult_events WHERE user_id IN ({marcas})
+            ) WHERE fila <= ? ORDER BY user_id, ts""",
+        (*user_ids, n)
+    ) or []
+    memorias = {}
+    for user_id, termino in rows:
+        memorias.setdefault(user_id, []).append(termino)
+    return memorias
+
+def top_insultos(chat_id: Optional[int], desde: float, limite: int = 10) -> list:
+    """[(término, veces)] en un chat (None = todos) desde un epoch. Resuelto sobre índice cubriente."""
+    if chat_id is None:
+        query = "SELECT term, COUNT(*) FROM insult_events WHERE ts >= ? GROUP BY term ORDER BY 2 DESC LIMIT ?"
+        params = (desde, limite)
+    else:
+        query = "SELECT term, COUNT(*) FROM insult_events WHERE chat_id = ? AND ts >= ? GROUP BY term ORDER BY 2 DESC LIMIT ?"
+        params = (chat_id, desde, limite)
+    return db_safe_run(query, params) or []
+
+def top_ofensores(chat_id: Optional[int], desde: float, limite: int = 10) -> list:
+    """[(user_id, username, insultos)] en un chat (None = todos) desde un epoch."""
+    filtro = "e.ts >= ?" if chat_id is None else "e.chat_id = ? AND e.ts >= ?"
+    params = (desde,) if chat_id is None else (chat_id, desde)
     return db_safe_run(
-        """SELECT user_id, username, reputation, total_insultos, ultimo_insulto, insultos_memoria
-           FROM user_reputation ORDER BY reputation ASC"""
+        f"""SELECT e.user_id, r.username, COUNT(*) AS n
+            FROM insult_events e LEFT JOIN user_reputation r ON r.user_id = e.user_id
+            WHERE {filtro} GROUP BY e.user_id ORDER BY n DESC LIMIT ?""",
+        params + (limite,)
     ) or []
 
 # ============== FUNCIONES DE ADVERTENCIAS ==============
@@ -434,16 +1280,16 @@ def get_user_warnings(user_id: int) -> dict:
         }
     return None
 
-def add_warning(user_id: int, username: str, reason: str = ""):
-    """Agrega una advertencia a un usuario. Si llega a 3, banea temporalmente."""
+def add_warning(user_id: int, username: str, reason: str = "", max_warnings: int = 3, ban_hours: int = 3):
+    """Agrega una advertencia a un usuario. Si llega a max_warnings, banea temporalmente."""
     existing = get_user_warnings(user_id)
     now = datetime.now().isoformat()
 
     if existing:
         new_count = existing["warnings_count"] + 1
-        if new_count >= 3:
-            # Ban temporal 3 horas
-            ban_until = (datetime.now() + timedelta(hours=3)).isoformat()
+        if new_count >= max_warnings:
+            # Ban temporal
+            ban_until = (datetime.now() + timedelta(hours=ban_hours)).isoformat()
             db_safe_run(
                 """UPDATE user_warnings
                    SET warnings_count = ?, last_warning = ?, banned_until = ?, ban_reason = ?, updated_at = ?, username = ?
@@ -461,14 +1307,18 @@ def add_warning(user_id: int, username: str, reason: str = ""):
                 commit=True
             )
     else:
+        new_count = 1
+        baneado = new_count >= max_warnings
         db_safe_run(
             """INSERT INTO user_warnings
-               (user_id, username, warnings_count, last_warning, updated_at)
-               VALUES (?, ?, 1, ?, ?)""",
-            (user_id, username, now, now),
+               (user_id, username, warnings_count, last_warning, banned_until, ban_reason, updated_at)
+               VALUES (?, ?, 1, ?, ?, ?, ?)""",
+            (user_id, username, now,
+             (datetime.now() + timedelta(hours=ban_hours)).isoformat() if baneado else None,
+             reason if baneado else None, now),
             commit=True
         )
-        new_count = 1
+        return new_count, baneado
 
     return new_count, False
 
@@ -523,6 +1373,474 @@ def estimar_fecha_creacion(user_id: int) -> str:
 
     return "Desconocido"
 
+# ============== FUNCIONES DE VERIFICACIÓN PENDIENTE ==============
+
+def add_pending_verification(chat_id: int, user_id: int, message_id: int, timeout_min: float = None) -> float:
+    """Registra un aviso de edad sin responder. Retorna el deadline (epoch)."""
+    timeout_min = AGE_VERIFICATION_TIMEOUT_MIN if timeout_min is None else timeout_min
+    deadline = time.time() + timeout_min * 60
+    PENDING_VERIFICATIONS[(chat_id, user_id)] = {"message_id": message_id, "deadline": deadline}
+    heapq.heappush(VERIFICATION_HEAP, (deadline, chat_id, user_id))
+    db_safe_run(
+        """INSERT OR REPLACE INTO pending_verifications (chat_id, user_id, message_id, deadline, created_at)
+           VALUES (?, ?, ?, ?, ?)""",
+        (chat_id, user_id, message_id, deadline, datetime.now().isoformat()), commit=True
+    )
+    return deadline
+
+def resolve_pending_verification(chat_id: int, user_id: int) -> Optional[dict]:
+    """Quita una verificación respondida. Su entrada en el heap queda obsoleta y se ignora."""
+    entry = PENDING_VERIFICATIONS.pop((chat_id, user_id), None)
+    if entry:
+        db_safe_run("DELETE FROM pending_verifications WHERE chat_id = ? AND user_id = ?", (chat_id, user_id), commit=True)
+    return entry
+
+def pop_expired_verifications(now: float = None) -> dict:
+    """Saca del heap todo lo vencido. Retorna {chat_id: [(user_id, message_id), ...]}."""
+    now = time.time() if now is None else now
+    expired = {}
+    while VERIFICATION_HEAP and VERIFICATION_HEAP[0][0] <= now:
+        deadline, chat_id, user_id = heapq.heappop(VERIFICATION_HEAP)
+        entry = PENDING_VERIFICATIONS.get((chat_id, user_id))
+        # Obsoleta: ya respondió o se registró de nuevo con otro deadline
+        if not entry or entry["deadline"] != deadline:
+            continue
+        del PENDING_VERIFICATIONS[(chat_id, user_id)]
+        expired.setdefault(chat_id, []).append((user_id, entry["message_id"]))
+    if expired:
+        db_safe_run_many(
+            "DELETE FROM pending_verifications WHERE chat_id = ? AND user_id = ?",
+            [(chat_id, user_id) for chat_id, items in expired.items() for user_id, _ in items]
+        )
+    return expired
+
+def next_verification_deadline() -> Optional[float]:
+    """Deadline vigente más próximo (descarta la cima obsoleta del heap)."""
+    while VERIFICATION_HEAP:
+        deadline, chat_id, user_id = VERIFICATION_HEAP[0]
+        entry = PENDING_VERIFICATIONS.get((chat_id, user_id))
+        if entry and entry["deadline"] == deadline:
+            return deadline
+        heapq.heappop(VERIFICATION_HEAP)
+    return None
+
+def load_pending_verifications() -> int:
+    """Reconstruye el registro y el heap desde la BD al arrancar."""
+    PENDING_VERIFICATIONS.clear()
+    VERIFICATION_HEAP.clear()
+    rows = db_safe_run("SELECT chat_id, user_id, message_id, deadline FROM pending_verifications") or []
+    if WORKER_SHARD:
+        indice, workers = WORKER_SHARD
+        rows = [row for row in rows if shard_for_chat(row[0], workers) == indice]
+    for chat_id, user_id, message_id, deadline in rows:
+        PENDING_VERIFICATIONS[(chat_id, user_id)] = {"message_id": message_id, "deadline": deadline}
+        VERIFICATION_HEAP.append((deadline, chat_id, user_id))
+    heapq.heapify(VERIFICATION_HEAP)
+    return len(rows)
+
+# ============== CONFIGURACIÓN POR CHAT ==============
+
+def _parse_config_value(key: str, raw: str):
+    """Convierte el texto guardado al tipo del valor por defecto del ajuste. ValueError si no es válido."""
+    default = getattr(DEFAULT_CHAT_CONFIG, key)
+    if isinstance(default, bool):
+        texto = str(raw).strip().lower()
+        if texto not in VERDADEROS_CONFIG | FALSOS_CONFIG:
+            raise ValueError(f"{key} espera 1/0, on/off, sí/no: '{raw}'")
+        return texto in VERDADEROS_CONFIG
+    valor = type(default)(raw)
+    minimo, maximo = RANGOS_CONFIG.get(key, (0, math.inf))
+    if valor == 0 and key in CONFIG_CERO_DESACTIVA:
+        return valor
+    if not math.isfinite(valor) or not minimo <= valor <= maximo:
+        desactivar = " (o 0 para desactivar)" if key in CONFIG_CERO_DESACTIVA else ""
+        raise ValueError(f"{key} fuera de rango [{minimo}, {maximo}]{desactivar}: '{raw}'")
+    return valor
+
+def chat_config_signature():
+    """Huella barata de chat_config para detectar cambios hechos por otro proceso."""
+    return db_safe_run("SELECT COUNT(*), MAX(updated_at) FROM chat_config", fetchone=True)
+
+def reload_chat_config() -> int:
+    """Lee chat_config y publica un snapshot nuevo de una sola asignación. Retorna nº de chats."""
+    global CHAT_CONFIG, _CHAT_CONFIG_SIGNATURE
+    _CHAT_CONFIG_SIGNATURE = chat_config_signature()
+    ajustes = {}
+    for chat_id, key, value in db_safe_run("SELECT chat_id, key, value FROM chat_config") or []:
+        if key not in ChatConfig._fields:
+            logger.warning(f"Ajuste desconocido '{key}' en chat {chat_id}, ignorado.")
+            continue
+        try:
+            ajustes.setdefault(chat_id, {})[key] = _parse_config_value(key, value)
+        except ValueError:
+            logger.warning(f"Valor inválido '{value}' para '{key}' en chat {chat_id}, ignorado.")
+    CHAT_CONFIG = MappingProxyType({
+        chat_id: DEFAULT_CHAT_CONFIG._replace(**valores) for chat_id, valores in ajustes.items()
+    })
+    return len(CHAT_CONFIG)
+
+def get_chat_config(chat_id: int) -> Optional[ChatConfig]:
+    """Configuración de un chat habilitado, o None si el templo no lo admite."""
+    config = CHAT_CONFIG.get(chat_id)
+    return config if config and config.enabled else None
+
+def set_chat_setting(chat_id: int, key: str, value) -> ChatConfig:
+    """Persiste un ajuste y recarga el snapshot. Lanza ValueError si la clave o el valor no son válidos."""
+    if key not in ChatConfig._fields:
+        raise ValueError(f"Ajuste desconocido: {key}")
+    parsed = _parse_config_value(key, value)
+    stored = "1" if parsed is True else "0" if parsed is False else str(parsed)
+    db_safe_run(
+        "INSERT OR REPLACE INTO chat_config (chat_id, key, value, updated_at) VALUES (?, ?, ?, ?)",
+        (chat_id, key, stored, datetime.now().isoformat()), commit=True
+    )
+    reload_chat_config()
+    return CHAT_CONFIG.get(chat_id, DEFAULT_CHAT_CONFIG)
+
+# ============== AUDITORÍA DE MODERACIÓN (ESCRITURA EN LOTE) ==============
+
+def log_mod_action(action: str, target_id: int, chat_id: int = None, admin_id: int = None, reason: str = None):
+    """Encola una fila de mod_logs. Solo toca la BD cuando el buffer se llena."""
+    AUDIT_BUFFER.append((action, target_id, datetime.now().isoformat(), chat_id, admin_id, reason))
+    if len(AUDIT_BUFFER) >= AUDIT_FLUSH_SIZE:
+        flush_mod_logs()
+
+def flush_mod_logs() -> int:
+    """Vuelca el buffer de auditoría en una sola transacción. Retorna filas escritas."""
+    if not AUDIT_BUFFER:
+        return 0
+    filas = AUDIT_BUFFER[:]
+    AUDIT_BUFFER.clear()
+    escritas = db_safe_run_many(
+        "INSERT INTO mod_logs (action, target_id, timestamp, chat_id, admin_id, reason) VALUES (?, ?, ?, ?, ?, ?)",
+        filas
+    )
+    if not escritas:
+        # La BD falló: devolver las filas al buffer (acotado) para el próximo intento
+        AUDIT_BUFFER[:0] = filas
+        del AUDIT_BUFFER[:-AUDIT_FLUSH_SIZE * 20]
+    return escritas
+
+def flush_uso_ia() -> int:
+    """Suma al día de cada chat el consumo de IA acumulado en memoria. Retorna filas tocadas."""
+    if not USO_IA:
+        return 0
+    filas = [(chat_id, dia, llamadas, tokens, rechazadas) for (chat_id, dia), (llamadas, tokens, rechazadas) in USO_IA.items()]
+    USO_IA.clear()
+    escritas = db_safe_run_many(
+        """INSERT INTO ai_usage (chat_id, dia, llamadas, tokens, rechazadas) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(chat_id, dia) DO UPDATE SET llamadas = llamadas + excluded.llamadas,
+               tokens = tokens + excluded.tokens, rechazadas = rechazadas + excluded.rechazadas""",
+        filas
+    )
+    if not escritas:
+        # La BD falló: devolver los contadores a memoria para el próximo intento
+        for chat_id, dia, llamadas, tokens, rechazadas in filas:
+            fila = USO_IA.setdefault((chat_id, dia), [0, 0, 0])
+            fila[0] += llamadas
+            fila[1] += tokens
+            fila[2] += rechazadas
+    return escritas
+
+def uso_ia_por_chat(desde: str) -> list:
+    """[(chat_id, llamadas, tokens, rechazadas)] desde el día dado (AAAA-MM-DD), de más a menos tokens."""
+    return db_safe_run(
+        """SELECT chat_id, SUM(llamadas), SUM(tokens), SUM(rechazadas) FROM ai_usage
+           WHERE dia >= ? GROUP BY chat_id ORDER BY SUM(tokens) DESC""",
+        (desde,)
+    ) or []
+
+# ============== RETENCIÓN, ARCHIVO Y COMPACTACIÓN ==============
+
+def _particion(valor, epoch: bool) -> str:
+    if valor is None:
+        return "sin-fecha"
+    return datetime.fromtimestamp(valor).strftime("%Y-%m-%d") if epoch else str(valor)[:10]
+
+def archivar_tabla(tabla: str, politica: PoliticaRetencion, ahora: datetime = None) -> int:
+    """Mueve las filas caducadas a archivos gzip por fecha, en streaming. Retorna filas archivadas.
+
+    Todo ocurre bajo BEGIN IMMEDIATE: lo escrito en el archivo es exactamente lo que se borra. Si algo
+    falla, los archivos se truncan a su tamaño previo y la transacción se deshace.
+    """
+    ahora = ahora or datetime.now()
+    corte = ahora - timedelta(days=politica.dias)
+    params = {"corte": corte.timestamp() if politica.epoch else corte.isoformat(), "ahora_iso": ahora.isoformat()}
+    filtro = f"{politica.columna} < :corte" + (f" AND ({politica.condicion})" if politica.condicion else "")
+    archivos = {}  # partición -> (archivo crudo, gzip, tamaño previo)
+    total = 0
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(f"SELECT * FROM {tabla} WHERE {filtro}", params)
+        columnas = [d[0] for d in cursor.description]
+        indice = columnas.index(politica.columna)
+        for lote in iter(lambda: cursor.fetchmany(500), []):
+            for fila in lote:
+                particion = _particion(fila[indice], politica.epoch)
+                if particion not in archivos:
+                    os.makedirs(os.path.join(ARCHIVE_DIR, tabla), exist_ok=True)
+                    crudo = open(os.path.join(ARCHIVE_DIR, tabla, f"{particion}.jsonl.gz"), "ab")
+                    # Cada pasada añade un miembro gzip nuevo; gzip lee los miembros concatenados como uno
+                    archivos[particion] = (crudo, gzip.GzipFile(fileobj=crudo, mode="wb"), crudo.tell())
+                archivos[particion][1].write((json.dumps(dict(zip(columnas, fila)), ensure_ascii=False) + "\n").encode())
+                total += 1
+        for crudo, comprimido, _ in archivos.values():
+            comprimido.close()
+            crudo.flush()
+            os.fsync(crudo.fileno())
+        if total:
+            conn.execute(f"DELETE FROM {tabla} WHERE {filtro}", params)
+        conn.execute("COMMIT")
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Error archivando {tabla}: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        for crudo, _, previo in archivos.values():
+            crudo.truncate(previo)
+        total = 0
+    finally:
+        for crudo, _, _ in archivos.values():
+            crudo.close()
+        conn.close()
+    if total:
+        incrementar("mashi_archived_rows_total", total, tabla=tabla)
+        logger.info(f"🗄️ {total} filas de {tabla} archivadas en {len(archivos)} particiones.")
+    return total
+
+def archivar_expirados() -> dict:
+    """Aplica todas las políticas de retención. Retorna {tabla: filas archivadas}."""
+    return {tabla: archivar_tabla(tabla, politica) for tabla, politica in RETENTION_POLICIES.items()}
+
+def compactar_bd(paginas: int = VACUUM_PAGES_POR_PASADA) -> int:
+    """Devuelve al sistema hasta `paginas` páginas libres y trunca el WAL. Retorna páginas liberadas."""
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    try:
+        libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # BD creada sin auto_vacuum incremental: un VACUUM completo (una sola vez) lo activa
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # executescript avanza la sentencia hasta el final; execute() liberaría una sola página
+            conn.executescript(f"PRAGMA incremental_vacuum({int(paginas)});")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return libres - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Error compactando la BD: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def en_horas_tranquilas(hora: int) -> bool:
+    inicio, fin = QUIET_HOURS
+    return inicio <= hora < fin if inicio <= fin else hora >= inicio or hora < fin
+
+def listar_particiones() -> dict:
+    """{tabla: [fechas archivadas disponibles]} (las ya restauradas no cuentan)."""
+    particiones = {}
+    for tabla in RETENTION_POLICIES:
+        carpeta = os.path.join(ARCHIVE_DIR, tabla)
+        if os.path.isdir(carpeta):
+            fechas = sorted(n[:-len(".jsonl.gz")] for n in os.listdir(carpeta) if n.endswith(".jsonl.gz"))
+            if fechas:
+                particiones[tabla] = fechas
+    return particiones
+
+def restaurar_particion(tabla: str, fecha: str) -> int:
+    """Reinserta una partición archivada (INSERT OR IGNORE, sin pisar filas más nuevas). Retorna filas."""
+    if tabla not in RETENTION_POLICIES or not re.fullmatch(r"\d{4}-\d{2}-\d{2}|sin-fecha", fecha):
+        raise ValueError(f"Partición inválida: {tabla}/{fecha}")
+    ruta = os.path.join(ARCHIVE_DIR, tabla, f"{fecha}.jsonl.gz")
+    if not os.path.exists(ruta):
+        raise FileNotFoundError(ruta)
+    validas = {row[1] for row in db_safe_run(f"SELECT * FROM pragma_table_info('{tabla}')") or []}
+    total = 0
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        with conn, gzip.open(ruta, "rt", encoding="utf-8") as archivo:
+            lote = []
+            for linea in archivo:
+                fila = {k: v for k, v in json.loads(linea).items() if k in validas}
+                lote.append(fila)
+                if len(lote) >= 500:
+                    total += _insertar_restauradas(conn, tabla, lote)
+                    lote = []
+            total += _insertar_restauradas(conn, tabla, lote)
+    finally:
+        conn.close()
+    # Marcar como restaurada: si las filas siguen caducadas, la próxima pasada las vuelve a archivar
+    os.replace(ruta, ruta + ".restaurado")
+    logger.info(f"♻️ {total} filas de {tabla} restauradas desde {fecha}.")
+    return total
+
+def _insertar_restauradas(conn, tabla: str, filas: list) -> int:
+    por_columnas = {}
+    for fila in filas:
+        por_columnas.setdefault(tuple(fila), []).append(tuple(fila.values()))
+    insertadas = 0
+    for columnas, valores in por_columnas.items():
+        marcas = ", ".join("?" * len(columnas))
+        cursor = conn.executemany(f"INSERT OR IGNORE INTO {tabla} ({', '.join(columnas)}) VALUES ({marcas})", valores)
+        insertadas += cursor.rowcount
+    return insertadas
+
+def estadisticas_bd() -> dict:
+    """Tamaño del archivo y del WAL, páginas libres, filas por tabla y volumen archivado."""
+    def pragma(nombre):
+        row = db_safe_run(f"SELECT * FROM pragma_{nombre}()", fetchone=True)
+        return row[0] if row else 0
+    tablas = [row[0] for row in db_safe_run("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name") or []]
+    wal = DB_FILE + "-wal"
+    archivados, bytes_archivo = 0, 0
+    for raiz, _, nombres in os.walk(ARCHIVE_DIR):
+        for nombre in nombres:
+            if nombre.endswith(".jsonl.gz"):
+                archivados += 1
+                bytes_archivo += os.path.getsize(os.path.join(raiz, nombre))
+    return {
+        "archivo_bytes": os.path.getsize(DB_FILE) if os.path.exists(DB_FILE) else 0,
+        "wal_bytes": os.path.getsize(wal) if os.path.exists(wal) else 0,
+        "paginas": pragma("page_count"),
+        "paginas_libres": pragma("freelist_count"),
+        "tam_pagina": pragma("page_size"),
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(pragma("auto_vacuum"), "?"),
+        "filas": {tabla: (db_safe_run(f"SELECT COUNT(*) FROM {tabla}", fetchone=True) or (0,))[0] for tabla in tablas},
+        "particiones_archivadas": archivados,
+        "archivo_total_bytes": bytes_archivo,
+    }
+
+def abrir_volcado(ruta: str, modo: str):
+    """Archivo de texto para exportar/importar; transparente a .gz."""
+    if ruta.endswith(".gz"):
+        return gzip.open(ruta, modo + "t", encoding="utf-8", newline="")
+    return open(ruta, modo, encoding="utf-8", newline="")
+
+def formato_de(ruta: str) -> str:
+    """'csv' o 'jsonl' según la extensión (ignorando .gz)."""
+    extension = ruta[:-3] if ruta.endswith(".gz") else ruta
+    extension = extension.rsplit(".", 1)[-1].lower()
+    if extension not in FORMATOS_VOLCADO:
+        raise ValueError(f"Formato desconocido: {ruta} (usa .csv o .jsonl)")
+    return extension
+
+def exportar_tabla(tabla: str, destino, formato: str = "csv") -> int:
+    """Vuelca la tabla en `destino` (archivo de texto) en streaming: memoria constante. Retorna filas."""
+    if tabla not in TABLAS_EXPORTABLES or formato not in FORMATOS_VOLCADO:
+        raise ValueError(f"No se puede exportar {tabla} como {formato}")
+    clave = TABLAS_EXPORTABLES[tabla]
+    total = 0
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        # Un solo SELECT: lectura consistente en WAL aunque el bot siga escribiendo
+        cursor = conn.execute(f"SELECT * FROM {tabla} ORDER BY {clave or 'rowid'}")
+        columnas = [d[0] for d in cursor.description]
+        if formato == "csv":
+            escritor = csv.writer(destino)
+            escritor.writerow(columnas)
+        for lote in iter(lambda: cursor.fetchmany(VOLCADO_LOTE), []):
+            if formato == "csv":
+                escritor.writerows(lote)
+            else:
+                destino.writelines(json.dumps(dict(zip(columnas, fila)), ensure_ascii=False) + "\n" for fila in lote)
+            total += len(lote)
+    finally:
+        conn.close()
+    return total
+
+def importar_tabla(tabla: str, origen, formato: str = "csv") -> int:
+    """Carga un volcado con upsert por la clave de la tabla, en lotes de executemany. Retorna filas escritas.
+
+    Sin clave (mod_logs) las filas se añaden en orden cronológico y se omiten las que ya existen idénticas.
+    """
+    if tabla not in TABLAS_EXPORTABLES or formato not in FORMATOS_VOLCADO:
+        raise ValueError(f"No se puede importar {tabla} desde {formato}")
+    clave = TABLAS_EXPORTABLES[tabla]
+    tipos = {row[1]: row[2].upper() for row in db_safe_run(f"SELECT * FROM pragma_table_info('{tabla}')") or []}
+    validas = set(tipos)
+    if formato == "csv":
+        lector = csv.reader(origen)
+        columnas = next(lector, [])
+        # Convertir aquí y no dejarlo a la afinidad de SQLite: su texto -> REAL no siempre es exacto.
+        # CSV no distingue NULL de '': la celda vacía vuelve como NULL
+        conversores = [_conversor_csv(tipos.get(c)) for c in columnas]
+        filas = ([conv(valor) if valor != "" else None for conv, valor in zip(conversores, fila)] for fila in lector)
+    else:
+        primera = origen.readline()
+        columnas = list(json.loads(primera)) if primera.strip() else []
+        filas = (tuple(registro.get(c) for c in columnas)
+                 for registro in map(json.loads, _lineas_no_vacias(primera, origen)))
+    if not columnas:
+        return 0  # Volcado vacío
+    campos = [c for c in columnas if c in validas]
+    if len(campos) < len(columnas):
+        # Columnas legadas (insultos_memoria en BD antiguas) o ajenas: se descartan, no bloquean la migración
+        logger.warning(f"⚠️ {tabla}: se ignoran columnas que no existen en el esquema actual: "
+                       f"{[c for c in columnas if c not in validas]}")
+        indices = [i for i, c in enumerate(columnas) if c in validas]
+        filas = (tuple(fila[i] for i in indices) for fila in filas)
+    if not campos or (clave and clave not in campos):
+        raise ValueError(f"Columnas inválidas para {tabla}: falta {clave or 'alguna columna del esquema'}")
+
+    marcas = ", ".join("?" * len(campos))
+    if clave is None:
+        # Auditoría: nada de REPLACE por rowid (pisaría filas ajenas). Se carga en una tabla temporal
+        # y luego se añade lo que no esté ya (EXCEPT compara NULL con NULL como iguales)
+        sentencia = f"INSERT INTO temp.importacion ({', '.join(campos)}) VALUES ({marcas})"
+    else:
+        cambios = ", ".join(f"{c} = excluded.{c}" for c in campos if c != clave)
+        sentencia = (f"INSERT INTO {tabla} ({', '.join(campos)}) VALUES ({marcas}) "
+                     f"ON CONFLICT({clave}) DO " + (f"UPDATE SET {cambios}" if cambios else "NOTHING"))
+    total = 0
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        if clave is None:
+            conn.execute(f"CREATE TEMP TABLE importacion AS SELECT {', '.join(campos)} FROM main.{tabla} WHERE 0")
+        lote = []
+        for fila in filas:
+            lote.append(fila)
+            if len(lote) >= IMPORTACION_LOTE:
+                with conn:
+                    conn.executemany(sentencia, lote)
+                total += len(lote)
+                lote = []
+        if lote:
+            with conn:
+                conn.executemany(sentencia, lote)
+            total += len(lote)
+        if clave is None:
+            leidas, seleccion = total, ", ".join(campos)
+            with conn:
+                total = conn.execute(
+                    f"INSERT INTO main.{tabla} ({seleccion}) SELECT * FROM ("
+                    f"SELECT {seleccion} FROM temp.importacion EXCEPT SELECT {seleccion} FROM main.{tabla}"
+                    f") ORDER BY {'timestamp' if 'timestamp' in campos else 1}"
+                ).rowcount
+            if leidas > total:
+                logger.info(f"📥 {leidas - total} filas de {tabla} ya estaban y se omitieron.")
+    finally:
+        conn.close()
+    logger.info(f"📥 {total} filas importadas en {tabla}.")
+    return total
+
+def _conversor_csv(tipo: str):
+    numerico = {"INTEGER": int, "REAL": float}.get(tipo)
+    if numerico is None:
+        return str
+    def convertir(valor: str):
+        try:
+            return numerico(valor)
+        except ValueError:
+            return valor  # SQLite admite texto en columnas numéricas: se respeta tal cual
+    return convertir
+
+def _lineas_no_vacias(primera: str, resto):
+    if primera.strip():
+        yield primera
+    for linea in resto:
+        if linea.strip():
+            yield linea
+
 async def ensure_user(user: User):
     if not db_safe_run("SELECT 1 FROM subscribers WHERE chat_id = ?", (user.id,), fetchone=True):
         joined_at = datetime.now().isoformat()
@@ -535,31 +1853,357 @@ async def ensure_user(user: User):
 # BLOQUE 4: CEREBRO DE IA (GOOGLE GEMINI)
 ###############################################################################
 
+def obtener_genai():
+    """Importa y configura el SDK de Gemini la primera vez que hace falta (arranque en frío más rápido)."""
+    global _GENAI
+    if _GENAI is None:
+        inicio = time.perf_counter()
+        # Importamos la librería de Google
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        _GENAI = genai
+        logger.info(f"✅ SDK de Gemini cargado en {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+    return _GENAI
+
+async def gemini_backend(prompt_sistema: str, prompt_usuario: str) -> str:
+    """Llamada real a Google Gemini."""
+    # Instanciamos el modelo
+    model = obtener_genai().GenerativeModel(
+        model_name=GEMINI_MODEL,
+        generation_config=GENERATION_CONFIG,
+        # system_instruction permite definir la personalidad de forma nativa
+        system_instruction=prompt_sistema
+    )
+
+    # Enviamos el mensaje del usuario (puede incluir historial si lo formateamos)
+    response = await model.generate_content_async(prompt_usuario)
+    return response.text.strip()
+
+def obtener_http_llm() -> httpx.AsyncClient:
+    """Cliente httpx del backend REST: una sola instancia, conexiones reutilizadas entre llamadas."""
+    global _HTTP_LLM, _CUPOS_LLM
+    if _HTTP_LLM is None or _HTTP_LLM.is_closed:
+        _HTTP_LLM = httpx.AsyncClient(
+            base_url=GEMINI_API_URL,
+            headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+            http2=HTTP2,
+            limits=limites_http(HTTP_LLM_POOL_SIZE),
+            timeout=httpx.Timeout(HTTP_LLM_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT,
+                                  write=HTTP_WRITE_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+            event_hooks={"request": [trazador_conexiones("llm")]},
+        )
+        _CUPOS_LLM = CuposHTTP("llm", HTTP_LLM_POOL_SIZE)
+    return _HTTP_LLM
+
+async def cerrar_http_llm() -> None:
+    global _HTTP_LLM
+    if _HTTP_LLM is not None:
+        await _HTTP_LLM.aclose()
+        _HTTP_LLM = None
+
+def _camel(clave: str) -> str:
+    cabeza, *resto = clave.split("_")
+    return cabeza + "".join(p.capitalize() for p in resto)
+
+async def gemini_rest_backend(prompt_sistema: str, prompt_usuario: str) -> str:
+    """Google Gemini por REST (generateContent) sobre el cliente compartido de obtener_http_llm()."""
+    cliente = obtener_http_llm()
+    cuerpo = {
+        "systemInstruction": {"parts": [{"text": prompt_sistema}]},
+        "contents": [{"role": "user", "parts": [{"text": prompt_usuario or " "}]}],
+        "generationConfig": {_camel(k): v for k, v in GENERATION_CONFIG.items()},
+    }
+    async with _CUPOS_LLM:
+        respuesta = await cliente.post(f"/models/{GEMINI_MODEL}:generateContent", json=cuerpo)
+    respuesta.raise_for_status()
+    candidatos = respuesta.json().get("candidates") or []
+    if not candidatos:  # Bloqueado por los filtros de seguridad: respuesta vacía
+        return ""
+    partes = candidatos[0].get("content", {}).get("parts") or []
+    return "".join(p.get("text", "") for p in partes if not p.get("thought")).strip()
+
+# Backend del LLM. Los benchmarks de replay lo sustituyen por un stub.
+LLM_BACKEND = gemini_rest_backend if GEMINI_TRANSPORT == "rest" else gemini_backend
+
 async def consultar_ia(prompt_sistema, prompt_usuario=""):
     """
-    Conecta con Google Gemini 1.5 Flash.
+    Conecta con Google Gemini (vía LLM_BACKEND), midiendo latencia y resultado.
     """
     if not GEMINI_API_KEY:
         logger.error("❌ Error: No hay GEMINI_API_KEY configurada.")
+        incrementar("mashi_gemini_calls_total", outcome="sin_clave")
         return None
 
+    inicio = time.perf_counter()
+    outcome = "error"
     try:
-        # Instanciamos el modelo
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            generation_config=GENERATION_CONFIG,
-            # system_instruction permite definir la personalidad de forma nativa
-            system_instruction=prompt_sistema
-        )
-
-        # Enviamos el mensaje del usuario (puede incluir historial si lo formateamos)
-        response = await model.generate_content_async(prompt_usuario)
-        
-        return response.text.strip()
+        texto = await LLM_BACKEND(prompt_sistema, prompt_usuario)
+        outcome = "ok" if texto else "vacio"
+        return texto
 
     except Exception as e:
         logger.error(f"💥 Error en Gemini: {e}")
         return None
+    finally:
+        duracion = time.perf_counter() - inicio
+        observar("mashi_gemini_seconds", duracion, outcome=outcome)
+        incrementar("mashi_gemini_calls_total", outcome=outcome)
+        logger.info(f"🤖 Gemini {outcome} en {duracion * 1000:.0f} ms")
+
+# ============== PRESUPUESTO DE IA (CUBOS DE TOKENS) ==============
+
+def estimar_tokens(*textos: str) -> int:
+    """~4 caracteres por token: suficiente para repartir cuota, no para facturar."""
+    return sum(len(t) for t in textos if t) // 4 + 1
+
+def _cubo_ia(clave: tuple, capacidad: int, ahora: float) -> list:
+    """Cubo rellenado hasta `ahora` (capacidad tokens por hora, ráfaga máxima = capacidad)."""
+    cubo = CUBOS_IA.get(clave)
+    if cubo is None:
+        if len(CUBOS_IA) >= CUBOS_IA_MAX:
+            _podar_cubos_ia(ahora)
+        cubo = CUBOS_IA[clave] = [float(capacidad), ahora]
+    else:
+        cubo[0] = min(capacidad, cubo[0] + (ahora - cubo[1]) * capacidad / 3600)
+        cubo[1] = ahora
+    return cubo
+
+def _podar_cubos_ia(ahora: float) -> None:
+    """Los cubos que ya se habrían rellenado del todo equivalen a no tener cubo."""
+    for clave in [clave for clave, (_, ts) in CUBOS_IA.items() if ahora - ts >= 3600]:
+        del CUBOS_IA[clave]
+    # Si aún no hay sitio, se olvidan los más antiguos (el dict conserva el orden de inserción)
+    while len(CUBOS_IA) >= CUBOS_IA_MAX:
+        CUBOS_IA.pop(next(iter(CUBOS_IA)))
+
+def _contar_uso_ia(chat_id: int, llamadas: int = 0, tokens: int = 0, rechazadas: int = 0) -> None:
+    fila = USO_IA.setdefault((chat_id, datetime.now().strftime("%Y-%m-%d")), [0, 0, 0])
+    fila[0] += llamadas
+    fila[1] += tokens
+    fila[2] += rechazadas
+
+def reservar_tokens_ia(chat_id: int, user_id: int, tokens: int, cfg: ChatConfig, ahora: float = None) -> str:
+    """Admisión antes de llamar a la IA: "" si entra (y descuenta), o el cubo agotado ("chat"/"usuario")."""
+    if user_id == OWNER_ID:
+        return ""  # Kai siempre recibe respuesta; su consumo cuenta igual en ai_usage
+    ahora = time.time() if ahora is None else ahora
+    cubos = []
+    for clave, capacidad in ((("chat", chat_id), cfg.ai_tokens_hour), (("usuario", user_id), cfg.ai_user_tokens_hour)):
+        if capacidad > 0:
+            cubo = _cubo_ia(clave, capacidad, ahora)
+            if cubo[0] < tokens:
+                _contar_uso_ia(chat_id, rechazadas=1)
+                incrementar("mashi_ai_rejected_total", cubo=clave[0])
+                return clave[0]
+            cubos.append(cubo)
+    for cubo in cubos:
+        cubo[0] -= tokens
+    return ""
+
+def liquidar_tokens_ia(chat_id: int, user_id: int, reservados: int, usados: int, cfg: ChatConfig) -> None:
+    """Tras la llamada: devuelve a los cubos lo reservado de más y anota el consumo real del chat."""
+    _contar_uso_ia(chat_id, llamadas=1, tokens=usados)
+    incrementar("mashi_ai_tokens_total", usados)
+    if user_id == OWNER_ID:
+        return
+    for clave, capacidad in ((("chat", chat_id), cfg.ai_tokens_hour), (("usuario", user_id), cfg.ai_user_tokens_hour)):
+        cubo = CUBOS_IA.get(clave)
+        if capacidad > 0 and cubo:
+            cubo[0] = min(capacidad, cubo[0] + reservados - usados)
+
+async def consultar_ia_con_presupuesto(prompt_sistema: str, prompt_usuario: str, chat_id: int, user_id: int,
+                                       cfg: ChatConfig) -> tuple:
+    """consultar_ia detrás de los cubos del chat y del usuario. Retorna (respuesta, motivo del fallback)."""
+    reservados = estimar_tokens(prompt_sistema, prompt_usuario) + IA_TOKENS_SALIDA_RESERVA
+    agotado = reservar_tokens_ia(chat_id, user_id, reservados, cfg)
+    if agotado:
+        logger.info(f"💸 Presupuesto de IA agotado ({agotado}) en {chat_id} para {user_id}: respuesta de respaldo.")
+        return None, "sin_presupuesto"
+    respuesta = await consultar_ia(prompt_sistema, prompt_usuario)
+    usados = reservados - IA_TOKENS_SALIDA_RESERVA + (estimar_tokens(respuesta) if respuesta else 0)
+    liquidar_tokens_ia(chat_id, user_id, reservados, usados, cfg)
+    return respuesta, "" if respuesta else "ia_fallo"
+
+# ============== CLASIFICADOR LOCAL DE HOSTILIDAD / NSFW ==============
+
+class ModeloNgramas:
+    """Regresión logística sobre n-gramas de caracteres con hashing, en NumPy y CPU.
+
+    Dos cabezas (hostilidad, nsfw) sobre el texto normalizado como en el spam duplicado. Los n-gramas
+    se hashean vectorizados (hash polinómico uint64 sobre los code points), así que puntuar un lote
+    cuesta unas pocas llamadas a NumPy, no un bucle por n-grama.
+    """
+    CABEZAS = ("hostilidad", "nsfw")
+
+    def __init__(self, np, pesos, sesgos):
+        self.np = np
+        self.pesos = pesos      # (2^bits, 2) float32
+        self.sesgos = sesgos    # (2,)
+        self.bits = int(pesos.shape[0]).bit_length() - 1
+
+    @staticmethod
+    def ngramas(np, textos: list, bits: int) -> tuple:
+        """(índice de cubo, índice de texto) por cada n-grama de cada texto."""
+        normalizados = "\0".join(f" {normalizar_para_huella(t)} " for t in textos)
+        cp = np.frombuffer(normalizados.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        # separadores[i] = textos terminados antes de la posición i (= índice del texto en i)
+        separadores = np.concatenate(([0], np.cumsum(cp == 0)))
+        largo = len(cp)
+        cubos, duenos = [], []
+        for n in CLASIFICADOR_NGRAMAS:
+            if largo < n:
+                break
+            h = cp[:largo - n + 1].copy()
+            for k in range(1, n):
+                h = h * np.uint64(1_000_003) + cp[k:largo - n + 1 + k]
+            validos = separadores[n:] == separadores[:largo - n + 1]  # Sin separador dentro del n-grama
+            h = (h[validos] ^ np.uint64(n)) * np.uint64(0x9E3779B97F4A7C15)
+            cubos.append((h >> np.uint64(64 - bits)).astype(np.intp))
+            duenos.append(separadores[:largo - n + 1][validos].astype(np.intp))
+        vacio = np.zeros(0, dtype=np.intp)
+        return (np.concatenate(cubos) if cubos else vacio), (np.concatenate(duenos) if duenos else vacio)
+
+    def _logits(self, cubos, duenos, total: int, pesos, sesgos):
+        np = self.np
+        norma = 1 / np.sqrt(np.maximum(np.bincount(duenos, minlength=total), 1))
+        suma = np.stack([np.bincount(duenos, weights=pesos[cubos, c], minlength=total) for c in range(2)], axis=1)
+        return suma * norma[:, None] + sesgos
+
+    def puntuar(self, textos: list):
+        """Probabilidades (len(textos), 2): columna 0 hostilidad, 1 nsfw."""
+        cubos, duenos = self.ngramas(self.np, textos, self.bits)
+        return 1 / (1 + self.np.exp(-self._logits(cubos, duenos, len(textos), self.pesos, self.sesgos)))
+
+    @classmethod
+    def entrenar(cls, np, textos: list, etiquetas, bits: int = CLASIFICADOR_BITS, epocas: int = 80,
+                 tasa: float = 0.5, l2: float = 1e-6) -> "ModeloNgramas":
+        """AdaGrad de lote completo sobre la pérdida logística, con clases balanceadas por cabeza."""
+        y = np.asarray(etiquetas, dtype=np.float64).reshape(len(textos), 2)
+        modelo = cls(np, np.zeros((1 << bits, 2)), np.zeros(2))
+        cubos, duenos = cls.ngramas(np, textos, bits)
+        norma = 1 / np.sqrt(np.maximum(np.bincount(duenos, minlength=len(textos)), 1))
+        positivos = y.mean(axis=0).clip(1e-3, 1 - 1e-3)
+        balance = np.where(y == 1, 0.5 / positivos, 0.5 / (1 - positivos))
+        acumulado_w, acumulado_b = np.full_like(modelo.pesos, 1e-8), np.full(2, 1e-8)
+        for _ in range(epocas):
+            p = 1 / (1 + np.exp(-modelo._logits(cubos, duenos, len(textos), modelo.pesos, modelo.sesgos)))
+            error = (p - y) * balance / len(textos)
+            peso_ngrama = norma[duenos]
+            grad_w = np.stack([np.bincount(cubos, weights=error[duenos, c] * peso_ngrama, minlength=1 << bits)
+                               for c in range(2)], axis=1) + l2 * modelo.pesos
+            grad_b = error.sum(axis=0)
+            acumulado_w += grad_w ** 2
+            acumulado_b += grad_b ** 2
+            modelo.pesos -= tasa * grad_w / np.sqrt(acumulado_w)
+            modelo.sesgos -= tasa * grad_b / np.sqrt(acumulado_b)
+        modelo.pesos = modelo.pesos.astype(np.float32)
+        return modelo
+
+    def guardar(self, ruta: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+        with open(ruta + ".tmp", "wb") as f:
+            self.np.savez_compressed(f, pesos=self.pesos, sesgos=self.sesgos, ngramas=self.np.asarray(CLASIFICADOR_NGRAMAS))
+        os.replace(ruta + ".tmp", ruta)
+
+    @classmethod
+    def cargar(cls, np, ruta: str) -> "ModeloNgramas":
+        with np.load(ruta) as datos:
+            if tuple(datos["ngramas"]) != CLASIFICADOR_NGRAMAS:
+                raise ValueError(f"modelo entrenado con n-gramas {tuple(datos['ngramas'])}")
+            return cls(np, datos["pesos"].astype(np.float32), datos["sesgos"].astype(np.float64))
+
+class ClasificadorLotes:
+    """Junta los textos que piden puntuación en el mismo instante y los puntúa en un solo lote."""
+
+    def __init__(self, modelo: ModeloNgramas, ventana_ms: float = CLASSIFIER_WINDOW_MS):
+        self.modelo = modelo
+        self.ventana = ventana_ms / 1000
+        self.pendientes = []
+        self._disparo = None
+
+    async def puntuar(self, texto: str) -> Optional[tuple]:
+        """(p_hostilidad, p_nsfw), o None si el modelo falló (el llamador vuelve a la regex)."""
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self.pendientes.append((texto, futuro))
+        if len(self.pendientes) >= CLASIFICADOR_LOTE_MAX:
+            self._vaciar()
+        elif self._disparo is None:
+            self._disparo = loop.call_later(self.ventana, self._vaciar) if self.ventana else loop.call_soon(self._vaciar)
+        return await futuro
+
+    def _vaciar(self) -> None:
+        if self._disparo is not None:
+            self._disparo.cancel()
+            self._disparo = None
+        lote, self.pendientes = self.pendientes, []
+        if not lote:
+            return
+        inicio = time.perf_counter()
+        try:
+            probabilidades = self.modelo.puntuar([texto for texto, _ in lote]).tolist()
+        except Exception as e:
+            logger.error(f"Clasificador local falló con un lote de {len(lote)}: {e}")
+            probabilidades = [None] * len(lote)
+        observar("mashi_classifier_seconds", time.perf_counter() - inicio)
+        incrementar("mashi_classifier_messages_total", len(lote))
+        for (_, futuro), resultado in zip(lote, probabilidades):
+            if not futuro.done():
+                futuro.set_result(tuple(resultado) if resultado else None)
+
+def cargar_clasificador() -> Optional[ClasificadorLotes]:
+    """Carga el modelo (NumPy y .npz opcionales). Sin ellos, Mashi sigue solo con las regex."""
+    try:
+        import numpy as np
+    except ImportError:
+        logger.info("Clasificador local desactivado: NumPy no está instalado.")
+        return None
+    ruta = CLASSIFIER_PATH
+    if not os.path.exists(ruta) and CLASSIFIER_REPO:
+        try:
+            from huggingface_hub import hf_hub_download
+            # Queda en la caché de Hugging Face: solo se descarga la primera vez
+            ruta = hf_hub_download(CLASSIFIER_REPO, os.path.basename(CLASSIFIER_PATH))
+        except Exception as e:
+            logger.warning(f"No se pudo descargar el clasificador de {CLASSIFIER_REPO}: {e}")
+            return None
+    if not os.path.exists(ruta):
+        logger.info(f"Clasificador local desactivado: no existe {ruta}.")
+        return None
+    inicio = time.perf_counter()
+    try:
+        modelo = ModeloNgramas.cargar(np, ruta)
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"Clasificador local ilegible ({ruta}), se usan solo regex: {e}")
+        return None
+    logger.info(f"🧠 Clasificador local cargado en {(time.perf_counter() - inicio) * 1000:.0f} ms ({ruta}).")
+    return ClasificadorLotes(modelo)
+
+def veredicto(texto: str, probabilidades: Optional[tuple] = None) -> tuple:
+    """(es_hostil, insulto, es_nsfw, término): regex y, si hay probabilidades del modelo, su veredicto encima.
+
+    El modelo rescata paráfrasis sin palabra clave (umbral alto) y descarta palabras clave usadas
+    de forma inocente, como "tirar la basura" o "por dios" (umbral bajo).
+    """
+    es_hostil, insulto = detectar_hostilidad(texto)
+    es_nsfw, termino = detectar_nsfw(texto)
+    if probabilidades:
+        p_hostil, p_nsfw = probabilidades
+        if es_hostil != (p_hostil >= (CLASIFICADOR_UMBRAL_BAJO if es_hostil else CLASIFICADOR_UMBRAL_ALTO)):
+            incrementar("mashi_classifier_overrides_total", cabeza="hostilidad", veredicto="hostil" if not es_hostil else "inocente")
+            es_hostil = not es_hostil
+            insulto = ETIQUETA_PARAFRASIS if es_hostil else ""  # Va a insult_events y ultimo_insulto
+        if es_nsfw != (p_nsfw >= (CLASIFICADOR_UMBRAL_BAJO if es_nsfw else CLASIFICADOR_UMBRAL_ALTO)):
+            incrementar("mashi_classifier_overrides_total", cabeza="nsfw", veredicto="nsfw" if not es_nsfw else "inocente")
+            es_nsfw = not es_nsfw
+            termino = ETIQUETA_PARAFRASIS if es_nsfw else ""
+    if es_hostil:
+        es_nsfw, termino = False, ""
+    return es_hostil, insulto, es_nsfw, termino
+
+async def clasificar_mensaje(texto: str) -> tuple:
+    """veredicto() con el clasificador local en micro-lotes, si está cargado."""
+    return veredicto(texto, await _CLASIFICADOR.puntuar(texto) if _CLASIFICADOR else None)
 
 
 ###############################################################################
@@ -570,7 +2214,7 @@ def restricted_access(func):
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         chat = update.effective_chat
-        if not chat or chat.id not in ALLOWED_CHATS:
+        if not chat or not get_chat_config(chat.id):
             return
         return await func(update, context, *args, **kwargs)
     return wrapped
@@ -588,6 +2232,485 @@ async def send_random_choice(update: Update, context: ContextTypes.DEFAULT_TYPE,
     chosen_item = random.choice(choices)
     await update.message.reply_text(f"{intro_text}\n\n{chosen_item}")
 
+# ============== EJECUTOR DE MODERACIÓN ==============
+
+@dataclass
+class ResultadoModeracion:
+    """Resultado agregado de una acción de moderación (varias llamadas a la API)."""
+    accion: str
+    chat_id: int
+    target_id: int
+    completadas: list = field(default_factory=list)
+    errores: dict = field(default_factory=dict)
+    omitidas: list = field(default_factory=list)
+    duracion_ms: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.errores and not self.omitidas
+
+def _segundos_retry_after(error: RetryAfter) -> float:
+    espera = error.retry_after
+    return espera.total_seconds() if isinstance(espera, timedelta) else float(espera)
+
+async def llamada_con_reintentos(factory, intentos: int = MOD_MAX_RETRIES):
+    """Ejecuta factory() reintentando flood-control y errores de red transitorios."""
+    for intento in range(intentos):
+        try:
+            return await factory()
+        except RetryAfter as e:
+            if intento == intentos - 1:
+                raise
+            await asyncio.sleep(_segundos_retry_after(e))
+        except BadRequest:
+            raise  # Error del pedido (permisos, mensaje inexistente...): reintentar no sirve
+        except NetworkError:  # Incluye TimedOut
+            if intento == intentos - 1:
+                raise
+            await asyncio.sleep(0.5 * 2 ** intento)
+
+async def ejecutar_moderacion(accion: str, chat_id: int, target_id: int, fases: list,
+                              admin_id: int = None, reason: str = None) -> ResultadoModeracion:
+    """
+    Ejecuta una acción de moderación por fases. Las llamadas de una misma fase
+    ({nombre: lambda: coroutine}) son independientes y van en paralelo; si alguna
+    falla, las fases siguientes se omiten. La primera fase es la sanción en sí:
+    si se completa, la acción queda auditada en mod_logs.
+    """
+    resultado = ResultadoModeracion(accion, chat_id, target_id)
+    inicio = time.perf_counter()
+    for i, fase in enumerate(fases):
+        nombres = list(fase)
+        salidas = await asyncio.gather(
+            *(llamada_con_reintentos(fase[nombre]) for nombre in nombres),
+            return_exceptions=True
+        )
+        for nombre, salida in zip(nombres, salidas):
+            if isinstance(salida, Exception):
+                resultado.errores[nombre] = salida
+            else:
+                resultado.completadas.append(nombre)
+        if resultado.errores:
+            resultado.omitidas = [nombre for resto in fases[i + 1:] for nombre in resto]
+            break
+    resultado.duracion_ms = (time.perf_counter() - inicio) * 1000
+
+    sancion_aplicada = bool(fases) and all(nombre in resultado.completadas for nombre in fases[0])
+    if sancion_aplicada:
+        log_mod_action(accion, target_id, chat_id, admin_id, reason)
+    incrementar("mashi_moderation_actions_total", accion=accion, resultado="ok" if sancion_aplicada else "error")
+    observar("mashi_moderation_seconds", resultado.duracion_ms / 1000, accion=accion)
+    if not resultado.ok:
+        logger.error(f"Moderación '{accion}' sobre {target_id} en {chat_id} incompleta: {resultado.errores}")
+    return resultado
+
+async def borrar_en_lotes(bot, chat_id: int, message_ids: list, pausa: float = 0.0) -> int:
+    """delete_messages en lotes de 100 (límite de la API), con reintentos y, si se pide, una pausa
+    entre lotes para no chocar con el flood-control. Retorna mensajes pedidos sin error."""
+    message_ids = sorted(set(message_ids))
+    borrados = 0
+    for i in range(0, len(message_ids), 100):
+        lote = message_ids[i:i + 100]
+        if i and pausa:
+            await asyncio.sleep(pausa)
+        try:
+            await llamada_con_reintentos(lambda lote=lote: bot.delete_messages(chat_id, lote))
+            borrados += len(lote)
+        except Exception as e:
+            logger.warning(f"No pude borrar {len(lote)} mensajes en {chat_id}: {e}")
+        if len(message_ids) > 100:
+            logger.info(f"🧹 Purga en {chat_id}: {min(i + 100, len(message_ids))}/{len(message_ids)}")
+    return borrados
+
+# ============== SPAM DUPLICADO ENTRE USUARIOS ==============
+
+class HuellaMensaje(NamedTuple):
+    ts: float
+    user_id: int
+    message_id: int
+    exacta: int     # hash del texto normalizado
+    simhash: int    # SimHash de 64 bits para casi-duplicados
+
+_NO_PALABRA_RE = re.compile(r'[^\w\s]+')
+_MASCARA_64 = (1 << 64) - 1
+
+def normalizar_para_huella(texto: str) -> str:
+    """Minúsculas, sin tildes, signos ni espacios repetidos: '¡GÁNALO ya!!' == 'ganalo ya'."""
+    texto = unicodedata.normalize("NFKD", texto[:SPAM_MAX_CHARS * 2].lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(_NO_PALABRA_RE.sub(" ", texto).split())[:SPAM_MAX_CHARS]
+
+def simhash(texto: str) -> int:
+    """SimHash de 64 bits sobre 4-gramas de caracteres (hash() del proceso: solo comparable en memoria)."""
+    gramas = {texto[i:i + 4] for i in range(max(1, len(texto) - 3))}
+    # Conteo de bits sin bucle de 64 por grama: '0101…' en UTF-16 deja cada bit en su propio carril de 16 bits
+    acumulado = 0
+    for grama in gramas:
+        acumulado += int.from_bytes(format(hash(grama) & _MASCARA_64, "064b").encode("utf-16-be"), "big")
+    base = ord("0") * len(gramas)
+    mitad = len(gramas) / 2
+    huella = 0
+    for bit in range(64):
+        if ((acumulado >> (16 * bit)) & 0xFFFF) - base > mitad:
+            huella |= 1 << bit
+    return huella
+
+def detectar_spam_duplicado(chat_id: int, user_id: int, message_id: int, texto: str,
+                            cfg: ChatConfig, ahora: float = None) -> list:
+    """Etapa temprana (sin BD ni IA). Retorna [(user_id, message_id)] a purgar, o [] si no es spam.
+
+    Si el mismo texto (o uno casi idéntico) llega de cfg.spam_min_users usuarios distintos dentro de
+    cfg.spam_window_s, se purgan todas las copias vistas y la huella queda "quemada": las copias
+    posteriores se purgan aunque vengan de un solo usuario.
+    """
+    if not cfg.spam_min_users:
+        return []
+    normalizado = normalizar_para_huella(texto)
+    if len(normalizado) < cfg.spam_min_chars:
+        return []
+    ahora = ahora or time.time()
+    exacta, sim = hash(normalizado), simhash(normalizado)
+
+    def coincide(otra_exacta: int, otro_sim: int) -> bool:
+        return otra_exacta == exacta or bin(otro_sim ^ sim).count("1") <= cfg.spam_max_hamming
+
+    quemadas = SPAM_QUEMADAS.setdefault(chat_id, deque(maxlen=SPAM_QUEMADAS_MAX))
+    while quemadas and quemadas[0][0] < ahora - cfg.spam_window_s * 10:
+        quemadas.popleft()
+    if any(coincide(q_exacta, q_sim) for _, q_exacta, q_sim in quemadas):
+        return [(user_id, message_id)]
+
+    ventana = SPAM_VENTANAS.setdefault(chat_id, deque(maxlen=SPAM_VENTANA_MAX))
+    while ventana and ventana[0].ts < ahora - cfg.spam_window_s:
+        ventana.popleft()
+    copias = [h for h in ventana if coincide(h.exacta, h.simhash)]
+    ventana.append(HuellaMensaje(ahora, user_id, message_id, exacta, sim))
+    if len({h.user_id for h in copias} | {user_id}) < cfg.spam_min_users:
+        return []
+
+    quemadas.append((ahora, exacta, sim))
+    purgar = {(h.user_id, h.message_id) for h in copias} | {(user_id, message_id)}
+    SPAM_VENTANAS[chat_id] = deque((h for h in ventana if (h.user_id, h.message_id) not in purgar), maxlen=SPAM_VENTANA_MAX)
+    return sorted(purgar)
+
+async def purgar_spam(context: ContextTypes.DEFAULT_TYPE, chat_id: int, copias: list, cfg: ChatConfig) -> None:
+    """Silencia a todas las cuentas en paralelo y borra sus copias en lotes de 100."""
+    usuarios = sorted({uid for uid, _ in copias})
+    hasta = datetime.now() + timedelta(minutes=cfg.spam_mute_min)
+    razon = f"Spam duplicado ({len(copias)} copias, {len(usuarios)} cuentas)"
+    await asyncio.gather(*(
+        ejecutar_moderacion("silenciar_spam", chat_id, uid, [
+            {"restringir": lambda uid=uid: context.bot.restrict_chat_member(
+                chat_id, uid, permissions=ChatPermissions(can_send_messages=False), until_date=hasta)},
+        ], reason=razon)
+        for uid in usuarios
+    ))
+    await borrar_en_lotes(context.bot, chat_id, [mid for _, mid in copias])
+    incrementar("mashi_spam_purgado_total", len(copias))
+    logger.info(f"🧹 {razon} purgado en {chat_id}")
+
+# ============== ANÁLISIS DE REENVÍOS ==============
+
+class PerfilOrigen(NamedTuple):
+    """Origen de un reenvío, calculado una vez y cacheado en PERFILES_REENVIO."""
+    tipo: str                            # "usuario", "canal", "grupo" u "oculto"
+    origen_id: int                       # 0 en usuarios ocultos: solo se conoce el nombre
+    nombre: str
+    edad: str = ""                       # Solo usuarios (estimar_fecha_creacion)
+    rep_guardada: Optional[int] = None   # Solo usuarios con registro; el decaimiento se aplica al leer
+    rep_ts: Optional[float] = None
+    creado: float = 0.0
+
+    @property
+    def clave(self) -> tuple:
+        return clave_reenvio(self.tipo, self.origen_id, self.nombre)
+
+def clave_reenvio(tipo: str, origen_id: int, nombre: str) -> tuple:
+    """Clave de un origen en PERFILES_REENVIO y REENVIOS_POR_CHAT: el ID, o el nombre si está oculto."""
+    return tipo, origen_id or nombre
+
+def origen_reenvio(message) -> Optional[tuple]:
+    """(tipo, id, nombre) del origen de un reenvío, o None si el mensaje no es reenviado.
+
+    forward_origin puede ser MessageOriginUser, HiddenUser, Chat o Channel; sin él se miran los forward_* antiguos.
+    """
+    origin = getattr(message, "forward_origin", None)
+    if origin:
+        usuario = getattr(origin, "sender_user", None)
+        chat = getattr(origin, "chat", None) or getattr(origin, "sender_chat", None)
+        oculto = getattr(origin, "sender_user_name", None)
+    else:
+        usuario = getattr(message, "forward_from", None)
+        chat = getattr(message, "forward_from_chat", None)
+        oculto = getattr(message, "forward_sender_name", None)
+    if usuario:
+        return "usuario", usuario.id, usuario.first_name
+    if chat:
+        return "canal" if chat.type == "channel" else "grupo", chat.id, chat.title or chat.username or str(chat.id)
+    if oculto:
+        return "oculto", 0, oculto
+    return None
+
+def perfil_reenvio(message, ahora: float = None) -> Optional[PerfilOrigen]:
+    """Perfil del origen de un reenvío: de la caché si sigue vigente; si no, una lectura de BD (solo usuarios)."""
+    origen = origen_reenvio(message)
+    if not origen:
+        return None
+    tipo, origen_id, nombre = origen
+    clave = clave_reenvio(tipo, origen_id, nombre)
+    ahora = ahora or time.time()
+    perfil = PERFILES_REENVIO.get(clave)
+    if perfil is not None and ahora - perfil.creado < PERFIL_REENVIO_TTL_S:
+        PERFILES_REENVIO.move_to_end(clave)
+        incrementar("mashi_forward_profiles_total", resultado="cache")
+        return perfil
+
+    incrementar("mashi_forward_profiles_total", resultado="nuevo")
+    if tipo == "usuario":
+        fila = db_safe_run("SELECT reputation, rep_ts FROM user_reputation WHERE user_id = ?", (origen_id,), fetchone=True)
+        perfil = PerfilOrigen(tipo, origen_id, nombre, estimar_fecha_creacion(origen_id), *(fila or (None, None)), creado=ahora)
+    else:
+        perfil = PerfilOrigen(tipo, origen_id, nombre, creado=ahora)
+    PERFILES_REENVIO[clave] = perfil
+    PERFILES_REENVIO.move_to_end(clave)
+    if len(PERFILES_REENVIO) > PERFILES_REENVIO_MAX:
+        PERFILES_REENVIO.popitem(last=False)
+    return perfil
+
+def reputacion_origen(perfil: PerfilOrigen, cfg: ChatConfig) -> Optional[int]:
+    """Reputación efectiva de un usuario de origen (baseline si no tiene registro); None para chats y ocultos."""
+    if perfil.tipo != "usuario":
+        return None
+    if perfil.rep_guardada is None:
+        return cfg.rep_baseline
+    return reputacion_efectiva(perfil.rep_guardada, perfil.rep_ts, cfg)
+
+def contar_reenvio(chat_id: int, clave: tuple, cfg: ChatConfig, registrar: bool = True,
+                   ahora: float = None) -> int:
+    """Reenvíos del origen `clave` en el chat dentro de cfg.forward_window_s (incluido este si registrar).
+
+    Solo necesita la clave (clave_reenvio): contar no obliga a cargar el perfil ni a leer la BD.
+    """
+    ahora = ahora or time.time()
+    rastreo = REENVIOS_POR_CHAT.get(chat_id)
+    if rastreo is None:
+        if not registrar:
+            return 0
+        rastreo = REENVIOS_POR_CHAT[chat_id] = OrderedDict()
+    marcas = rastreo.get(clave)
+    if marcas is None:
+        if not registrar:
+            return 0
+        marcas = rastreo[clave] = deque(maxlen=REENVIO_MARCAS_MAX)
+        if len(rastreo) > REENVIO_RASTREO_MAX:
+            rastreo.popitem(last=False)
+    elif registrar:
+        rastreo.move_to_end(clave)
+    while marcas and marcas[0] < ahora - cfg.forward_window_s:
+        marcas.popleft()
+    if registrar:
+        marcas.append(ahora)
+    return len(marcas)
+
+def describir_reenvio(perfil: PerfilOrigen, cfg: ChatConfig, veces: int = 0, para_ia: bool = False) -> str:
+    """Descripción del origen: bloque Markdown para /info o frase para el prompt de la IA."""
+    reputacion = reputacion_origen(perfil, cfg)
+    if para_ia:
+        if perfil.tipo == "usuario":
+            texto = (f"El mensaje es un reenvío de {perfil.nombre} (ID: {perfil.origen_id}, Edad: {perfil.edad}, "
+                     f"Reputación: {reputacion}/100).")
+        elif perfil.tipo == "oculto":
+            texto = f"El mensaje es un reenvío de '{perfil.nombre}' (usuario oculto)."
+        else:
+            texto = f"El mensaje es un reenvío del {perfil.tipo} '{perfil.nombre}' (ID: {perfil.origen_id})."
+        if veces > 1:
+            texto += f" Es el reenvío número {veces} de ese origen en este chat en poco tiempo."
+        return texto
+
+    if perfil.tipo == "usuario":
+        texto = (f"\n🔄 *Mensaje Reenviado de:*\n👤 {perfil.nombre}\n"
+                 f"🆔 `{perfil.origen_id}` | 📅 {perfil.edad} | ⭐ {reputacion}/100\n")
+    elif perfil.tipo == "oculto":
+        texto = f"\n🔄 *Mensaje Reenviado de:* {perfil.nombre} (oculto)\n"
+    else:
+        texto = f"\n🔄 *Mensaje Reenviado de {perfil.tipo.capitalize()}:*\n📢 {perfil.nombre} (`{perfil.origen_id}`)\n"
+    if veces:
+        texto += f"🔁 {veces} reenvío(s) de este origen en la última ventana ({cfg.forward_window_s / 60:.0f} min)\n"
+    return texto
+
+# ============== GRABACIÓN DE UPDATES (REPLAY OFFLINE) ==============
+
+_EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+\.[\w.]+')
+_TELEFONO_RE = re.compile(r'\+?\d[\d \-]{7,}\d')
+_CALLBACK_ID_RE = re.compile(r'^(\w+):(-?\d+)$')
+
+def seudonimo(user_id: int) -> int:
+    """ID estable y no reversible para un usuario. El owner siempre es 1 para poder reproducir sus comandos."""
+    if user_id == OWNER_ID:
+        return 1
+    digest = hashlib.blake2b(f"{RECORD_SALT}:{user_id}".encode(), digest_size=5).digest()
+    return 10_000 + int.from_bytes(digest, "big") % 9_000_000_000
+
+def _enmascarar_texto(texto: str) -> str:
+    """Oculta emails y teléfonos conservando la longitud (los offsets de entities siguen valiendo)."""
+    texto = _EMAIL_RE.sub(lambda m: "x" * len(m.group(0)), texto)
+    return _TELEFONO_RE.sub(lambda m: re.sub(r'\d', '0', m.group(0)), texto)
+
+def scrub_update(data):
+    """Quita datos personales de un update serializado (in place). Los bots conservan su identidad."""
+    if isinstance(data, list):
+        for item in data:
+            scrub_update(item)
+        return data
+    if not isinstance(data, dict):
+        return data
+
+    es_usuario = "is_bot" in data and "id" in data and not data["is_bot"]
+    es_chat_privado = data.get("type") == "private" and "id" in data
+    if es_usuario or es_chat_privado:
+        data["id"] = seudonimo(data["id"])
+        data["first_name"] = f"Mortal{data['id'] % 10000}"
+        data.pop("last_name", None)
+        if "username" in data:
+            data["username"] = f"mortal{data['id']}"
+    data.pop("phone_number", None)
+    for clave in ("text", "caption"):
+        if isinstance(data.get(clave), str):
+            data[clave] = _enmascarar_texto(data[clave])
+    if isinstance(data.get("data"), str):
+        # callback_data como "age_yes:<user_id>"
+        data["data"] = _CALLBACK_ID_RE.sub(lambda m: f"{m.group(1)}:{seudonimo(int(m.group(2)))}", data["data"])
+    for valor in data.values():
+        if isinstance(valor, (dict, list)):
+            scrub_update(valor)
+    return data
+
+def abrir_grabador() -> None:
+    global _RECORDER
+    if not RECORD_UPDATES_PATH:
+        return
+    ruta = f"{RECORD_UPDATES_PATH}.worker{WORKER_SHARD[0]}" if WORKER_SHARD else RECORD_UPDATES_PATH
+    _RECORDER = open(ruta, "a", encoding="utf-8", buffering=1)
+    logger.info(f"🎙️ Grabando updates (sin datos personales) en {ruta}")
+
+def cerrar_grabador() -> None:
+    global _RECORDER
+    if _RECORDER:
+        _RECORDER.close()
+        _RECORDER = None
+
+async def grabar_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler del grupo -1: vuelca cada update a JSONL y deja seguir al resto."""
+    if _RECORDER:
+        linea = {"ts": time.time(), "update": scrub_update(update.to_dict())}
+        _RECORDER.write(json.dumps(linea, ensure_ascii=False) + "\n")
+
+# ============== SNAPSHOT DEL ESTADO EN MEMORIA ==============
+
+def _ruta_snapshot() -> str:
+    return f"{SNAPSHOT_PATH}.worker{WORKER_SHARD[0]}" if WORKER_SHARD else SNAPSHOT_PATH
+
+def guardar_snapshot() -> int:
+    """Escribe de forma atómica (tmp + fsync + rename) la memoria de conversación, flood, insultos, índice de mensajes,
+    cubos de IA y ventanas de reenvíos y de medios repetidos.
+
+    marshal + zlib: compacto, rápido y sin ejecutar código al cargar (a diferencia de pickle).
+    Retorna los bytes escritos (0 si falló).
+    """
+    inicio = time.perf_counter()
+    ventana = max([cfg.flood_window for cfg in CHAT_CONFIG.values()] + [DEFAULT_CHAT_CONFIG.flood_window])
+    corte = datetime.now().timestamp() - ventana
+    configs = list(CHAT_CONFIG.values()) + [DEFAULT_CHAT_CONFIG]
+    corte_reenvios = time.time() - max(cfg.forward_window_s for cfg in configs)
+    corte_media = time.time() - max(cfg.media_repeat_window_s for cfg in configs)
+    estado = {
+        "creado": time.time(),
+        "python": tuple(sys.version_info[:2]),  # El formato de marshal depende de la versión
+        "shard": tuple(WORKER_SHARD) if WORKER_SHARD else None,
+        "chat_context": list(CHAT_CONTEXT),
+        "flood_track": {uid: [t for t in ts if t > corte] for uid, ts in FLOOD_TRACK.items() if ts and ts[-1] > corte},
+        "insultos_recientes": [(uid, list(memoria)) for uid, memoria in INSULTOS_RECIENTES.items()],
+        "indice_mensajes": {chat_id: list(indice) for chat_id, indice in INDICE_MENSAJES.items()},
+        "cubos_ia": {clave: tuple(cubo) for clave, cubo in CUBOS_IA.items()},
+        # Listas de pares en orden LRU; solo marcas que siguen dentro de alguna ventana
+        "reenvios": {chat_id: [(clave, [t for t in marcas if t > corte_reenvios]) for clave, marcas in rastreo.items()
+                               if marcas and marcas[-1] > corte_reenvios]
+                     for chat_id, rastreo in REENVIOS_POR_CHAT.items()},
+        "media_repeticiones": {chat_id: [(clave, [c for c in copias if c[0] > corte_media]) for clave, copias in rastreo.items()
+                                         if copias and copias[-1][0] > corte_media]
+                               for chat_id, rastreo in MEDIA_REPETICIONES.items()},
+    }
+    datos = SNAPSHOT_MAGIC + zlib.compress(marshal.dumps(estado), 6)
+    ruta = _ruta_snapshot()
+    try:
+        with open(ruta + ".tmp", "wb") as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta + ".tmp", ruta)
+    except OSError as e:
+        logger.error(f"No se pudo guardar el snapshot de estado: {e}")
+        return 0
+    duracion = time.perf_counter() - inicio
+    observar("mashi_snapshot_seconds", duracion, op="guardar")
+    logger.info(f"💾 Snapshot de estado guardado: {len(datos)} bytes en {duracion * 1000:.1f} ms.")
+    return len(datos)
+
+def restaurar_snapshot() -> bool:
+    """Carga el snapshot si existe, es de este proceso y es reciente; lo consume para no restaurarlo dos veces."""
+    ruta = _ruta_snapshot()
+    if not os.path.exists(ruta):
+        return False
+    inicio = time.perf_counter()
+    try:
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        os.remove(ruta)
+        if not datos.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("cabecera desconocida")
+        estado = marshal.loads(zlib.decompress(datos[len(SNAPSHOT_MAGIC):]))
+    except (OSError, ValueError, EOFError, TypeError, zlib.error) as e:
+        logger.warning(f"Snapshot de estado ilegible, se ignora: {e}")
+        return False
+    edad = time.time() - estado["creado"]
+    shard = tuple(WORKER_SHARD) if WORKER_SHARD else None
+    if edad > SNAPSHOT_MAX_EDAD_S or estado["python"] != tuple(sys.version_info[:2]) or estado["shard"] != shard:
+        logger.info(f"Snapshot de estado descartado (edad {edad:.0f} s o reparto/versión distintos).")
+        return False
+
+    CHAT_CONTEXT.clear()
+    CHAT_CONTEXT.extend(estado["chat_context"])
+    FLOOD_TRACK.clear()
+    FLOOD_TRACK.update(estado["flood_track"])
+    INSULTOS_RECIENTES.clear()
+    for uid, memoria in estado["insultos_recientes"][-INSULT_CACHE_USUARIOS:]:
+        INSULTOS_RECIENTES[uid] = deque(memoria, maxlen=INSULT_MEMORIA_N)
+    INDICE_MENSAJES.clear()
+    for chat_id, indice in estado.get("indice_mensajes", {}).items():
+        INDICE_MENSAJES[chat_id] = deque(map(tuple, indice), maxlen=INDICE_MENSAJES_MAX)
+    # Sin los cubos, reiniciar le regalaría a cada chat una hora de cuota
+    CUBOS_IA.clear()
+    CUBOS_IA.update({clave: list(cubo) for clave, cubo in estado.get("cubos_ia", {}).items()})
+    # Sin las ventanas, un reinicio a mitad de un raid de reenvíos o de medios empezaría a contar de cero
+    REENVIOS_POR_CHAT.clear()
+    for chat_id, rastreo in estado.get("reenvios", {}).items():
+        REENVIOS_POR_CHAT[chat_id] = OrderedDict(
+            (tuple(clave), deque(marcas, maxlen=REENVIO_MARCAS_MAX)) for clave, marcas in rastreo[-REENVIO_RASTREO_MAX:]
+        )
+    MEDIA_REPETICIONES.clear()
+    for chat_id, rastreo in estado.get("media_repeticiones", {}).items():
+        MEDIA_REPETICIONES[chat_id] = OrderedDict(
+            (tuple(clave), deque(map(tuple, copias), maxlen=MEDIA_COPIAS_MAX)) for clave, copias in rastreo[-MEDIA_RASTREO_MAX:]
+        )
+    duracion = time.perf_counter() - inicio
+    observar("mashi_snapshot_seconds", duracion, op="restaurar")
+    logger.info(
+        f"♨️ Reinicio en caliente: {len(CHAT_CONTEXT)} mensajes, {len(FLOOD_TRACK)} ventanas de flood y "
+        f"{len(INSULTOS_RECIENTES)} memorias de insultos restaurados, más las ventanas de reenvíos y medios de "
+        f"{len(REENVIOS_POR_CHAT)}/{len(MEDIA_REPETICIONES)} chats (snapshot de {edad:.0f} s, {duracion * 1000:.1f} ms)."
+    )
+    return True
+
 
 ###############################################################################
 # BLOQUE 6: COMANDOS PÚBLICOS
@@ -609,6 +2732,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @restricted_access
 async def relato(update: Update, context: ContextTypes.DEFAULT_TYPE):    
     if not GEMINI_API_KEY:
+        incrementar("mashi_fallbacks_total", origen="relato", motivo="ia_no_disponible")
         await send_random_choice(update, context, "El pasado es un eco...", RELATOS_DEL_GUARDIAN)
         return
     
@@ -618,11 +2742,18 @@ async def relato(update: Update, context: ContextTypes.DEFAULT_TYPE):
     prompt_sistema = LORE_MASHI + "\nInstrucción: Escribe un micro-relato (máximo 3 frases) sobre tu antiguo templo, el miedo al olvido o la calidez del sol."
     prompt_usuario = "Cuenta un breve fragmento de tu memoria divina."
     
-    respuesta = await consultar_ia(prompt_sistema, prompt_usuario)
+    respuesta, motivo = await consultar_ia_con_presupuesto(
+        prompt_sistema, prompt_usuario, update.effective_chat.id, update.effective_user.id,
+        get_chat_config(update.effective_chat.id)
+    )
     
     if respuesta:
         await update.message.reply_text(f"📜 *Memoria del León:*\n\n{respuesta}", parse_mode=ParseMode.MARKDOWN)
+    elif motivo == "sin_presupuesto":
+        incrementar("mashi_fallbacks_total", origen="relato", motivo=motivo)
+        await send_random_choice(update, context, "El pasado es un eco...", RELATOS_DEL_GUARDIAN)
     else:
+        incrementar("mashi_fallbacks_total", origen="relato", motivo="ia_fallo")
         await update.message.reply_text("La niebla del olvido es densa hoy. Intenta más tarde.")
 
 @restricted_access
@@ -641,8 +2772,9 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_msg = update.message.reply_to_message
 
     # Obtener reputación
-    rep_data = get_user_reputation(target_user.id)
-    reputacion = rep_data["reputation"] if rep_data else 50
+    cfg = get_chat_config(update.effective_chat.id) or DEFAULT_CHAT_CONFIG
+    rep_data = get_user_reputation(target_user.id, cfg)
+    reputacion = rep_data["reputation"] if rep_data else cfg.rep_baseline
     edad_estimada = estimar_fecha_creacion(target_user.id)
 
     # Emoji según reputación
@@ -662,34 +2794,11 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texto += f"📅 *Edad Estimada:* {edad_estimada}\n"
     texto += f"{emoji_rep} *Reputación:* {reputacion}/100\n"
 
-    # Si es un forward, mostrar origen
-    if hasattr(target_msg, 'forward_origin') and target_msg.forward_origin:
-        origin = target_msg.forward_origin
-        if hasattr(origin, 'sender_user') and origin.sender_user:
-            fwd_user = origin.sender_user
-            fwd_edad = estimar_fecha_creacion(fwd_user.id)
-            texto += f"\n🔄 *Mensaje Reenviado de:*\n"
-            texto += f"👤 {fwd_user.first_name}\n"
-            texto += f"🆔 `{fwd_user.id}` | 📅 {fwd_edad}\n"
-        elif hasattr(origin, 'chat') and origin.chat:
-            fwd_chat = origin.chat
-            texto += f"\n🔄 *Mensaje Reenviado de Chat:*\n"
-            texto += f"📢 {fwd_chat.title} (`{fwd_chat.id}`)\n"
-        elif hasattr(origin, 'sender_name') and origin.sender_name:
-            texto += f"\n🔄 *Mensaje Reenviado de:* {origin.sender_name} (oculto)\n"
-    # Fallback API antigua
-    elif hasattr(target_msg, 'forward_from') and target_msg.forward_from:
-        fwd_user = target_msg.forward_from
-        fwd_edad = estimar_fecha_creacion(fwd_user.id)
-        texto += f"\n🔄 *Mensaje Reenviado de:*\n"
-        texto += f"👤 {fwd_user.first_name}\n"
-        texto += f"🆔 `{fwd_user.id}` | 📅 {fwd_edad}\n"
-    elif hasattr(target_msg, 'forward_from_chat') and target_msg.forward_from_chat:
-        fwd_chat = target_msg.forward_from_chat
-        texto += f"\n🔄 *Mensaje Reenviado de Chat:*\n"
-        texto += f"📢 {fwd_chat.title} (`{fwd_chat.id}`)\n"
-    elif hasattr(target_msg, 'forward_sender_name') and target_msg.forward_sender_name:
-        texto += f"\n🔄 *Mensaje Reenviado de:* {target_msg.forward_sender_name} (oculto)\n"
+    # Si es un forward, mostrar origen (perfil cacheado) y cuántas veces se reenvió aquí
+    perfil = perfil_reenvio(target_msg)
+    if perfil:
+        veces = contar_reenvio(update.effective_chat.id, perfil.clave, cfg, registrar=False)
+        texto += describir_reenvio(perfil, cfg, veces)
 
     await update.message.reply_text(texto, parse_mode=ParseMode.MARKDOWN)
 
@@ -702,7 +2811,7 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @restricted_access
 async def reputacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando exclusivo del OWNER para ver la tabla de reputaciones."""
-    reputaciones = get_all_reputations()
+    reputaciones = get_all_reputations(get_chat_config(update.effective_chat.id) or DEFAULT_CHAT_CONFIG)
 
     if not reputaciones:
         await update.message.reply_text("📊 No hay datos de reputación aún.")
@@ -710,9 +2819,10 @@ async def reputacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     texto = "📊 *REGISTRO DE REPUTACIONES*\n"
     texto += "━" * 30 + "\n\n"
+    memorias = insultos_recientes_de([row[0] for row in reputaciones], 3)  # Últimos 3 de cada uno
 
     for row in reputaciones:
-        user_id, username, rep, total_ins, ultimo_ins, memoria = row
+        user_id, username, rep, total_ins, ultimo_ins = row
 
         # Emoji según reputación
         if rep >= 70:
@@ -732,8 +2842,8 @@ async def reputacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if ultimo_ins:
             texto += f"   ├ Último insulto: _{ultimo_ins}_\n"
 
-        if memoria:
-            insultos = memoria.split("|")[-3:]  # Últimos 3
+        insultos = memorias.get(user_id)
+        if insultos:
             texto += f"   └ Memoria: {', '.join(insultos)}\n"
         else:
             texto += f"   └ Memoria: (vacía)\n"
@@ -742,6 +2852,151 @@ async def reputacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(texto, parse_mode=ParseMode.MARKDOWN)
 
+@owner_only
+@restricted_access
+async def insultos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: insultos y ofensores más frecuentes. Uso: /insultos [horas] [chat_id|todos]"""
+    try:
+        horas = float(context.args[0]) if context.args else 168.0
+        destino = context.args[1] if len(context.args) > 1 else None
+        chat_id = None if destino == "todos" else int(destino) if destino else update.effective_chat.id
+    except ValueError:
+        await update.message.reply_text("Uso: /insultos [horas] [chat_id|todos]")
+        return
+
+    desde = time.time() - horas * 3600
+    ambito = "todos los chats" if chat_id is None else f"chat <code>{chat_id}</code>"
+    texto = f"🗯️ <b>Insultos en {ambito}</b> (últimas {horas:g} h)\n\n<b>Más usados</b>\n"
+    terminos = top_insultos(chat_id, desde)
+    texto += "\n".join(f"   ├ {html.escape(term)}: {n}" for term, n in terminos) or "   ├ (ninguno)"
+    texto += "\n\n<b>Ofensores</b>\n"
+    ofensores = top_ofensores(chat_id, desde)
+    texto += "\n".join(
+        f"   ├ {html.escape(username or 'Desconocido')} (<code>{user_id}</code>): {n}" for user_id, username, n in ofensores
+    ) or "   ├ (ninguno)"
+    await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+
+def _bytes_legibles(n: int) -> str:
+    for unidad in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unidad == "GB":
+            return f"{n:.0f} {unidad}" if unidad == "B" else f"{n:.1f} {unidad}"
+        n /= 1024
+
+async def ejecutar_mantenimiento() -> tuple:
+    """Archiva y compacta fuera del event loop. Retorna ({tabla: filas}, páginas liberadas)."""
+    loop = asyncio.get_running_loop()
+    archivadas = await loop.run_in_executor(None, archivar_expirados)
+    liberadas = await loop.run_in_executor(None, compactar_bd)
+    return archivadas, liberadas
+
+@owner_only
+@restricted_access
+async def bd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: estado de la BD. Con 'mantenimiento', archiva y compacta ya."""
+    texto = ""
+    if context.args and context.args[0] == "mantenimiento":
+        archivadas, liberadas = await ejecutar_mantenimiento()
+        texto += f"🧹 Archivadas: {sum(archivadas.values())} filas · páginas liberadas: {liberadas}\n\n"
+    stats = await asyncio.get_running_loop().run_in_executor(None, estadisticas_bd)
+    texto += f"🗄️ <b>Base de datos</b>\n"
+    texto += f"   ├ Archivo: {_bytes_legibles(stats['archivo_bytes'])} (WAL {_bytes_legibles(stats['wal_bytes'])})\n"
+    texto += f"   ├ Páginas: {stats['paginas']} × {stats['tam_pagina']} B, libres: {stats['paginas_libres']}\n"
+    texto += f"   ├ auto_vacuum: {stats['auto_vacuum']}\n"
+    texto += f"   └ Archivo histórico: {stats['particiones_archivadas']} particiones, {_bytes_legibles(stats['archivo_total_bytes'])}\n"
+    texto += "\n<b>Filas</b>\n" + "\n".join(f"   ├ {tabla}: {n}" for tabla, n in stats["filas"].items())
+    await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+
+@owner_only
+@restricted_access
+async def consumo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: consumo de IA por chat. Uso: /consumo [días] (por defecto 7)"""
+    try:
+        dias = max(1, int(context.args[0])) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Uso: /consumo [días]")
+        return
+    flush_uso_ia()
+    desde = (datetime.now() - timedelta(days=dias - 1)).strftime("%Y-%m-%d")
+    filas = uso_ia_por_chat(desde)
+    if not filas:
+        await update.message.reply_text(f"💸 Sin consumo de IA en los últimos {dias} días.")
+        return
+    ahora = time.time()
+    texto = f"💸 <b>Consumo de IA</b> (últimos {dias} días, tokens estimados)\n"
+    for chat_id, llamadas, tokens, rechazadas in filas[:15]:
+        cfg = get_chat_config(chat_id) or DEFAULT_CHAT_CONFIG
+        cubo = CUBOS_IA.get(("chat", chat_id))
+        if cfg.ai_tokens_hour and cubo:
+            disponible = min(cfg.ai_tokens_hour, cubo[0] + (ahora - cubo[1]) * cfg.ai_tokens_hour / 3600)
+            estado = f"{disponible / cfg.ai_tokens_hour:.0%} del cubo"
+        else:
+            estado = "sin límite" if not cfg.ai_tokens_hour else "cubo lleno"
+        texto += f"   ├ <code>{chat_id}</code>: {tokens} tokens, {llamadas} llamadas, {rechazadas} rechazadas · {estado}\n"
+    texto += f"   └ Total: {sum(f[2] for f in filas)} tokens en {len(filas)} chats"
+    await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+
+@owner_only
+@restricted_access
+async def restaurar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: reinserta una partición archivada. Uso: /restaurar [tabla AAAA-MM-DD]"""
+    if len(context.args) < 2:
+        particiones = listar_particiones()
+        if not particiones:
+            await update.message.reply_text("🗄️ No hay particiones archivadas.")
+            return
+        texto = "🗄️ <b>Particiones archivadas</b> (uso: /restaurar tabla AAAA-MM-DD)\n"
+        for tabla, fechas in particiones.items():
+            texto += f"   ├ {tabla}: {len(fechas)} ({fechas[0]} … {fechas[-1]})\n"
+        await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+        return
+    tabla, fecha = context.args[0], context.args[1]
+    try:
+        filas = await asyncio.get_running_loop().run_in_executor(None, restaurar_particion, tabla, fecha)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+        return
+    except FileNotFoundError:
+        await update.message.reply_text(f"⚠️ No existe la partición {tabla}/{fecha}.")
+        return
+    await update.message.reply_text(f"♻️ {filas} filas de {tabla} restauradas desde {fecha}.")
+
+def _volcado_en_memoria(tabla: str, formato: str) -> tuple:
+    """Exporta a un BytesIO (gzip si excede el tope de Telegram). Retorna (buffer, nombre, filas)."""
+    buffer = io.BytesIO()
+    texto = io.TextIOWrapper(buffer, encoding="utf-8", newline="", write_through=True)
+    filas = exportar_tabla(tabla, texto, formato)
+    texto.detach()
+    nombre = f"{tabla}_{datetime.now():%Y%m%d_%H%M}.{formato}"
+    if buffer.tell() > DOCUMENTO_MAX_BYTES:
+        buffer = io.BytesIO(gzip.compress(buffer.getvalue(), 6))
+        nombre += ".gz"
+    buffer.seek(0)
+    return buffer, nombre, filas
+
+@owner_only
+@restricted_access
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: envía por privado un volcado. Uso: /exportar [tabla|todas] [csv|jsonl]"""
+    args = [a.lower() for a in context.args or []]
+    formato = next((a for a in args if a in FORMATOS_VOLCADO), "csv")
+    pedidas = [a for a in args if a not in FORMATOS_VOLCADO] or ["user_reputation"]
+    tablas = list(TABLAS_EXPORTABLES) if pedidas == ["todas"] else pedidas
+    invalidas = [t for t in tablas if t not in TABLAS_EXPORTABLES]
+    if invalidas:
+        await update.message.reply_text(f"Uso: /exportar [{'|'.join(TABLAS_EXPORTABLES)}|todas] [csv|jsonl]")
+        return
+    loop = asyncio.get_running_loop()
+    for tabla in tablas:
+        inicio = time.perf_counter()
+        buffer, nombre, filas = await loop.run_in_executor(None, _volcado_en_memoria, tabla, formato)
+        # Los volcados llevan datos de todos los chats: siempre al privado del owner
+        await context.bot.send_document(
+            OWNER_ID, document=buffer, filename=nombre,
+            caption=f"📤 {tabla}: {filas} filas ({time.perf_counter() - inicio:.1f} s)"
+        )
+    if update.effective_chat.id != OWNER_ID:
+        await update.message.reply_text("📤 Volcado enviado por privado, maestro.")
+
 @owner_only
 @restricted_access
 async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -768,17 +3023,17 @@ async def advertir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target = update.message.reply_to_message.from_user
     reason = " ".join(context.args) if context.args else "Comportamiento inadecuado"
 
-    warnings_count, was_banned = add_warning(target.id, target.username or target.first_name, reason)
+    cfg = get_chat_config(update.effective_chat.id)
+    warnings_count, was_banned = add_warning(target.id, target.username or target.first_name, reason, cfg.max_warnings, cfg.ban_hours)
 
     if was_banned:
-        try:
-            await context.bot.ban_chat_member(update.effective_chat.id, target.id, until_date=datetime.now() + timedelta(hours=3))
-            await update.message.reply_text(f"El mortal {target.mention_html()} ha sido exiliado temporalmente (3h) por acumulación de advertencias.", parse_mode=ParseMode.HTML)
-            db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("exilio_temporal", target.id, datetime.now().isoformat()), commit=True)
-        except Exception as e:
-            logger.error(f"Error baneando: {e}")
+        chat_id = update.effective_chat.id
+        await ejecutar_moderacion("exilio_temporal", chat_id, target.id, [
+            {"ban": lambda: context.bot.ban_chat_member(chat_id, target.id, until_date=datetime.now() + timedelta(hours=cfg.ban_hours))},
+            {"respuesta": lambda: update.message.reply_text(f"El mortal {target.mention_html()} ha sido exiliado temporalmente ({cfg.ban_hours}h) por acumulación de advertencias.", parse_mode=ParseMode.HTML)},
+        ], admin_id=update.effective_user.id, reason=reason)
     else:
-        await update.message.reply_text(f"⚠️ Advertencia {warnings_count}/3 para {target.mention_html()}. Razón: {reason}", parse_mode=ParseMode.HTML)
+        await update.message.reply_text(f"⚠️ Advertencia {warnings_count}/{cfg.max_warnings} para {target.mention_html()}. Razón: {reason}", parse_mode=ParseMode.HTML)
 
 @owner_only
 @restricted_access
@@ -789,17 +3044,18 @@ async def silenciar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target = update.message.reply_to_message.from_user
-    try:
-        await context.bot.restrict_chat_member(
-            update.effective_chat.id,
+    chat_id = update.effective_chat.id
+    resultado = await ejecutar_moderacion("silenciar", chat_id, target.id, [
+        {"restringir": lambda: context.bot.restrict_chat_member(
+            chat_id,
             target.id,
             permissions=ChatPermissions(can_send_messages=False),
             until_date=datetime.now() + timedelta(hours=1)
-        )
-        await update.message.reply_text(f"El mortal {target.mention_html()} ha sido silenciado por 1 hora.", parse_mode=ParseMode.HTML)
-        db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("silenciar", target.id, datetime.now().isoformat()), commit=True)
-    except Exception as e:
-        await update.message.reply_text(f"No pude silenciar al usuario: {e}")
+        )},
+        {"respuesta": lambda: update.message.reply_text(f"El mortal {target.mention_html()} ha sido silenciado por 1 hora.", parse_mode=ParseMode.HTML)},
+    ], admin_id=update.effective_user.id, reason=" ".join(context.args or []) or None)
+    if "restringir" in resultado.errores:
+        await update.message.reply_text(f"No pude silenciar al usuario: {resultado.errores['restringir']}")
 
 @owner_only
 @restricted_access
@@ -810,26 +3066,81 @@ async def expulsar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target = update.message.reply_to_message.from_user
-    try:
-        await context.bot.ban_chat_member(update.effective_chat.id, target.id)
-        await context.bot.unban_chat_member(update.effective_chat.id, target.id)  # Kick = ban + unban inmediato
-        await update.message.reply_text(f"El mortal {target.mention_html()} ha sido expulsado del templo.", parse_mode=ParseMode.HTML)
-        db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("expulsar", target.id, datetime.now().isoformat()), commit=True)
-    except Exception as e:
-        await update.message.reply_text(f"No pude expulsar al usuario: {e}")
+    chat_id = update.effective_chat.id
+    # Kick = ban + unban inmediato; el unban y la respuesta no dependen entre sí
+    resultado = await ejecutar_moderacion("expulsar", chat_id, target.id, [
+        {"ban": lambda: context.bot.ban_chat_member(chat_id, target.id)},
+        {"unban": lambda: context.bot.unban_chat_member(chat_id, target.id),
+         "respuesta": lambda: update.message.reply_text(f"El mortal {target.mention_html()} ha sido expulsado del templo.", parse_mode=ParseMode.HTML)},
+    ], admin_id=update.effective_user.id, reason=" ".join(context.args or []) or None)
+    if "ban" in resultado.errores:
+        await update.message.reply_text(f"No pude expulsar al usuario: {resultado.errores['ban']}")
 
 @owner_only
 @restricted_access
 async def purificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         return await update.message.reply_text("Responde al mensaje impuro.")
+    chat_id = update.effective_chat.id
+    impuro = update.message.reply_to_message
+    resultado = await ejecutar_moderacion("purificar", chat_id, impuro.from_user.id, [
+        {"borrar_impuro": impuro.delete, "borrar_comando": update.message.delete},
+        {"anuncio": lambda: context.bot.send_message(chat_id, "La luz purifica. Sombra desterrada.")},
+    ], admin_id=update.effective_user.id)
+    if "borrar_impuro" in resultado.errores:
+        await context.bot.send_message(chat_id, "La impureza se resiste.")
+
+def seleccionar_purga(chat_id: int, ancla: Optional[int] = None, user_id: Optional[int] = None,
+                      cantidad: int = PURGA_MAX) -> list:
+    """IDs a purgar: desde el mensaje ancla en adelante, o los recientes de un usuario (del índice en memoria)."""
+    indice = INDICE_MENSAJES.get(chat_id, ())
+    if user_id is not None:
+        ids = [mid for mid, uid in indice if uid == user_id]
+        return ids[-cantidad:]
+    if any(mid == ancla for mid, _ in indice):
+        return [mid for mid, _ in indice if mid >= ancla][:cantidad]
+    # Ancla fuera del índice (más vieja que él, o índice vacío tras reiniciar): en supergrupos los IDs
+    # son consecutivos; los ausentes se ignoran
+    return list(range(ancla, ancla + cantidad))
+
+@owner_only
+@restricted_access
+async def purgar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: purga masiva. Respondiendo a un mensaje:
+    /purgar N — ese mensaje y los N-1 siguientes; /purgar usuario [N] — los últimos N de su autor."""
+    ancla = update.message.reply_to_message
+    args = context.args or []
+    por_usuario = bool(args) and args[0] == "usuario"
     try:
-        await update.message.reply_to_message.delete()
-        await update.message.delete()
-        await context.bot.send_message(update.effective_chat.id, "La luz purifica. Sombra desterrada.")
-        db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("purificar", update.message.reply_to_message.from_user.id, datetime.now().isoformat()), commit=True)
-    except Exception:
-        await update.message.reply_text("La impureza se resiste.")
+        cantidad = int(args[1 if por_usuario else 0]) if len(args) > (1 if por_usuario else 0) else (PURGA_MAX if por_usuario else 0)
+    except ValueError:
+        cantidad = 0
+    if not ancla or (not por_usuario and cantidad < 1):
+        return await update.message.reply_text("Uso (respondiendo a un mensaje): /purgar N  ·  /purgar usuario [N]")
+    cantidad = min(cantidad, PURGA_MAX)
+    chat_id = update.effective_chat.id
+    objetivo = ancla.from_user.id if por_usuario and ancla.from_user else None
+    if por_usuario and (objetivo is None or objetivo in TELEGRAM_SYSTEM_IDS):
+        # Canal o admin anónimo: no hay un autor propio cuyos mensajes purgar
+        return await update.message.reply_text("Ese mensaje no tiene un autor mortal: usa /purgar N.")
+    ids = seleccionar_purga(chat_id, ancla.message_id, objetivo, cantidad)
+    ids.append(update.message.message_id)
+
+    inicio = time.perf_counter()
+    borrados = await borrar_en_lotes(context.bot, chat_id, ids, pausa=PURGA_PAUSA_S)
+    purgados = set(ids)
+    if chat_id in INDICE_MENSAJES:
+        INDICE_MENSAJES[chat_id] = deque(
+            (item for item in INDICE_MENSAJES[chat_id] if item[0] not in purgados), maxlen=INDICE_MENSAJES_MAX
+        )
+    duracion = time.perf_counter() - inicio
+    # Una sola fila de auditoría para toda la purga
+    modo = f"usuario {objetivo}" if por_usuario else f"desde {ancla.message_id}"
+    log_mod_action("purgar", objetivo or 0, chat_id, update.effective_user.id,
+                   f"{borrados}/{len(ids)} mensajes ({modo}) en {duracion:.1f} s")
+    incrementar("mashi_mensajes_purgados_total", borrados)
+    logger.info(f"🧹 Purga en {chat_id} ({modo}): {borrados}/{len(ids)} mensajes en {duracion:.1f} s")
+    await context.bot.send_message(chat_id, f"🧹 La luz barre el templo: {borrados} mensajes purificados.")
 
 @owner_only
 @restricted_access
@@ -837,14 +3148,202 @@ async def exilio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         return await update.message.reply_text("Responde al hereje.")
     target = update.message.reply_to_message.from_user
-    try:
-        await context.bot.ban_chat_member(update.effective_chat.id, target.id)
-        await update.message.delete()
-        await context.bot.send_message(update.effective_chat.id, f"El hereje {target.mention_html()} ha sido exiliado.", parse_mode=ParseMode.HTML)
-        db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("exilio", target.id, datetime.now().isoformat()), commit=True)
-    except Exception:
+    chat_id = update.effective_chat.id
+    resultado = await ejecutar_moderacion("exilio", chat_id, target.id, [
+        {"ban": lambda: context.bot.ban_chat_member(chat_id, target.id)},
+        {"borrar_comando": update.message.delete,
+         "anuncio": lambda: context.bot.send_message(chat_id, f"El hereje {target.mention_html()} ha sido exiliado.", parse_mode=ParseMode.HTML)},
+    ], admin_id=update.effective_user.id, reason=" ".join(context.args or []) or None)
+    if "ban" in resultado.errores:
         await update.message.reply_text("El exilio falló.")
 
+@owner_only
+@restricted_access
+async def bloquear_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: responde a un sticker/GIF/foto/documento para vetarlo. Uso: /bloquear_media [razón]"""
+    objetivo = update.message.reply_to_message
+    media = extraer_media(objetivo) if objetivo else None
+    if not media:
+        return await update.message.reply_text(f"Responde al medio impuro. Vetados: {len(MEDIA_BLOCKLIST)}.")
+    tipo, file_unique_id = media
+    add_blocked_media(file_unique_id, tipo, update.effective_user.id, update.effective_chat.id, " ".join(context.args or []) or None)
+    log_mod_action("bloquear_media", objetivo.from_user.id if objetivo.from_user else 0, update.effective_chat.id,
+                   update.effective_user.id, f"{tipo} {file_unique_id}")
+    try:
+        await objetivo.delete()
+    except Exception as e:
+        logger.warning(f"No pude borrar el medio vetado: {e}")
+    await update.message.reply_text(f"🚫 {tipo} vetado en todo el templo (<code>{file_unique_id}</code>).", parse_mode=ParseMode.HTML)
+
+@owner_only
+@restricted_access
+async def desbloquear_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: quita un medio de la lista negra (respondiendo a él o con su file_unique_id)."""
+    objetivo = update.message.reply_to_message
+    media = extraer_media(objetivo) if objetivo else None
+    file_unique_id = media[1] if media else (context.args[0] if context.args else None)
+    if not file_unique_id:
+        return await update.message.reply_text("Uso: /desbloquear_media <file_unique_id> o respondiendo al medio.")
+    if remove_blocked_media(file_unique_id):
+        await update.message.reply_text(f"✅ <code>{html.escape(file_unique_id)}</code> ya no está vetado.", parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_text("Ese medio no estaba vetado.")
+
+@owner_only
+@restricted_access
+async def pendientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER para ver cuántas verificaciones de edad siguen abiertas."""
+    total = len(PENDING_VERIFICATIONS)
+    if not total:
+        await update.message.reply_text("✅ No hay mortales pendientes de verificar su edad.")
+        return
+
+    por_chat = {}
+    for chat_id, _ in PENDING_VERIFICATIONS:
+        por_chat[chat_id] = por_chat.get(chat_id, 0) + 1
+
+    texto = f"⏳ *Verificaciones pendientes:* {total}\n"
+    for chat_id, count in sorted(por_chat.items(), key=lambda kv: -kv[1]):
+        texto += f"   ├ `{chat_id}`: {count}\n"
+    proximo = next_verification_deadline()
+    if proximo:
+        minutos = max(0, int((proximo - time.time()) / 60))
+        texto += f"   └ Próxima expiración en {minutos} min\n"
+    await update.message.reply_text(texto, parse_mode=ParseMode.MARKDOWN)
+
+@owner_only
+@restricted_access
+async def config(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: /config [chat_id] [clave valor] muestra o cambia ajustes en caliente."""
+    args = list(context.args or [])
+    chat_id = update.effective_chat.id
+    if len(args) in (1, 3):
+        try:
+            chat_id = int(args.pop(0))
+        except ValueError:
+            await update.message.reply_text("Uso: /config [chat_id] [clave valor]")
+            return
+
+    if len(args) == 2:
+        try:
+            set_chat_setting(chat_id, args[0], args[1])
+        except ValueError as e:
+            await update.message.reply_text(f"No pude aplicar el ajuste: {e}")
+            return
+        logger.info(f"⚙️ Ajuste {args[0]}={args[1]} aplicado en {chat_id}")
+
+    cfg = CHAT_CONFIG.get(chat_id, DEFAULT_CHAT_CONFIG)
+    texto = f"⚙️ <b>Configuración del chat</b> <code>{chat_id}</code>\n"
+    for key, value in cfg._asdict().items():
+        marca = "" if value == getattr(DEFAULT_CHAT_CONFIG, key) else " ✏️"
+        texto += f"   ├ {key}: <code>{value}</code>{marca}\n"
+    await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+
+@owner_only
+@restricted_access
+async def permitir(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER para abrir el templo a un chat: /permitir <chat_id>."""
+    try:
+        chat_id = int(context.args[0])
+    except (IndexError, TypeError, ValueError):
+        await update.message.reply_text("Uso: /permitir <chat_id>")
+        return
+    set_chat_setting(chat_id, "enabled", "1")
+    await update.message.reply_text(f"🛕 El chat {chat_id} ahora está bajo mi vigilancia.")
+
+@owner_only
+@restricted_access
+async def vetar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER para cerrar el templo a un chat: /vetar [chat_id]."""
+    try:
+        chat_id = int(context.args[0]) if context.args else update.effective_chat.id
+    except ValueError:
+        await update.message.reply_text("Uso: /vetar [chat_id]")
+        return
+    set_chat_setting(chat_id, "enabled", "0")
+    await update.message.reply_text(f"🚫 El chat {chat_id} queda fuera del templo.")
+
+def _resumen_histogramas(nombre: str, top: int = 5, por_total: bool = False) -> list:
+    """Líneas 'label n p50 p99' de un histograma, ordenadas por cuenta o por tiempo total."""
+    filas = [(labels, hist) for (n, labels), hist in METRICS_HIST.items() if n == nombre and hist.cuenta]
+    filas.sort(key=lambda fila: fila[1].suma if por_total else fila[1].cuenta, reverse=True)
+    lineas = []
+    for labels, hist in filas[:top]:
+        etiqueta = ",".join(str(v) for _, v in labels) or "-"
+        lineas.append(
+            f"   ├ {html.escape(etiqueta)}: n={hist.cuenta} p50={hist.percentil(50) * 1000:.1f}ms "
+            f"p99={hist.percentil(99) * 1000:.1f}ms Σ={hist.suma:.2f}s"
+        )
+    return lineas or ["   ├ (sin datos)"]
+
+@owner_only
+@restricted_access
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: resumen compacto de latencias y contadores."""
+    texto = "📈 <b>Rendimiento del templo</b>\n"
+    texto += "\n<b>Handlers</b>\n" + "\n".join(_resumen_histogramas("mashi_handler_seconds", top=8))
+    texto += "\n<b>Gemini</b>\n" + "\n".join(_resumen_histogramas("mashi_gemini_seconds"))
+    texto += "\n<b>BD (por tiempo total)</b>\n" + "\n".join(_resumen_histogramas("mashi_db_seconds", por_total=True))
+    texto += "\n<b>Telegram API</b>\n" + "\n".join(_resumen_histogramas("mashi_telegram_api_seconds"))
+    lag = METRICS_HIST.get(("mashi_loop_lag_seconds", ()))
+    if lag and lag.cuenta:
+        texto += (
+            f"\n<b>Event loop</b>\n   ├ lag p50={lag.percentil(50) * 1000:.1f}ms "
+            f"p99={lag.percentil(99) * 1000:.1f}ms máx={_VIGILANTE.lag_max * 1000 if _VIGILANTE else 0:.0f}ms\n"
+        )
+        for b in list(_VIGILANTE.bloqueos)[-3:] if _VIGILANTE else []:
+            texto += f"   ├ 🐢 {b['cuando']} {b['retraso_ms']:.0f}ms {html.escape(b['handler'])} → {html.escape(b['funcion'])}:{b['linea']}\n"
+
+    contadores = [
+        (nombre, labels, valor) for (nombre, labels), valor in METRICS_COUNTERS.items()
+        if nombre in ("mashi_moderation_actions_total", "mashi_fallbacks_total")
+    ]
+    if contadores:
+        texto += "\n<b>Contadores</b>\n"
+        for nombre, labels, valor in sorted(contadores):
+            etiqueta = ",".join(f"{k}={v}" for k, v in labels)
+            texto += f"   ├ {nombre.replace('mashi_', '').replace('_total', '')}{{{html.escape(etiqueta)}}}: {valor}\n"
+    await update.message.reply_text(texto, parse_mode=ParseMode.HTML)
+
+async def _reportar_perfil(bot, chat_id: int) -> None:
+    """Detiene el perfilador activo y envía sus funciones más calientes."""
+    global _PERFILADOR
+    perfilador, _PERFILADOR = _PERFILADOR, None
+    if not perfilador:
+        return
+    perfilador.detener()
+    texto = f"🔥 <b>Perfil del event loop</b> ({perfilador.muestras} muestras)\n\n<b>Tiempo propio</b>\n"
+    texto += "\n".join(f"   ├ {pct:5.1f}% {html.escape(nombre)}" for pct, nombre in perfilador.top(10)) or "   ├ (sin muestras)"
+    texto += "\n\n<b>Inclusivo (solo mashi.py)</b>\n"
+    propias = [fila for fila in perfilador.top(40, inclusivo=True) if fila[1].startswith("mashi.py:")][:8]
+    texto += "\n".join(f"   ├ {pct:5.1f}% {html.escape(nombre)}" for pct, nombre in propias) or "   ├ (sin muestras)"
+    await bot.send_message(chat_id, texto, parse_mode=ParseMode.HTML)
+
+async def perfilador_fin_job(context: ContextTypes.DEFAULT_TYPE):
+    if context.job.data is _PERFILADOR:  # Si ya se detuvo a mano, no hay nada que reportar
+        await _reportar_perfil(context.bot, context.job.chat_id)
+
+@owner_only
+@restricted_access
+async def perfilar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando exclusivo del OWNER: activa el perfilador por muestreo N segundos, o lo detiene si ya corre."""
+    global _PERFILADOR
+    if _PERFILADOR:
+        await _reportar_perfil(context.bot, update.effective_chat.id)
+        return
+    try:
+        segundos = float(context.args[0]) if context.args else 10.0
+    except ValueError:
+        await update.message.reply_text("Uso: /perfilar [segundos]")
+        return
+    segundos = max(1.0, min(segundos, PERFILADOR_MAX_S))
+    _PERFILADOR = PerfiladorMuestreo(segundos)
+    _PERFILADOR.iniciar()
+    if context.job_queue:
+        context.job_queue.run_once(perfilador_fin_job, when=segundos, chat_id=update.effective_chat.id,
+                                   data=_PERFILADOR, name="perfilador")
+    await update.message.reply_text(f"🔥 Perfilando el event loop {segundos:.0f} s. Repite /perfilar para detenerlo antes.")
+
 
 ###############################################################################
 # BLOQUE 8: LÓGICA CONVERSACIONAL Y EVENTOS
@@ -852,73 +3351,65 @@ async def exilio(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def conversacion_natural(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text: return
-    if update.effective_chat.id not in ALLOWED_CHATS: return
-    
+    cfg = get_chat_config(update.effective_chat.id)
+    if not cfg: return
+
     ia_disponible = bool(GEMINI_API_KEY)
     user = update.effective_user
     if not user:
         return
     msg_text = update.message.text
 
+    # SPAM DUPLICADO: antes de cualquier lectura de BD o llamada a la IA
+    if user.id != OWNER_ID:
+        copias = detectar_spam_duplicado(update.effective_chat.id, user.id, update.message.message_id, msg_text, cfg)
+        if copias:
+            await purgar_spam(context, update.effective_chat.id, copias, cfg)
+            return
+
     # ANTI-FLOOD: Verificar si está floodando
     now = datetime.now().timestamp()
     if user.id not in FLOOD_TRACK:
         FLOOD_TRACK[user.id] = []
     FLOOD_TRACK[user.id].append(now)
-    # Mantener solo mensajes de los últimos 10 segundos
-    FLOOD_TRACK[user.id] = [t for t in FLOOD_TRACK[user.id] if now - t < 10]
-    if len(FLOOD_TRACK[user.id]) > 5:  # Más de 5 mensajes en 10s
-        try:
-            await context.bot.restrict_chat_member(
-                update.effective_chat.id,
+    # Mantener solo mensajes dentro de la ventana del chat
+    FLOOD_TRACK[user.id] = [t for t in FLOOD_TRACK[user.id] if now - t < cfg.flood_window]
+    if len(FLOOD_TRACK[user.id]) > cfg.flood_limit:
+        chat_id = update.effective_chat.id
+        resultado = await ejecutar_moderacion("silenciar_flood", chat_id, user.id, [
+            {"restringir": lambda: context.bot.restrict_chat_member(
+                chat_id,
                 user.id,
                 permissions=ChatPermissions(can_send_messages=False),
-                until_date=datetime.now() + timedelta(minutes=5)
-            )
-            await update.message.reply_text(f"El mortal {user.mention_html()} ha sido silenciado por flood (5 min).", parse_mode=ParseMode.HTML)
+                until_date=datetime.now() + timedelta(minutes=cfg.flood_mute_min)
+            )},
+            {"respuesta": lambda: update.message.reply_text(f"El mortal {user.mention_html()} ha sido silenciado por flood ({cfg.flood_mute_min} min).", parse_mode=ParseMode.HTML)},
+        ], reason="Flood")
+        if "restringir" not in resultado.errores:
             return  # No procesar más
-        except Exception as e:
-            logger.error(f"Error anti-flood: {e}")
 
-    # Detección de reenvíos
+    # Detección de reenvíos: moderar_reenvios (grupo -1) ya contó este reenvío, salvo si es del owner
+    # (no se cuentan). El perfil se carga aquí, después del filtro de spam y del anti-flood
     forward_info = ""
-    if hasattr(update.message, 'forward_origin') and update.message.forward_origin:
-        origin = update.message.forward_origin
-        if hasattr(origin, 'sender_user') and origin.sender_user:
-            fwd_user = origin.sender_user
-            fwd_rep = get_user_reputation(fwd_user.id)
-            fwd_reputacion = fwd_rep["reputation"] if fwd_rep else 50
-            fwd_edad = estimar_fecha_creacion(fwd_user.id)
-            forward_info = f"El mensaje es un reenvío de {fwd_user.first_name} (ID: {fwd_user.id}, Edad: {fwd_edad}, Reputación: {fwd_reputacion}/100)."
-        elif hasattr(origin, 'chat') and origin.chat:
-            fwd_chat = origin.chat
-            forward_info = f"El mensaje es un reenvío del chat '{fwd_chat.title}' (ID: {fwd_chat.id})."
-        elif hasattr(origin, 'sender_name') and origin.sender_name:
-            forward_info = f"El mensaje es un reenvío de '{origin.sender_name}' (usuario oculto)."
-    # Fallback para API antigua (si existe)
-    elif hasattr(update.message, 'forward_from') and update.message.forward_from:
-        fwd_user = update.message.forward_from
-        fwd_rep = get_user_reputation(fwd_user.id)
-        fwd_reputacion = fwd_rep["reputation"] if fwd_rep else 50
-        fwd_edad = estimar_fecha_creacion(fwd_user.id)
-        forward_info = f"El mensaje es un reenvío de {fwd_user.first_name} (ID: {fwd_user.id}, Edad: {fwd_edad}, Reputación: {fwd_reputacion}/100)."
-    elif hasattr(update.message, 'forward_from_chat') and update.message.forward_from_chat:
-        fwd_chat = update.message.forward_from_chat
-        forward_info = f"El mensaje es un reenvío del chat '{fwd_chat.title}' (ID: {fwd_chat.id})."
-    elif hasattr(update.message, 'forward_sender_name') and update.message.forward_sender_name:
-        forward_info = f"El mensaje es un reenvío de '{update.message.forward_sender_name}' (usuario oculto)."
+    perfil = perfil_reenvio(update.message)
+    if perfil:
+        veces = contar_reenvio(update.effective_chat.id, perfil.clave, cfg, registrar=False)
+        forward_info = describir_reenvio(perfil, cfg, veces, para_ia=True)
     
     # Identificar si el usuario es Kai (el padre de Mashi)
     es_kai = user.id == OWNER_ID
     nombre_usuario = "Kai (tu padre/creador)" if es_kai else user.first_name
     
     # ============== SISTEMA DE DETECCIÓN DE HOSTILIDAD / NSFW / ELOGIOS ==============
-    es_hostil, insulto_detectado = detectar_hostilidad(msg_text)
-    es_nsfw, nsfw_detectado = detectar_nsfw(msg_text) if not es_hostil else (False, "")
+    es_hostil, insulto_detectado, es_nsfw, nsfw_detectado = await clasificar_mensaje(msg_text)
     elogio_detectado = detectar_elogio(msg_text) if not es_hostil else False
-    user_rep_data = get_user_reputation(user.id)
-    reputacion_actual = user_rep_data["reputation"] if user_rep_data else 50
-    roleplay_permitido = es_nsfw and reputacion_actual >= 40 and not es_hostil
+    user_rep_data = get_user_reputation(user.id, cfg)
+    reputacion_actual = user_rep_data["reputation"] if user_rep_data else cfg.rep_baseline
+    if user_rep_data is None and not es_kai and not es_hostil:
+        registrar_usuario_nuevo(user.id, user.username or user.first_name, cfg)
+    elif user_rep_data and not es_hostil:  # Con insulto, update_user_reputation ya renueva last_seen
+        marcar_visto(user.id, user_rep_data["last_seen"])
+    roleplay_permitido = es_nsfw and reputacion_actual >= cfg.nsfw_min_rep and not es_hostil
 
     # ============== DETECCIÓN DE RETOS/CONFRONTACIONES ==============
     retos_patterns = [
@@ -933,34 +3424,33 @@ async def conversacion_natural(update: Update, context: ContextTypes.DEFAULT_TYP
             break
     
     # Si es hostil y NO es Kai, actualizar reputación
+    insultos_previos = []
     if es_hostil and not es_kai:
+        insultos_previos = insultos_recientes(user.id)
         reputacion_actual = update_user_reputation(
             user.id,
             user.username or user.first_name,
             delta=-10,  # Penalización por insulto
-            insulto=insulto_detectado
+            insulto=insulto_detectado,
+            cfg=cfg,
+            chat_id=update.effective_chat.id
         )
         logger.info(f"🔥 Hostilidad detectada de {user.first_name}: '{insulto_detectado}'")
 
         # Si además es reto y reputación muy baja, advertir
         if es_reto and reputacion_actual < 30:
-            warnings_count, was_banned = add_warning(user.id, user.username or user.first_name, f"Insulto + reto: {insulto_detectado}")
+            warnings_count, was_banned = add_warning(user.id, user.username or user.first_name, f"Insulto + reto: {insulto_detectado}", cfg.max_warnings, cfg.ban_hours)
             if was_banned:
                 # Banear temporalmente
-                try:
-                    await context.bot.ban_chat_member(update.effective_chat.id, user.id, until_date=datetime.now() + timedelta(hours=3))
-                    await update.message.reply_text(f"El mortal {user.mention_html()} ha sido exiliado temporalmente por comportamiento inadecuado. Regresará en 3 horas.", parse_mode=ParseMode.HTML)
-                    db_safe_run("INSERT INTO mod_logs (action, target_id, timestamp) VALUES (?, ?, ?)", ("exilio_temporal", user.id, datetime.now().isoformat()), commit=True)
-                except Exception as e:
-                    logger.error(f"Error baneando: {e}")
+                chat_id = update.effective_chat.id
+                await ejecutar_moderacion("exilio_temporal", chat_id, user.id, [
+                    {"ban": lambda: context.bot.ban_chat_member(chat_id, user.id, until_date=datetime.now() + timedelta(hours=cfg.ban_hours))},
+                    {"respuesta": lambda: update.message.reply_text(f"El mortal {user.mention_html()} ha sido exiliado temporalmente por comportamiento inadecuado. Regresará en {cfg.ban_hours} horas.", parse_mode=ParseMode.HTML)},
+                ], reason=f"Insulto + reto: {insulto_detectado}")
             else:
-                await update.message.reply_text(f"⚠️ Advertencia {warnings_count}/3 para {user.mention_html()}. Comportamiento inadecuado.", parse_mode=ParseMode.HTML)
+                await update.message.reply_text(f"⚠️ Advertencia {warnings_count}/{cfg.max_warnings} para {user.mention_html()}. Comportamiento inadecuado.", parse_mode=ParseMode.HTML)
 
-    elif not es_hostil and not es_kai:
-        # Mensaje normal = pequeña mejora de reputación
-        if random.random() < 0.3:  # 30% de chance de mejorar rep
-            update_user_reputation(user.id, user.username or user.first_name, delta=1)
-    
+    # Los mensajes normales no escriben: la subida por tiempo limpio es pasiva (reputacion_efectiva al leer)
     CHAT_CONTEXT.append(f"{nombre_usuario}: {msg_text}")
 
     if not es_hostil and es_saludo_hola_leon(msg_text):
@@ -986,7 +3476,7 @@ async def conversacion_natural(update: Update, context: ContextTypes.DEFAULT_TYP
         is_hostile_trigger = es_hostil and (is_reply or is_mentioned)  # Solo responder a insultos dirigidos al bot
         is_nsfw_trigger = es_nsfw
         is_praise_trigger = elogio_detectado and reputacion_actual >= 60
-        random_threshold = 0.0001 if reputacion_actual >= 60 else 0.00005  # Muy baja probabilidad de iniciar conversación
+        random_threshold = cfg.random_reply_prob_high if reputacion_actual >= 60 else cfg.random_reply_prob_low  # Muy baja probabilidad de iniciar conversación
         random_chance = random.random() < random_threshold
 
     if is_reply or is_mentioned or is_from_kai or is_hostile_trigger or is_nsfw_trigger or is_praise_trigger or random_chance:
@@ -1002,13 +3492,13 @@ async def conversacion_natural(update: Update, context: ContextTypes.DEFAULT_TYP
         elif es_hostil:
             # Obtener memoria de insultos previos
             memoria_insultos = ""
-            if user_rep_data and user_rep_data["insultos_memoria"]:
-                memoria_insultos = f"\nInsultos previos de este usuario: {user_rep_data['insultos_memoria']}"
+            if insultos_previos:
+                memoria_insultos = f"\nInsultos previos de este usuario: {'|'.join(insultos_previos)}"
             
             prompt_sistema += f"""
 
 ⚠️ ALERTA DE HOSTILIDAD DETECTADA ⚠️
-El usuario '{user.first_name}' te ha insultado con: "{insulto_detectado}"
+El usuario '{user.first_name}' te ha insultado con: "{msg_text[:60] if insulto_detectado == ETIQUETA_PARAFRASIS else insulto_detectado}"
 Su reputación actual: {reputacion_actual}/100 ({"muy baja" if reputacion_actual < 20 else "baja" if reputacion_actual < 40 else "media"})
 {memoria_insultos}
 
@@ -1042,20 +3532,25 @@ ACTIVA EL MÓDULO DE CONTRAATAQUE:
             prompt_usuario += "El mortal insinúa contenido adulto sin suficiente confianza. Recuérdale las reglas con firmeza.\n\n"
         prompt_usuario += "Responde al último mensaje como Mashi:"
         
+        motivo = "ia_no_disponible"
         if ia_disponible:
-            respuesta = await consultar_ia(prompt_sistema, prompt_usuario)
+            respuesta, motivo = await consultar_ia_con_presupuesto(
+                prompt_sistema, prompt_usuario, update.effective_chat.id, user.id, cfg
+            )
             if respuesta:
                 CHAT_CONTEXT.append(f"Mashi: {respuesta}")
                 await update.message.reply_text(respuesta)
                 return
         
-        fallback = construir_respuesta_fallback(es_kai, es_hostil, reputacion_actual, insulto_detectado, es_nsfw, nsfw_detectado, user)
+        incrementar("mashi_fallbacks_total", origen="conversacion", motivo=motivo)
+        fallback = construir_respuesta_fallback(es_kai, es_hostil, reputacion_actual, insulto_detectado, es_nsfw, nsfw_detectado, user, cfg.nsfw_min_rep)
         CHAT_CONTEXT.append(f"Mashi: {fallback}")
         await update.message.reply_text(fallback)
         return
 
 async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.id not in ALLOWED_CHATS: return
+    cfg = get_chat_config(update.effective_chat.id)
+    if not cfg: return
     new_members = update.message.new_chat_members
     chat_id = update.effective_chat.id
     adder = update.message.from_user
@@ -1083,7 +3578,9 @@ async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
             edad_estimada = estimar_fecha_creacion(member.id)
             kb = [[InlineKeyboardButton("Soy Mayor de 18", callback_data=f"age_yes:{member.id}")],
                   [InlineKeyboardButton("Soy Menor", callback_data=f"age_no:{member.id}")]]
-            await context.bot.send_message(chat_id, f"Mortal {member.mention_html()} (Cuenta: {edad_estimada}), confirma tu edad (+18) para permanecer en el templo.", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+            aviso = await context.bot.send_message(chat_id, f"Mortal {member.mention_html()} (Cuenta: {edad_estimada}), confirma tu edad (+18) para permanecer en el templo.", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+            add_pending_verification(chat_id, member.id, aviso.message_id, cfg.verification_timeout_min)
+            schedule_verification_timer(context.job_queue)
 
 async def age_verification_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1096,16 +3593,171 @@ async def age_verification_handler(update: Update, context: ContextTypes.DEFAULT
         return await query.answer("No es tu verificación.", show_alert=True)
 
     await query.answer()
+    resolve_pending_verification(update.effective_chat.id, target_id)
     if action == "age_yes":
         await query.edit_message_text(f"El mortal {query.from_user.mention_html()} ha sido aceptado.", parse_mode=ParseMode.HTML)
     elif action == "age_no":
         try:
-            await context.bot.ban_chat_member(query.effective_chat.id, target_id)
+            await context.bot.ban_chat_member(update.effective_chat.id, target_id)
             await query.edit_message_text(f"El mortal {query.from_user.mention_html()} ha confesado ser menor. Exiliado.", parse_mode=ParseMode.HTML)
         except: pass
 
+def schedule_verification_timer(job_queue):
+    """(Re)arma el único timer para que despierte en el deadline más próximo del heap."""
+    global _VERIFICATION_TIMER, _VERIFICATION_TIMER_AT
+    if job_queue is None:
+        logger.warning("JobQueue no disponible: las verificaciones de edad no expirarán solas.")
+        return
+    deadline = next_verification_deadline()
+    if _VERIFICATION_TIMER is not None and deadline is not None and _VERIFICATION_TIMER_AT <= deadline:
+        return  # El timer actual ya despierta antes
+    if _VERIFICATION_TIMER is not None:
+        try:
+            _VERIFICATION_TIMER.schedule_removal()
+        except Exception:
+            pass
+        _VERIFICATION_TIMER = None
+        _VERIFICATION_TIMER_AT = None
+    if deadline is None:
+        return
+    _VERIFICATION_TIMER = job_queue.run_once(expire_verifications_job, when=max(0.0, deadline - time.time()), name="verificaciones_edad")
+    _VERIFICATION_TIMER_AT = deadline
+
+async def expire_verifications_job(context: ContextTypes.DEFAULT_TYPE):
+    """Expulsa a quien no confirmó su edad a tiempo y borra sus avisos en lote."""
+    global _VERIFICATION_TIMER, _VERIFICATION_TIMER_AT
+    _VERIFICATION_TIMER = None
+    _VERIFICATION_TIMER_AT = None
+
+    expired = pop_expired_verifications()
+    for chat_id, items in expired.items():
+        # Kick = ban + unban inmediato, todos los expulsados del chat en paralelo
+        await asyncio.gather(*(
+            ejecutar_moderacion("expulsar_no_verificado", chat_id, user_id, [
+                {"ban": lambda user_id=user_id: context.bot.ban_chat_member(chat_id, user_id)},
+                {"unban": lambda user_id=user_id: context.bot.unban_chat_member(chat_id, user_id)},
+            ], reason="Edad sin confirmar")
+            for user_id, _ in items
+        ))
+        await borrar_en_lotes(context.bot, chat_id, [message_id for _, message_id in items if message_id])
+        logger.info(f"⏳ {len(items)} mortales sin verificar expulsados de {chat_id}")
+
+    schedule_verification_timer(context.job_queue)
+
+async def indexar_mensaje(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Grupo -2: anota (message_id, user_id) de cada mensaje nuevo en el índice acotado del chat."""
+    message = update.message
+    if not message or not get_chat_config(message.chat_id):
+        return
+    indice = INDICE_MENSAJES.get(message.chat_id)
+    if indice is None:
+        indice = INDICE_MENSAJES[message.chat_id] = deque(maxlen=INDICE_MENSAJES_MAX)
+    indice.append((message.message_id, message.from_user.id if message.from_user else 0))
+
+def extraer_media(message) -> Optional[tuple]:
+    """(tipo, file_unique_id) del medio de un mensaje. Solo metadatos: nada se descarga ni decodifica."""
+    if message.sticker:
+        return "sticker", message.sticker.file_unique_id
+    if message.animation:  # Antes que document: los GIF también traen document
+        return "animation", message.animation.file_unique_id
+    if message.photo:
+        return "photo", message.photo[-1].file_unique_id  # El tamaño mayor, siempre el mismo por foto
+    if message.video:
+        return "video", message.video.file_unique_id
+    if message.document:
+        return "document", message.document.file_unique_id
+    return None
+
+def contar_repeticion_media(chat_id: int, file_unique_id: str, user_id: int, message_id: int,
+                            cfg: ChatConfig, ahora: float = None) -> list:
+    """Registra una aparición del medio enviada por user_id. Al llegar a cfg.media_repeat_limit dentro de la
+    ventana retorna todas sus copias [(user_id, message_id)] a purgar; por encima del límite, solo la nueva.
+
+    Se cuenta por usuario: el sticker de reacción que usa medio chat no es spam, el que lo repite solo sí.
+    """
+    if not cfg.media_repeat_limit:
+        return []
+    ahora = ahora or time.time()
+    rastreo = MEDIA_REPETICIONES.setdefault(chat_id, OrderedDict())
+    clave = (user_id, file_unique_id)
+    copias = rastreo.get(clave)
+    if copias is None:
+        copias = rastreo[clave] = deque(maxlen=MEDIA_COPIAS_MAX)
+        if len(rastreo) > MEDIA_RASTREO_MAX:
+            rastreo.popitem(last=False)
+    else:
+        rastreo.move_to_end(clave)
+    while copias and copias[0][0] < ahora - cfg.media_repeat_window_s:
+        copias.popleft()
+    copias.append((ahora, message_id))
+    if len(copias) < cfg.media_repeat_limit:
+        return []
+    if len(copias) == cfg.media_repeat_limit:
+        return [(user_id, mid) for _, mid in copias]
+    return [(user_id, message_id)]
+
+async def moderar_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stickers, GIFs, fotos, vídeos y documentos de humanos: lista negra y repeticiones por usuario y file_unique_id."""
+    message = update.effective_message
+    if not message or not update.effective_chat: return
+    cfg = get_chat_config(update.effective_chat.id)
+    if not cfg: return
+    user = update.effective_user
+    # Los bots los purga handle_bot_messages
+    if not user or user.is_bot or user.id == OWNER_ID or user.id in TELEGRAM_SYSTEM_IDS: return
+    media = extraer_media(message)
+    if not media: return
+    tipo, file_unique_id = media
+    chat_id = update.effective_chat.id
+
+    if file_unique_id in MEDIA_BLOCKLIST:
+        await ejecutar_moderacion("media_bloqueado", chat_id, user.id, [
+            {"borrar": message.delete,
+             "restringir": lambda: context.bot.restrict_chat_member(
+                 chat_id, user.id, permissions=ChatPermissions(can_send_messages=False),
+                 until_date=datetime.now() + timedelta(minutes=cfg.media_mute_min))},
+        ], reason=f"Medio en lista negra ({tipo})")
+        incrementar("mashi_media_bloqueados_total", tipo=tipo)
+        return
+
+    copias = contar_repeticion_media(chat_id, file_unique_id, user.id, message.message_id, cfg)
+    if copias:
+        borrados = await borrar_en_lotes(context.bot, chat_id, [mid for _, mid in copias])
+        incrementar("mashi_media_repetidos_purgados_total", borrados, tipo=tipo)
+        if len(copias) > 1:
+            log_mod_action("purga_media_repetido", user.id, chat_id, reason=f"{tipo} {file_unique_id} x{len(copias)}")
+            logger.info(f"🧹 {len(copias)} copias de un {tipo} purgadas en {chat_id}")
+
+async def moderar_reenvios(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Grupo -1: cuenta los reenvíos por origen y chat; marca los orígenes masivos y borra lo que pase de forward_limit."""
+    message = update.effective_message
+    if not message or not update.effective_chat: return
+    cfg = get_chat_config(update.effective_chat.id)
+    if not cfg: return
+    user = update.effective_user
+    if not user or user.is_bot or user.id == OWNER_ID or user.id in TELEGRAM_SYSTEM_IDS: return
+    # Solo el origen que trae el propio mensaje: el perfil (lectura de BD) lo carga quien lo describe
+    origen = origen_reenvio(message)
+    if not origen: return
+    tipo, origen_id, nombre = origen
+    chat_id = update.effective_chat.id
+    veces = contar_reenvio(chat_id, clave_reenvio(tipo, origen_id, nombre), cfg)
+    incrementar("mashi_forwards_total", tipo=tipo)
+
+    if cfg.forward_flag_limit and veces == cfg.forward_flag_limit:
+        log_mod_action("origen_reenvio_masivo", origen_id, chat_id,
+                       reason=f"{tipo} {nombre} x{veces} en {cfg.forward_window_s:.0f} s")
+        incrementar("mashi_forward_sources_flagged_total", tipo=tipo)
+        logger.warning(f"🔁 Origen de reenvíos masivo en {chat_id}: {tipo} {nombre} ({veces})")
+
+    if cfg.forward_limit and veces > cfg.forward_limit:
+        await ejecutar_moderacion("limitar_reenvio", chat_id, user.id, [{"borrar": message.delete}],
+                                  reason=f"Reenvío nº {veces} de {tipo} {nombre}")
+        incrementar("mashi_forwards_limited_total", tipo=tipo)
+        raise ApplicationHandlerStop  # Borrado: que ningún otro handler le responda
+
 async def handle_bot_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.effective_chat or update.effective_chat.id not in ALLOWED_CHATS: return
+    if not update.effective_chat or not get_chat_config(update.effective_chat.id): return
     user = update.effective_user
     if not user or user.id in TELEGRAM_SYSTEM_IDS: return
     if not user.is_bot or user.id == context.bot.id: return
@@ -1126,31 +3778,279 @@ async def handle_bot_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
 # BLOQUE 9: EJECUCIÓN PRINCIPAL
 ###############################################################################
 
+async def post_init(application: Application) -> None:
+    """Restaura estado persistido antes de empezar a recibir updates."""
+    global _METRICS_SERVER, _VIGILANTE
+    restaurar_snapshot()  # Antes de que llegue el primer update
+    # También antes del polling: un clic en el botón llegado antes de restaurarlas no encontraría su
+    # entrada, y la fila restaurada después expulsaría a quien ya se verificó
+    restauradas = load_pending_verifications()
+    if restauradas:
+        logger.info(f"⏳ {restauradas} verificaciones de edad pendientes restauradas.")
+    schedule_verification_timer(application.job_queue)
+    logger.info(f"🚫 {reload_media_blocklist()} medios en la lista negra.")
+    puerto = METRICS_PORT + 1 + WORKER_SHARD[0] if WORKER_SHARD and METRICS_PORT else METRICS_PORT
+    _METRICS_SERVER = await start_metrics_server(puerto)
+    abrir_grabador()
+    if os.environ.get("MASHI_HTTP2") == "1" and not HTTP2:
+        logger.warning("⚠️ MASHI_HTTP2=1 pero falta h2 (pip install \"httpx[http2]\"): se usa HTTP/1.1.")
+    _VIGILANTE = VigilanteLoop()
+    _VIGILANTE.iniciar()
+    if application.job_queue:
+        # Lo no imprescindible se carga cuando el polling ya está activo (la JobQueue arranca después)
+        application.job_queue.run_once(calentar_caches_job, when=0, name="calentamiento")
+        application.job_queue.run_repeating(flush_audit_job, interval=AUDIT_FLUSH_INTERVAL, name="auditoria")
+        if not WORKER_SHARD or WORKER_SHARD[0] == 0:  # Un solo proceso mantiene la BD compartida
+            application.job_queue.run_repeating(mantenimiento_job, interval=600, first=60, name="mantenimiento")
+    else:
+        await calentar_caches(application)
+
+async def calentar_caches(application: Application) -> None:
+    """Carga el estado diferible (el clasificador) sin retrasar el primer update."""
+    global _CLASIFICADOR
+    # Mientras carga (NumPy + modelo), los mensajes siguen con las regex
+    _CLASIFICADOR = await asyncio.get_running_loop().run_in_executor(None, cargar_clasificador)
+    logger.info(f"🚀 Polling activo a los {(time.perf_counter() - _ARRANQUE) * 1000:.0f} ms del arranque.")
+
+async def calentar_caches_job(context: ContextTypes.DEFAULT_TYPE):
+    await calentar_caches(context.application)
+
+async def post_shutdown(application: Application) -> None:
+    """Vacía lo que quede en memoria antes de salir."""
+    flush_mod_logs()
+    flush_uso_ia()
+    guardar_snapshot()
+    if _METRICS_SERVER:
+        _METRICS_SERVER.close()
+    if _VIGILANTE:
+        _VIGILANTE.detener()
+    cerrar_grabador()
+    await cerrar_http_llm()
+
+async def flush_audit_job(context: ContextTypes.DEFAULT_TYPE):
+    flush_mod_logs()
+    flush_uso_ia()
+
+async def mantenimiento_job(context: ContextTypes.DEFAULT_TYPE):
+    """Archiva lo caducado y compacta la BD una vez al día, dentro de QUIET_HOURS."""
+    global _ULTIMO_MANTENIMIENTO
+    ahora = datetime.now()
+    if not en_horas_tranquilas(ahora.hour) or _ULTIMO_MANTENIMIENTO == ahora.date():
+        return
+    _ULTIMO_MANTENIMIENTO = ahora.date()
+    archivadas, liberadas = await ejecutar_mantenimiento()
+    logger.info(f"🧹 Mantenimiento: {sum(archivadas.values())} filas archivadas, {liberadas} páginas liberadas.")
+
+def registrar_handlers(application: Application) -> None:
+    """Registra todos los handlers (medidos). Compartido por el modo simple y los workers."""
+    comandos = {
+        "start": start, "relato": relato, "tienda": tienda, "info": info,
+        "purificar": purificar, "purgar": purgar, "exilio": exilio, "reputacion": reputacion, "insultos": insultos, "debug": debug,
+        "bd": bd, "restaurar": restaurar, "exportar": exportar, "consumo": consumo,
+        "bloquear_media": bloquear_media, "desbloquear_media": desbloquear_media,
+        "advertir": advertir, "silenciar": silenciar, "expulsar": expulsar,
+        "pendientes": pendientes, "config": config, "permitir": permitir, "vetar": vetar,
+        "perf": perf, "perfilar": perfilar,
+    }
+    if RECORD_UPDATES_PATH:  # Antes que nada: se graba el update tal como llegó
+        application.add_handler(TypeHandler(Update, grabar_update), group=-3)
+    application.add_handler(MessageHandler(filters.ALL, indexar_mensaje), group=-2)
+    # Antes de los handlers del grupo 0, que leen el conteo y no deben responder a un reenvío borrado
+    application.add_handler(MessageHandler(filters.FORWARDED, medir_handler(moderar_reenvios)), group=-1)
+    for nombre, callback in comandos.items():
+        application.add_handler(CommandHandler(nombre, medir_handler(callback)))
+    
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, medir_handler(handle_new_members)))
+    application.add_handler(CallbackQueryHandler(medir_handler(age_verification_handler), pattern="^age_"))
+    
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), medir_handler(conversacion_natural)))
+    application.add_handler(MessageHandler(filters.ALL, medir_handler(handle_bot_messages)))
+    # Grupo propio: corre además del manejador de bots del grupo 0
+    application.add_handler(MessageHandler(
+        filters.Sticker.ALL | filters.ANIMATION | filters.PHOTO | filters.VIDEO | filters.Document.ALL,
+        medir_handler(moderar_media)
+    ), group=1)
+
+def construir_aplicacion(request=None, **builder_kwargs) -> Application:
+    """
+    ApplicationBuilder con el transporte instrumentado (mide cada llamada a la Bot API).
+    `request` permite inyectar otro transporte (p. ej. el Bot falso del replay).
+    """
+    builder = ApplicationBuilder().token(TOKEN).request(request or RequestInstrumentado("telegram", HTTP_POOL_SIZE))
+    if "updater" not in builder_kwargs:  # Sin updater no hay long polling propio
+        # Pool aparte: getUpdates retiene su conexión hasta 10 s y no debe hacer esperar a los envíos
+        builder = builder.get_updates_request(RequestInstrumentado("polling", HTTP_POLL_POOL_SIZE))
+    for metodo, valor in builder_kwargs.items():
+        builder = getattr(builder, metodo)(valor)
+    return builder.build()
+
+# ============== MODO MULTIPROCESO (WORKERS POR CHAT) ==============
+
+def shard_for_chat(chat_id: int, workers: int) -> int:
+    """Worker que atiende un chat. Todo el estado de un chat vive en un único proceso."""
+    return chat_id % workers
+
+def update_shard_key(update: Update) -> int:
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+async def refresh_chat_config_job(context: ContextTypes.DEFAULT_TYPE):
+    """En workers: recoge cambios de /config y de la lista negra de medios hechos desde otro proceso."""
+    if chat_config_signature() != _CHAT_CONFIG_SIGNATURE:
+        logger.info(f"⚙️ Configuración recargada: {reload_chat_config()} chats.")
+    if media_blocklist_signature() != _MEDIA_BLOCKLIST_SIGNATURE:
+        logger.info(f"🚫 Lista negra de medios recargada: {reload_media_blocklist()} medios.")
+
+def worker_main(indice: int, workers: int, cola) -> None:
+    """Proceso worker: procesa solo los updates de sus chats, recibidos por IPC."""
+    # El front coordina el apagado con un centinela; las señales del grupo se ignoran
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_loop(indice, workers, cola))
+
+async def _worker_loop(indice: int, workers: int, cola) -> None:
+    global WORKER_SHARD
+    WORKER_SHARD = (indice, workers)
+    reload_chat_config()
+    application = construir_aplicacion(updater=None)
+    registrar_handlers(application)
+    loop = asyncio.get_running_loop()
+
+    async with application:
+        await post_init(application)  # initialize() no lo invoca por sí mismo
+        application.job_queue.run_repeating(refresh_chat_config_job, interval=30, name="config_refresh")
+        await application.start()
+        logger.info(f"🧩 Worker {indice}/{workers} listo (pid {os.getpid()}).")
+        while True:
+            data = await loop.run_in_executor(None, cola.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        await post_shutdown(application)
+    logger.info(f"🧩 Worker {indice} detenido.")
+
+def run_front(workers: int) -> None:
+    """Proceso front: hace long polling y reparte cada update al worker de su chat."""
+    ctx = multiprocessing.get_context("spawn")
+    colas = [ctx.Queue() for _ in range(workers)]
+    procesos = [
+        ctx.Process(target=worker_main, args=(i, workers, colas[i]), name=f"mashi-worker-{i}")
+        for i in range(workers)
+    ]
+    for proceso in procesos:
+        proceso.start()
+
+    async def despachar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        colas[shard_for_chat(update_shard_key(update), workers)].put(update.to_dict())
+
+    async def detener_workers(application: Application) -> None:
+        for cola in colas:
+            cola.put(None)
+        for proceso in procesos:
+            await asyncio.get_running_loop().run_in_executor(None, proceso.join, 15)
+            if proceso.is_alive():
+                logger.warning(f"{proceso.name} no respondió al centinela, terminando.")
+                proceso.terminate()
+
+    application = construir_aplicacion(post_shutdown=detener_workers)
+    application.add_handler(TypeHandler(Update, despachar))
+    logger.info(f"Mashi está en línea (front + {workers} workers).")
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def validar_entorno() -> None:
+    """Comprueba la configuración obligatoria antes de arrancar (no al importar el módulo)."""
+    if not TOKEN:
+        raise ValueError("ERROR: Falta TELEGRAM_TOKEN en .env")
+    if not OWNER_ID:
+        raise ValueError("ERROR: Falta OWNER_ID en .env")
+    if GEMINI_API_KEY:
+        logger.info("✅ API Key de Gemini cargada correctamente.")
+    else:
+        logger.warning("⚠️ No se encontró GEMINI_API_KEY. La IA no funcionará.")
+
+def ejecutar_volcado(args) -> None:
+    """Subcomandos `export` / `import`: no necesitan token, solo la BD."""
+    setup_database()
+    if args.accion == "export":
+        os.makedirs(args.dir, exist_ok=True)
+        for tabla in args.tablas or list(TABLAS_EXPORTABLES):
+            ruta = os.path.join(args.dir, f"{tabla}.{args.formato}" + (".gz" if args.gzip else ""))
+            inicio = time.perf_counter()
+            with abrir_volcado(ruta, "w") as destino:
+                filas = exportar_tabla(tabla, destino, args.formato)
+            print(f"📤 {tabla}: {filas} filas -> {ruta} ({time.perf_counter() - inicio:.2f} s)")
+        return
+    for ruta in args.archivos:
+        nombre = os.path.basename(ruta)
+        tabla = args.tabla or nombre.split(".", 1)[0]
+        inicio = time.perf_counter()
+        with abrir_volcado(ruta, "r") as origen:
+            filas = importar_tabla(tabla, origen, formato_de(ruta))
+        print(f"📥 {tabla}: {filas} filas <- {ruta} ({time.perf_counter() - inicio:.2f} s)")
+
+def ejecutar_entrenamiento(args) -> None:
+    """Subcomando `entrenar`: JSONL con {"texto", "hostil", "nsfw"} -> modelo .npz del clasificador."""
+    import numpy as np
+    textos, etiquetas = [], []
+    with abrir_volcado(args.datos, "r") as origen:
+        for linea in origen:
+            if linea.strip():
+                ejemplo = json.loads(linea)
+                textos.append(ejemplo["texto"])
+                etiquetas.append((int(ejemplo.get("hostil", 0)), int(ejemplo.get("nsfw", 0))))
+    inicio = time.perf_counter()
+    modelo = ModeloNgramas.entrenar(np, textos, etiquetas, epocas=args.epocas)
+    modelo.guardar(args.salida)
+    print(f"🧠 Clasificador entrenado con {len(textos)} ejemplos en {time.perf_counter() - inicio:.1f} s -> {args.salida}")
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Mashi, guardián del templo.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("MASHI_WORKERS", "0")),
+                        help="Procesos worker (por chat_id). 0 o 1 = un solo proceso.")
+    subcomandos = parser.add_subparsers(dest="accion")
+    exportacion = subcomandos.add_parser("export", help="Volcar tablas a CSV/JSONL")
+    exportacion.add_argument("tablas", nargs="*", metavar="tabla",
+                             help=f"Por defecto todas: {', '.join(TABLAS_EXPORTABLES)}")
+    exportacion.add_argument("--formato", choices=FORMATOS_VOLCADO, default="csv")
+    exportacion.add_argument("--dir", default=".", help="Carpeta de salida (<tabla>.<formato>)")
+    exportacion.add_argument("--gzip", action="store_true", help="Comprimir la salida")
+    importacion = subcomandos.add_parser("import", help="Cargar volcados CSV/JSONL (upsert)")
+    importacion.add_argument("archivos", nargs="+", help="<tabla>.csv|.jsonl[.gz]")
+    importacion.add_argument("--tabla", choices=list(TABLAS_EXPORTABLES), help="Si el nombre del archivo no es la tabla")
+    entrenamiento = subcomandos.add_parser("entrenar", help="Entrenar el clasificador local (NumPy)")
+    entrenamiento.add_argument("datos", help='JSONL con {"texto": ..., "hostil": 0|1, "nsfw": 0|1}')
+    entrenamiento.add_argument("--salida", default=CLASSIFIER_PATH)
+    entrenamiento.add_argument("--epocas", type=int, default=80)
+    args = parser.parse_args()
+
+    if args.accion == "entrenar":
+        ejecutar_entrenamiento(args)
+        return
+    if args.accion:
+        desconocidas = set(getattr(args, "tablas", [])) - set(TABLAS_EXPORTABLES)
+        if desconocidas:
+            parser.error(f"tablas no exportables: {', '.join(sorted(desconocidas))}")
+        ejecutar_volcado(args)
+        return
+
     logger.info("Iniciando Mashi (Gemini Mode)...")
+    validar_entorno()
     setup_database()
-    application = ApplicationBuilder().token(TOKEN).build()
-    
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("relato", relato))
-    application.add_handler(CommandHandler("tienda", tienda))
-    application.add_handler(CommandHandler("info", info))
-    application.add_handler(CommandHandler("purificar", purificar))
-    application.add_handler(CommandHandler("exilio", exilio))
-    application.add_handler(CommandHandler("reputacion", reputacion))
-    application.add_handler(CommandHandler("debug", debug))
-    application.add_handler(CommandHandler("advertir", advertir))
-    application.add_handler(CommandHandler("silenciar", silenciar))
-    application.add_handler(CommandHandler("expulsar", expulsar))
-    
-    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_members))
-    application.add_handler(CallbackQueryHandler(age_verification_handler, pattern="^age_"))
-    
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), conversacion_natural))
-    application.add_handler(MessageHandler(filters.ALL, handle_bot_messages))
+    logger.info(f"⚙️ {reload_chat_config()} chats configurados.")
+
+    if args.workers > 1:
+        run_front(args.workers)
+        return
+
+    application = construir_aplicacion(post_init=post_init, post_shutdown=post_shutdown)
+    registrar_handlers(application)
 
     logger.info("Mashi está en línea.")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()